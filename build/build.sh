@@ -66,6 +66,7 @@ do
     sudo docker exec -it $cname rm /home/$cscript
 
     sudo docker cp $cur_dir/../utils/udp.py $cname:/home/
+    sudo docker cp $cur_dir/../utils/units.py $cname:/home/
 done
 
 # Run the default configuration
@@ -89,6 +90,7 @@ do
     # Copy dummy sender/receiver
     sudo docker cp $cur_dir/../utils/schedule_flows.py $cname:/home/
     sudo docker cp $cur_dir/../utils/udp.py $cname:/home/
+    sudo docker cp $cur_dir/../utils/units.py $cname:/home/
 
 done
 
@@ -110,6 +112,7 @@ do
     sudo docker exec -it $cname /home/$cscript
     sudo docker exec -it $cname rm /home/$cscript
     sudo docker cp $cur_dir/../utils/udp.py $cname:/home/
+    sudo docker cp $cur_dir/../utils/units.py $cname:/home/
 done
 
 # Load the topology db
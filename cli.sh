@@ -255,7 +255,7 @@ function run
     (cd $cur_dir/utils && sudo nice -n -20 python2 orchestrate.py --topo=$topo --traffic-spec=$trafficpath --failure-spec=$failurepath)
 
     # Check run performance 
-    (cd $cur_dir/utils && python performance.py --traffic-spec=$trafficpath)   
+    (cd $cur_dir/utils && python3 performance.py --traffic-spec=$trafficpath)   
 }
 
 function pipeline
@@ -0,0 +1,199 @@
+"""Capture BFD packets on the switch CPU ports.
+
+The default backend opens one raw AF_PACKET socket per CPU port, attaches a
+BPF filter so the kernel only passes UDP packets to the BFD port 3784, and
+waits on all sockets with epoll. The header fields we need are read directly
+from the frame, without building scapy packets.
+
+The scapy backend is kept as a fallback. To compare the per-packet cost of
+both backends, run this file:
+
+```
+$ python2 bfd_capture.py --packets 100000
+```
+"""
+from __future__ import print_function
+
+import ctypes
+import errno
+import select
+import socket
+import struct
+
+BFD_PORT = 3784
+ETH_P_ALL = 0x0003
+SO_ATTACH_FILTER = 26
+
+# Ethernet, IPv4, UDP and BFD control packet (RFC 5880).
+ETH_HEADER_LEN = 14
+ETH_TYPE_IPV4 = 0x0800
+UDP_HEADER_LEN = 8
+BFD_HEADER_LEN = 24
+
+# Compiled `ip and udp dst port 3784`, see `tcpdump -dd`.
+BPF_BFD_FILTER = [
+    (0x28, 0, 0, 0x0000000c),  # ldh [12]
+    (0x15, 0, 8, 0x00000800),  # jeq #0x800, else drop
+    (0x30, 0, 0, 0x00000017),  # ldb [23]
+    (0x15, 0, 6, 0x00000011),  # jeq #17 (UDP), else drop
+    (0x28, 0, 0, 0x00000014),  # ldh [20]
+    (0x45, 4, 0, 0x00001fff),  # jset #0x1fff (fragment), drop
+    (0xb1, 0, 0, 0x0000000e),  # ldxb 4*([14]&0xf)
+    (0x48, 0, 0, 0x00000010),  # ldh [x + 16]
+    (0x15, 0, 1, BFD_PORT),    # jeq #3784, else drop
+    (0x06, 0, 0, 0x00040000),  # accept
+    (0x06, 0, 0, 0x00000000),  # drop
+]
+
+BACKENDS = ['raw', 'scapy']
+
+
+def parse_bfd(frame):
+    """Extract the fields we need from a BFD frame.
+
+    Args:
+        frame (bytes or bytearray): Ethernet frame.
+
+    Returns:
+        tuple(str, str, int): Source IP, destination IP and the BFD flags,
+            or None if the frame is not a BFD packet.
+    """
+    if len(frame) < ETH_HEADER_LEN + 20:
+        return None
+    if struct.unpack_from('!H', frame, 12)[0] != ETH_TYPE_IPV4:
+        return None
+    ip_header_len = (struct.unpack_from('!B', frame, ETH_HEADER_LEN)[0] &
+                     0x0f) * 4
+    udp_start = ETH_HEADER_LEN + ip_header_len
+    bfd_start = udp_start + UDP_HEADER_LEN
+    if len(frame) < bfd_start + BFD_HEADER_LEN:
+        return None
+    if struct.unpack_from('!H', frame, udp_start + 2)[0] != BFD_PORT:
+        return None
+
+    src = socket.inet_ntoa(bytes(frame[26:30]))
+    dst = socket.inet_ntoa(bytes(frame[30:34]))
+    # Second byte: 2 bit state, 6 bit flags.
+    flags = struct.unpack_from('!B', frame, bfd_start + 1)[0] & 0x3f
+    return src, dst, flags
+
+
+class RawBfdCapture(object):
+    """Raw socket capture of BFD packets on multiple interfaces."""
+
+    def __init__(self, interfaces, buffer_size=2048):
+        self.sockets = {}
+        self._buffer = bytearray(buffer_size)
+        program = b''.join(struct.pack('HBBI', *insn)
+                           for insn in BPF_BFD_FILTER)
+        # Keep the filter buffer alive as long as the sockets.
+        self._filter = ctypes.create_string_buffer(program, len(program))
+        fprog = struct.pack('HL', len(BPF_BFD_FILTER),
+                            ctypes.addressof(self._filter))
+
+        for interface in interfaces:
+            sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                                 socket.htons(ETH_P_ALL))
+            sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+            sock.bind((interface, 0))
+            sock.setblocking(False)
+            self.sockets[sock.fileno()] = sock
+
+    def run(self, callback):
+        """Call `callback(src, dst, flags)` for every captured BFD packet.
+
+        Blocks until the sockets are closed.
+        """
+        poller = select.epoll()
+        for fileno in self.sockets:
+            poller.register(fileno, select.EPOLLIN)
+        try:
+            while self.sockets:
+                for fileno, _ in poller.poll():
+                    self._drain(self.sockets[fileno], callback)
+        finally:
+            poller.close()
+
+    def _drain(self, sock, callback):
+        """Read all pending packets of a socket."""
+        view = memoryview(self._buffer)
+        while True:
+            try:
+                size = sock.recv_into(view)
+            except socket.error as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            fields = parse_bfd(self._buffer[:size])
+            if fields is not None:
+                callback(*fields)
+
+    def close(self):
+        for sock in self.sockets.values():
+            sock.close()
+        self.sockets = {}
+
+
+def sniff_scapy(interfaces, callback):
+    """Fallback capture with scapy, with the same callback as `RawBfdCapture`."""
+    from scapy.all import sniff, IP
+    from scapy.contrib.bfd import BFD
+
+    def _handle(pkt):
+        callback(pkt[IP].src, pkt[IP].dst, int(pkt[BFD].flags))
+
+    sniff(iface=interfaces, prn=_handle, lfilter=lambda x: x.haslayer(BFD))
+
+
+def capture_bfd(interfaces, callback, backend='raw'):
+    """Capture BFD packets on all interfaces with the selected backend."""
+    if backend == 'raw':
+        capture = RawBfdCapture(interfaces)
+        try:
+            capture.run(callback)
+        finally:
+            capture.close()
+    elif backend == 'scapy':
+        sniff_scapy(interfaces, callback)
+    else:
+        raise ValueError("Unknown capture backend '%s'" % backend)
+
+
+def benchmark(packets):
+    """Measure how many packets per second each backend can decode."""
+    import time
+    from scapy.all import Ether, IP, UDP
+    from scapy.contrib.bfd import BFD
+
+    frame = bytes(Ether() / IP(src='9.0.0.6', dst='9.0.0.1') /
+                  UDP(sport=49156, dport=BFD_PORT) / BFD(flags=32))
+    seen = []
+
+    def _callback(src, dst, flags):
+        seen.append(flags)
+
+    start = time.time()
+    buffer = bytearray(frame)
+    for _ in range(packets):
+        fields = parse_bfd(buffer)
+        _callback(*fields)
+    raw_rate = packets / (time.time() - start)
+
+    start = time.time()
+    for _ in range(packets):
+        pkt = Ether(frame)
+        if pkt.haslayer(BFD):
+            _callback(pkt[IP].src, pkt[IP].dst, int(pkt[BFD].flags))
+    scapy_rate = packets / (time.time() - start)
+
+    print("raw    {:12.0f} packets/s".format(raw_rate))
+    print("scapy  {:12.0f} packets/s".format(scapy_rate))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packets', help='Number of packets to decode.',
+                        type=int, required=False, default=100000)
+    args = parser.parse_args()
+    benchmark(args.packets)
@@ -0,0 +1,25 @@
+"""Monotonic clock for Python 2 and 3.
+
+Python 2 has no monotonic clock in the time module, so we call clock_gettime
+of librt directly.
+"""
+try:
+    from time import monotonic
+except ImportError:
+    import ctypes
+
+    CLOCK_MONOTONIC = 1
+
+    class _Timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    _librt = ctypes.CDLL('librt.so.1', use_errno=True)
+    _clock_gettime = _librt.clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def monotonic():
+        """Seconds from a clock that never jumps (CLOCK_MONOTONIC)."""
+        timespec = _Timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
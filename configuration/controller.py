@@ -19,28 +19,85 @@ The controller will be available as the variable `control`.
 
 import argparse
 import csv
+import os
+import sys
 import time
-#LFA RELATED IMPORTS
-from networkx.algorithms import all_pairs_dijkstra
+from collections import deque
+from itertools import combinations
+from Queue import Queue, Empty
 
+from networkx import is_connected
 from p4utils.utils.topology import Topology
 from p4utils.utils.sswitch_API import SimpleSwitchAPI
 
-from scapy.all import sniff, IP, Ether, UDP, sendp
+from scapy.all import IP, Ether, UDP, sendp
 from scapy.contrib.bfd import BFD
 from multiprocessing import Process
 import threading
 import time
 from random import randint
 
+# Helpers shared with the traffic tools (units.py, ring_buffer.py).
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+
+from bfd_capture import BACKENDS, capture_bfd
+from detection import DetectionTimers
+from flowlet_telemetry import FlowletTelemetry, REGISTER_SIZE
+from heartbeat import HeartbeatTransmitter
+from failure_cache import FailureImageCache, start_precompute, precompute_images
+from register_sync import RegisterSync
+from routing import RoutingEngine
+from rule_installer import RulePlan, install_plans, print_install_report
+from units import setSizeToInt
+
+
+def parse_detection_timer(value):
+    """`switch-switch=0.05:3` to a link class and its (interval, multiplier)."""
+    try:
+        link_class, timer = value.split('=')
+        interval, multiplier = timer.split(':')
+        interval, multiplier = float(interval), int(multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected class=interval:multiplier, got %r" % value)
+    if link_class not in Controller.DETECTION_TIMERS:
+        raise argparse.ArgumentTypeError("unknown link class %r, expected one of %s" % (
+            link_class, ", ".join(sorted(Controller.DETECTION_TIMERS))))
+    if interval <= 0 or multiplier < 1:
+        raise argparse.ArgumentTypeError("interval and multiplier must be positive")
+    return link_class, (interval, multiplier)
+
 
 class Controller(object):
     """The central controller for your p4 switches."""
 
     L2_BROADCAST_GROUP_ID = 1
-
-    def __init__(self, topo, traffic=None):
+    # Nexthop register images cached for failures that were not precomputed.
+    FAILURE_CACHE_SIZE = 256
+    # Maximum number of failure sets whose images are precomputed.
+    MAX_PRECOMPUTED_FAILURES = 4096
+    # Failure detection per link class: (heartbeat interval in seconds, detect multiplier).
+    # A link is declared down if no heartbeat arrived for interval * multiplier.
+    DETECTION_TIMERS = {
+        'switch-switch': (0.1, 5),
+        'switch-router': (0.1, 5),
+    }
+    # Flows faster than this (bits per second) are split over several paths.
+    TRAFFIC_SPLIT_RATE = 4e6
+
+    def __init__(self, topo, traffic=None, reconcile=False, capture='raw',
+                 telemetry=None, detection_timers=None):
         self.topo = Topology(db=topo)
+        # In reconcile mode, we keep the current switch state and only
+        # write the difference to the desired state (warm restart).
+        self.reconcile = reconcile
+        # Backend used to capture BFD packets, see bfd_capture.py.
+        self.capture_backend = capture
+        # Options of the flowlet telemetry poller, disabled if None.
+        self.telemetry_options = telemetry
+        # DETECTION_TIMERS, with the given link classes overridden.
+        self.detection_timers = dict(self.DETECTION_TIMERS)
+        self.detection_timers.update(detection_timers or {})
         if traffic is not None:
             # Parse traffic matrix.
             self.traffic = self._parse_traffic_file(traffic)
@@ -50,7 +107,8 @@ class Controller(object):
         # Basic initialization. *Do not* change.
         self.controllers = {}
         self._connect_to_switches()
-        self._reset_states()
+        if not self.reconcile:
+            self._reset_states()
 
         # Start main loop
         self.main()
@@ -70,6 +128,28 @@ class Controller(object):
         for controller in self.controllers.values():
             controller.reset_state()
 
+    def install_rules(self):
+        """Push the recorded rule plans to all switches in parallel."""
+        report = install_plans(self.controllers, self.plans,
+                               reconcile=self.reconcile)
+        print_install_report(report)
+
+    def setup_register_sync(self):
+        """Mirror the registers that are updated at runtime, initialized from the switches."""
+        self.register_sync = {
+            switch: RegisterSync(controller, ['primaryNH', 'alternativeNH', 'linkState'])
+            for switch, controller in self.controllers.items()
+        }
+
+    def verify_registers(self):
+        """Bulk read the mirrored registers and return the indices that differ from the mirror, per switch."""
+        mismatches = {}
+        for switch, sync in self.register_sync.items():
+            differ = sync.verify()
+            if differ:
+                mismatches[switch] = differ
+        return mismatches
+
     @staticmethod
     def _parse_traffic_file(trafficpath):
         with open(trafficpath, 'rb') as csvfile:
@@ -89,6 +169,10 @@ class Controller(object):
         self.ip_lookup_table = {}
         self.populate_ip_lookup_table()
 
+        # All bring-up steps below only record their writes into a plan per
+        # switch. The plans are pushed to all switches in parallel afterwards.
+        self.plans = {switch: RulePlan(switch) for switch in self.controllers}
+
         # This adds the mirrors to receive
         # the forwarded BFD packets from the switches.
         self.add_mirrors()
@@ -103,6 +187,11 @@ class Controller(object):
         # Call MP route
         self.MP_route()
 
+        # Keeps shortest paths up to date when links fail or come back (used in LFA).
+        self.routing = RoutingEngine(self.topo.network_graph)
+        # Nexthop register images per set of failed links.
+        self.failure_cache = FailureImageCache(self.FAILURE_CACHE_SIZE)
+
         # Installing the rewriteMac table to match ports to
         # their MAC addresses.
         self.install_macs()
@@ -110,7 +199,12 @@ class Controller(object):
         self.install_nexthop_indices_LFA()
         # Recalculates next hops and LFAs after link failure is detected and installs them in their
         # relevant registers (specifically the primaryNH and the alternativeNH registers)
-        self.update_nexthops_LFA()
+        self.update_nexthops_LFA(targets=self.plans)
+
+        # Push all recorded entries to the switches at once.
+        self.install_rules()
+        # From now on, registers are updated through their mirrors.
+        self.setup_register_sync()
 
         # This extends the switch graph of the topology to
         # include routers. Specifically this is used so we can also
@@ -122,11 +216,19 @@ class Controller(object):
         # This preserves calculation cycles.
         self.LFA_flag = 0
 
+        # Precompute the nexthop registers for all single and double link failures
+        # in the background, so that a detected failure only needs a cache lookup.
+        self.start_failure_precompute()
+
         # This answers to the routers so that the BFD packets will be sent at a higher rate
         # back to the switches. If a router wouldn't receive a BFD control packet it would
         # - according to RFC 5881 - only send control packets every 1s.
         self.init_bfd()
 
+        # Prebuild the heartbeats between switches. This also tells the sniffer
+        # which packets are our own heartbeats.
+        self.setup_heartbeats()
+
         # All these functions have to run in parallel, thus we are using Threads.
         # Otherwise each of them would block.
         sniffing = threading.Thread(target=self.sniff_bfd_packets)
@@ -158,6 +260,10 @@ class Controller(object):
         interfaces.daemon = True
         interfaces.start()
 
+        # Optionally, observe how traffic is spread over the flowlets.
+        if self.telemetry_options is not None:
+            self.start_flowlet_telemetry()
+
         # Keeping main thread alive so others dont get killed
         # as they are run as daemons.
         while True:
@@ -169,7 +275,7 @@ class Controller(object):
         We check the topology object to get all connected nodes and their
         MAC addresses, and configure static rules accordingly.
         """
-        for switch, controller in self.controllers.items():
+        for switch, controller in self.plans.items():
             # Add broadcast rule.
             controller.table_add("l2_forward", "broadcast",
                                  ["ff:ff:ff:ff:ff:ff"])
@@ -202,7 +308,7 @@ class Controller(object):
     def create_l2_multicast_group(self):
         """Create a multicast group to enable L2 broadcasting.
         """
-        for switch, controller in self.controllers.items():
+        for switch, controller in self.plans.items():
             controller.mc_mgrp_create(self.L2_BROADCAST_GROUP_ID)
             port_list = []
 
@@ -236,29 +342,61 @@ class Controller(object):
             # Get the switch the traffic arrives at first
             switch = "S" + flow['src'][1]
 
-            #Extracting the numeric part of the BW
-            bandwidth = flow['rate'][:-1]
-
-            #If bandwidth > 4, update register for that switch
-            if int(bandwidth) > 4:
+            #If the rate is above the split rate, update register for that switch
+            if setSizeToInt(flow['rate']) > self.TRAFFIC_SPLIT_RATE:
 
-                control = self.controllers[switch]
+                control = self.plans[switch]
                 index = 0
                 state = 1  # means traffic splitting is necessary
                 control.register_write('Bandwidth', index, state)
 
     def check_interface_and_trigger_lfa(self):
         """Checks the interfaces for link failures and then triggers the LFA.
+
+        The heartbeat threads push an event onto self.link_events whenever a link
+        changes its status, so we simply block on this queue and only recompute
+        the LFAs if there actually was a transition. Idle links cost nothing.
         """
 
         while (True):
             try:
+                _, detected = self.link_events.get()
+                # Multiple links may change at the same time. Process all pending
+                # events at once and measure the latency from the first detection.
+                while True:
+                    try:
+                        detected = min(detected, self.link_events.get_nowait()[1])
+                    except Empty:
+                        break
+
                 self.check_interface_status()
                 self.trigger_lfa()
+                if self.LFA_flag:
+                    self.record_lfa_latency(detected)
             except (KeyboardInterrupt, SystemExit):
                 print("Exiting...")
                 break
 
+    def notify_link_event(self, link):
+        """Called by the heartbeat threads when the status of a link changes."""
+        self.link_events.put((link, time.time()))
+
+    def record_lfa_latency(self, detected):
+        """Stores the time between detecting a transition and reprogramming the switches."""
+        latency = time.time() - detected
+        self.lfa_latencies.append(latency)
+        print("Switches reprogrammed {:.1f}ms after detection".format(latency * 1000))
+
+    def get_lfa_latency_stats(self):
+        """Returns count, mean, and max of the recent detection-to-reprogramming latencies in seconds."""
+        if not self.lfa_latencies:
+            return {'count': 0, 'mean': None, 'max': None}
+        return {
+            'count': len(self.lfa_latencies),
+            'mean': sum(self.lfa_latencies) / len(self.lfa_latencies),
+            'max': max(self.lfa_latencies)
+        }
+
     def MP_route(self):
         """Populates the tables for Multipath
             
@@ -273,7 +411,7 @@ class Controller(object):
             for sw_name in self.topo.get_p4switches().keys()
         }
 
-        for sw_name, controller in self.controllers.items():
+        for sw_name in self.plans:
             for sw_dst in self.topo.get_p4switches():
 
                 # If the switch is the destination switch
@@ -286,8 +424,7 @@ class Controller(object):
                         host_mac = self.topo.get_host_mac(host)
 
                         # add MP table rules
-                        print "table_add at {}:".format(sw_name)
-                        self.controllers[sw_name].table_add(
+                        self.plans[sw_name].table_add(
                             "ipv4_lpm", "set_nhop", [str(host_ip)],
                             [str(host_mac), str(sw_port)])
 
@@ -324,8 +461,7 @@ class Controller(object):
                                     next_hop, sw_name)
 
                                 #add MP table rules
-                                print "table_add at {}:".format(sw_name)
-                                self.controllers[sw_name].table_add(
+                                self.plans[sw_name].table_add(
                                     "ipv4_lpm", "set_nhop", [str(host_ip)],
                                     [str(dst_sw_mac),
                                      str(sw_port)])
@@ -356,8 +492,7 @@ class Controller(object):
                                     mp_group_id = switch_mp_groups[
                                         sw_name].get(tuple(dst_macs_ports),
                                                      None)
-                                    print "table_add at {}:".format(sw_name)
-                                    self.controllers[sw_name].table_add(
+                                    self.plans[sw_name].table_add(
                                         "ipv4_lpm", "mp_group", [str(host_ip)],
                                         [
                                             str(mp_group_id),
@@ -375,17 +510,14 @@ class Controller(object):
                                     # add the new groups for multipath
                                     for i, (mac,
                                             port) in enumerate(dst_macs_ports):
-                                        print "table_add at {}:".format(
-                                            sw_name)
-                                        self.controllers[sw_name].table_add(
+                                        self.plans[sw_name].table_add(
                                             "mp_group_to_nhop", "set_nhop",
                                             [str(new_mp_group_id),
                                              str(i)],
                                             [str(mac), str(port)])
 
                                     #add forwarding rule to the table
-                                    print "table_add at {}:".format(sw_name)
-                                    self.controllers[sw_name].table_add(
+                                    self.plans[sw_name].table_add(
                                         "ipv4_lpm", "mp_group", [str(host_ip)],
                                         [
                                             str(new_mp_group_id),
@@ -494,9 +626,9 @@ class Controller(object):
             self.update_switch_linkstate(node2, port2, _state)
 
     def update_switch_linkstate(self, switch, port, state):
-        """Update the link state register on the device. This is what actually triggers the P4 code, by flipping a bit."""
-        control = self.controllers[switch]
-        control.register_write('linkState', port, state)
+        """Update the link state register on the device. This is what actually triggers the P4 code, by flipping a bit.
+        The write is skipped if the mirror shows that the bit is already set."""
+        self.register_sync[switch].push_cells([('linkState', port, int(state))])
 
     # THE LFA CONTROLLER functions
     def install_link_register(self):
@@ -512,6 +644,14 @@ class Controller(object):
                 'count': 1,
                 'status': 1
             }  #This register is updated continously by the heartbeat message
+        # Status transitions of the heartbeat_register, consumed by check_interface_and_trigger_lfa.
+        self.link_events = Queue()
+        # Recent latencies from detecting a transition to reprogramming the switches.
+        self.lfa_latencies = deque(maxlen=1000)
+        # Deadlines of all links, refreshed by every received heartbeat.
+        timings = {link: self.detection_timers[self.get_link_class(link)]
+                   for link in self.accessible_links}
+        self.detection = DetectionTimers(timings, self.declare_link_down)
         print("Registers installed")
 
     def setup_link_map(self):
@@ -580,8 +720,9 @@ class Controller(object):
 
     def dijkstra(self, failures=None):  #Imported from Exercise
         """Compute shortest paths and distances.
-        This was reused as it is already performance optimised, 
-        and the actual performance improvements are from how often this function gets called and not the function itself.
+        Instead of running all_pairs_dijkstra on a copy of the graph every time, the routing engine keeps
+        the tables and only recomputes the sources affected by links that failed or came back since the last call.
+        Thus, compute_nexthops and compute_lfas share one computation per event.
 
         Args:
             failures (list(tuple(str, str))): List of failed links.
@@ -589,20 +730,8 @@ class Controller(object):
         Returns:
             tuple(dict, dict): First dict: distances, second: paths.
         """
-        graph = self.topo.network_graph
-
-        if failures is not None:
-            graph = graph.copy()
-            for failure in failures:
-                graph.remove_edge(*failure)
-
-        # Compute the shortest paths from switches to hosts.
-        dijkstra = dict(all_pairs_dijkstra(graph, weight='weight'))
-
-        distances = {node: data[0] for node, data in dijkstra.items()}
-        paths = {node: data[1] for node, data in dijkstra.items()}
-
-        return distances, paths
+        self.routing.set_failures(failures)
+        return self.routing.distances, self.routing.paths
 
     def compute_nexthops(self, failures=None):  #Imported from Exercise
         """Compute the best nexthops for all switches to each host.
@@ -640,7 +769,7 @@ class Controller(object):
     def install_macs(self):
         """Install the port-to-mac map on all switches. Needed to send gold traffic to the calculated next hop.
         """
-        for switch, control in self.controllers.items():
+        for switch, control in self.plans.items():
             print "Installing MAC addresses for switch '%s'." % switch
             print "=========================================\n"
             for neighbor in self.topo.get_neighbors(switch):
@@ -651,7 +780,7 @@ class Controller(object):
 
     def install_nexthop_indices_LFA(self):
         """Install the mapping from prefix to nexthop ids for all switches."""
-        for switch, control in self.controllers.items():
+        for switch, control in self.plans.items():
             print "Installing nexthop indices for LFA setup '%s'." % switch
             print "===========================================\n"
             control.table_clear('dst_index')
@@ -661,24 +790,48 @@ class Controller(object):
                 control.table_add('dst_index', 'query_nextLink', [subnet],
                                   [str(index)])
 
-    def update_nexthops_LFA(self, failures=None):
+    def update_nexthops_LFA(self, failures=None, targets=None):
         """Install nexthops and LFAs in all switches. This is more general code that also allows for scenarios with multiple gold flows
         instead of just the one in the testing scenario. This calculates the shortest path for Gold and its LFAs.
         It utilises djikstras ability to account for failed links, which is critical for the high PRR we are aiming for.
         The two registers allow the P4 code to know both where the gold traffic is supposed to go,
         which allows it to check just the required One link status and then decides whether to send traffic to it or
         whether it should switch to the LFA as a backup option. 
-        This was not extended to Silver and Bronze traffic, as those rely on using multipathing to circumvent link capacity limits."""
+        This was not extended to Silver and Bronze traffic, as those rely on using multipathing to circumvent link capacity limits.
+        The register images for the failed links are taken from the failure cache if they were precomputed.
+        During bring-up, `targets` are the rule plans. Afterwards, only the cells that differ from the register mirrors are written."""
+        image = self.failure_cache.get(failures)
+        if image is None:
+            image = self.compute_register_images(failures=failures)
+            self.failure_cache.put(failures, image)
+
+        for switch, cells in image.items():
+            if targets is not None:
+                for register, index, port in cells:
+                    targets[switch].register_write(register, index, port)
+            else:
+                self.register_sync[switch].push_cells(cells)
+
+    def compute_register_images(self, failures=None):
+        """Compute the content of the primaryNH and alternativeNH registers of all switches for the given failed links.
+
+        Args:
+            failures (list(tuple(str, str))): List of failed links.
+
+        Returns:
+            dict(str, list(tuple(str, int, int))): Register name, index and port for all switches.
+        """
         nexthops = self.compute_nexthops(failures=failures)
         lfas = self.compute_lfas(nexthops, failures=failures)
 
+        images = {}
         for switch, destinations in nexthops.items():
-            control = self.controllers[switch]
+            cells = images[switch] = []
             for host, nexthop in destinations:
                 nexthop_id = self.get_nexthop_index(host)
                 port = self.get_port(switch, nexthop)
-                # Write the port in the nexthop lookup register.
-                control.register_write('primaryNH', nexthop_id, port)
+                # The port for the nexthop lookup register.
+                cells.append(('primaryNH', nexthop_id, port))
 
             for host, nexthop in destinations:
                 nexthop_id = self.get_nexthop_index(host)
@@ -690,7 +843,35 @@ class Controller(object):
                     lfa_nexthop = nexthop  # Fallback to default nh.
                 lfa_port = self.get_port(switch, lfa_nexthop)
 
-                control.register_write('alternativeNH', nexthop_id, lfa_port)
+                cells.append(('alternativeNH', nexthop_id, lfa_port))
+        return images
+
+    def start_failure_precompute(self):
+        """Fill the failure cache with the register images for every single and double failure of the accessible links.
+        Failures never partition the network, so we skip link sets that would. The worker processes are forked here,
+        before the other threads are started, and fed by a background thread so that forwarding is not delayed.
+        The cache is grown to hold all precomputed images, so that none are evicted before they are used. At most
+        MAX_PRECOMPUTED_FAILURES sets are precomputed, single failures first."""
+        failure_sets = []
+        for count in (1, 2):
+            for failures in combinations(self.accessible_links, count):
+                graph = self.topo.network_graph.copy()
+                graph.remove_edges_from(failures)
+                if is_connected(graph):
+                    failure_sets.append(list(failures))
+
+        if len(failure_sets) > self.MAX_PRECOMPUTED_FAILURES:
+            print("Warning: only precomputing {} of {} failure scenarios".format(
+                self.MAX_PRECOMPUTED_FAILURES, len(failure_sets)))
+            failure_sets = failure_sets[:self.MAX_PRECOMPUTED_FAILURES]
+        self.failure_cache.resize(len(failure_sets) + self.FAILURE_CACHE_SIZE)
+
+        pool = start_precompute(self.compute_register_images)
+        precompute = threading.Thread(target=precompute_images,
+                                      args=(pool, failure_sets, self.failure_cache))
+        precompute.daemon = True
+        precompute.start()
+        print("Precomputing nexthops for {} failure scenarios".format(len(failure_sets)))
 
     def compute_lfas(self, nexthops, failures=None):
         """Compute LFA (loop-free alternates) for all nexthops. Reused the Exercise solution code to reduce sources of failure,
@@ -730,6 +911,18 @@ class Controller(object):
                     switch_lfas[host] = min(noloop, key=lambda x: x[1])[0]
         return lfas
 
+    def start_flowlet_telemetry(self):
+        """Poll the flowlet registers of all switches in the background.
+        The poller uses its own Thrift connections, so it never blocks the LFA updates."""
+        connections = {}
+        for switch in self.controllers:
+            connections[switch] = SimpleSwitchAPI(
+                self.topo.get_thrift_port(switch), self.topo.get_thrift_ip(switch))
+        self.flowlet_telemetry = FlowletTelemetry(connections, **self.telemetry_options)
+        telemetry = threading.Thread(target=self.flowlet_telemetry.run)
+        telemetry.daemon = True
+        telemetry.start()
+
     def add_mirrors(self):
         """Add mirrors in the data plane to forward packets to the controllers.
         """
@@ -737,7 +930,7 @@ class Controller(object):
         base_session_id = 100
         for switch in self.topo.get_p4switches().keys():
             cpu_port = self.topo.get_cpu_port_index(switch)
-            self.controllers[switch].mirroring_add(base_session_id, cpu_port)
+            self.plans[switch].mirroring_add(base_session_id, cpu_port)
 
     def update_heartbeat_register(self, pkt):
         """Update the heartbeat register according to incoming packets.
@@ -745,20 +938,20 @@ class Controller(object):
         :param pkt: an incoming bfd packet
         :type pkt: bfd control packet
         """
+        self.record_heartbeat(pkt[IP].src, pkt[IP].dst, pkt[BFD].flags)
 
-        try:
-            # extract src and dst ip addresses
-            src_address = pkt[IP].src
-            dst_address = pkt[IP].dst
+    def record_heartbeat(self, src_address, dst_address, flags):
+        """Update the heartbeat register with the fields of an incoming BFD packet.
+        The capture backends call this directly, so no scapy packet has to be built.
+        """
 
+        try:
             # check whether a packet is a switch-switch packet and
             # it's flag value is 32. if so, we know this packet hasn't
             # been processed by the switch yet. the switch would have changed the flag value to 1
             # before cloning it to the controller. this way we prevent "self-sniffing", meaning
             # assuming a link is up when it is actually not.
-            if (src_address == '9.0.0.6' and pkt[BFD].flags == 32):
-                raise KeyError
-            elif (src_address == '9.0.0.4' and pkt[BFD].flags == 32):
+            if (src_address in self.heartbeat_sources and flags == 32):
                 raise KeyError
 
             # convert addresses to names to insert into the heartbeat_register.
@@ -766,15 +959,19 @@ class Controller(object):
             src_node = self.ip_lookup_table[src_address]
             dst_node = self.ip_lookup_table[dst_address]
 
-            try:
-                # increase the counter, meaning we sniffed one packet on the given link
-                self.heartbeat_register[(src_node, dst_node)]['count'] += 1
-                # and set the link state to up
-                self.heartbeat_register[(src_node, dst_node)]['status'] = 1
-            except KeyError as e:
+            link = (src_node, dst_node)
+            if link not in self.heartbeat_register:
                 # if the key is the other way around
-                self.heartbeat_register[(dst_node, src_node)]['count'] += 1
-                self.heartbeat_register[(dst_node, src_node)]['status'] = 1
+                link = (dst_node, src_node)
+            entry = self.heartbeat_register[link]
+
+            # increase the counter, meaning we sniffed one packet on the given link
+            entry['count'] += 1
+            self.detection.refresh(link)
+            # and set the link state to up, notifying the LFA thread if it was down
+            if entry['status'] == 0:
+                entry['status'] = 1
+                self.notify_link_event(link)
         except KeyError as e:
             pass
 
@@ -789,13 +986,10 @@ class Controller(object):
                 for switch in self.topo.get_p4switches().keys()
             ]
 
-            # sniff on all cpu port interfaces for bfd packets
-            # and invoke the update_heartbeat_register function on each packet
-            sniff(
-                iface=cpu_port_interfaces,
-                prn=self.update_heartbeat_register,
-                lfilter=lambda x: x.haslayer(BFD),
-            )
+            # capture bfd packets on all cpu port interfaces
+            # and invoke the record_heartbeat function on each packet
+            capture_bfd(cpu_port_interfaces, self.record_heartbeat,
+                        backend=self.capture_backend)
         except (KeyboardInterrupt, SystemExit):
             print("Exiting...")
 
@@ -803,71 +997,56 @@ class Controller(object):
         """Send hearbeats between switch to switch links.
         Because we are alreay sniffing for BFD packets anyways, for simplicity
         we decided to make these packets BFD packets too.
+        The frames are built once and sent every switch-switch detection interval over persistent raw sockets.
         """
 
-        while (True):
-            try:
-                # get the source and destination mac/ip adresses
-                src_mac = self.topo.node_to_node_mac('S6', 'S1')
-                dst_mac = self.topo.node_to_node_mac('S1', 'S6')
-
-                # send heartbeat between S6-S1
-                # this is a BFD control packet
-                sendp(
-                    Ether(dst=dst_mac, src=src_mac, type=2048) /
-                    IP(version=4,
-                       tos=192,
-                       dst='9.0.0.1',
-                       proto=17,
-                       src='9.0.0.6') / UDP(sport=49156, dport=3784, len=32)
-                    /  # udp addresses should be unique
-                    BFD(version=1,
-                        diag=0,
-                        your_discriminator=0,
-                        flags=32,
-                        my_discriminator=15,
-                        echo_rx_interval=50000,
-                        len=24,
-                        detect_mult=3,
-                        min_tx_interval=250000,
-                        min_rx_interval=250000,
-                        sta=1),
-                    iface='1-S6-cpu',
-                    verbose=False)
+        try:
+            self.heartbeat.run()
+        except (KeyboardInterrupt, SystemExit):
+            print("Exiting...")
 
-                # get the source and destination mac/ip adresses
-                src_mac = self.topo.node_to_node_mac('S4', 'S3')
-                dst_mac = self.topo.node_to_node_mac('S3', 'S4')
-
-                # send heartbeat between S4-S3
-                # this is a BFD control packet
-                sendp(
-                    Ether(dst=dst_mac, src=src_mac, type=2048) /
-                    IP(version=4,
-                       tos=192,
-                       dst='9.0.0.3',
-                       proto=17,
-                       src='9.0.0.4') / UDP(sport=49155, dport=3784, len=32)
-                    /  # udp addresses should be unique
-                    BFD(version=1,
-                        diag=0,
-                        your_discriminator=0,
-                        flags=32,
-                        my_discriminator=14,
-                        echo_rx_interval=50000,
-                        len=24,
-                        detect_mult=3,
-                        min_tx_interval=250000,
-                        min_rx_interval=250000,
-                        sta=1),
-                    iface='1-S4-cpu',
-                    verbose=False)
-
-                # send the heartbeat packets every 0.1 seconds
-                time.sleep(0.1)
-            except (KeyboardInterrupt, SystemExit):
-                print("Exiting...")
-                break
+    def setup_heartbeats(self):
+        """Build the heartbeat frames for all switch-switch links in the topology.
+        For each link, the switch with the larger name sends a BFD control packet from its CPU port
+        to the other switch. Their source addresses are stored in self.heartbeat_sources,
+        so we can ignore the packets we sniff before they traversed the link."""
+        switch_ips = {node: ip for ip, node in self.ip_lookup_table.items()
+                      if node in self.topo.get_p4switches()}
+        switch_links = sorted(tuple(sorted(link)) for link in self.accessible_links
+                              if self.get_link_class(link) == 'switch-switch')
+
+        frames = []
+        self.heartbeat_sources = set()
+        for index, (dst_switch, src_switch) in enumerate(switch_links):
+            # get the source and destination mac/ip adresses
+            src_mac = self.topo.node_to_node_mac(src_switch, dst_switch)
+            dst_mac = self.topo.node_to_node_mac(dst_switch, src_switch)
+
+            # this is a BFD control packet
+            frame = Ether(dst=dst_mac, src=src_mac, type=2048) / IP(
+                version=4,
+                tos=192,
+                dst=switch_ips[dst_switch],
+                proto=17,
+                src=switch_ips[src_switch]) / UDP(
+                    sport=49152 + index, dport=3784, len=32
+                ) / BFD(  # udp addresses should be unique
+                    version=1,
+                    diag=0,
+                    your_discriminator=0,
+                    flags=32,
+                    my_discriminator=index + 1,
+                    echo_rx_interval=50000,
+                    len=24,
+                    detect_mult=3,
+                    min_tx_interval=250000,
+                    min_rx_interval=250000,
+                    sta=1)
+            frames.append((self.topo.get_cpu_port_intf(src_switch), bytes(frame)))
+            self.heartbeat_sources.add(switch_ips[src_switch])
+
+        interval = self.detection_timers['switch-switch'][0]
+        self.heartbeat = HeartbeatTransmitter(frames, interval)
 
     def populate_ip_lookup_table(self):
         """Populates a table that maps IP addresses to names.
@@ -895,34 +1074,33 @@ class Controller(object):
         }
 
     def check_link_status(self):
-        """Checks the status of each link. If there hasn't been received a packet in 1.5 seconds, consider the link as down.
-        Unfortunately due to scapy's limitations in sniffing on multiple interfaces at the same time, we can't further lower
-        this value. Scapy seems to be only capable of sniffing around 2 packets per second on each interface. With some
-        packets being dropped due to high load on a link, we consider the current value a good practice after quite some testing.
+        """Checks the status of each link. Like in BFD, every link has its own deadline of interval * multiplier
+        (see DETECTION_TIMERS), which is moved forward by every heartbeat received on it. If the deadline expires,
+        the link is considered down. Setting the status to 1 if its up again happens immediately in record_heartbeat.
         """
 
-        while (True):
+        try:
+            self.detection.run()
+        except (KeyboardInterrupt, SystemExit):
+            print("Exiting...")
 
-            try:
-                # check for every link
-                # if we sniffed a bfd packet
-                for link in self.heartbeat_register:
-                    # if not, set the link status to 0
-                    # setting the status to 1 if its up again happens
-                    # immediately in update_heartbeat_register after we received a packet
-                    if self.heartbeat_register[link]['count'] == 0:
-                        print("link {} failed".format(link))
-                        self.heartbeat_register[link]['status'] = 0
-                    # if so, reset the count to 0 for the next epoch
-                    else:
-                        self.heartbeat_register[link]['count'] = 0
-
-                # wait 1.5 seconds before checking again as the heartbeat is currently sent every 100ms
-                #  (controller cant handle more packets )
-                time.sleep(1.5)
-            except (KeyboardInterrupt, SystemExit):
-                print("Exiting...")
-                break
+    def declare_link_down(self, link):
+        """Called by the detection timers if no heartbeat arrived on a link in time."""
+        if self.heartbeat_register[link]['status'] == 1:
+            print("link {} failed".format(link))
+            self.heartbeat_register[link]['status'] = 0
+            self.notify_link_event(link)
+
+    def get_link_class(self, link):
+        """Returns the class of a link for the detection timers."""
+        switches = self.topo.get_switches()
+        if link[0] in switches and link[1] in switches:
+            return 'switch-switch'
+        return 'switch-router'
+
+    def get_detection_histograms(self):
+        """Returns the histogram of detection latencies (last heartbeat to declared down) for each link."""
+        return self.detection.get_histograms()
 
     def init_bfd(self):
         """Answer to BFD control packets so that the routers send their control packets
@@ -1008,6 +1186,43 @@ if __name__ == "__main__":
                         type=str,
                         required=False,
                         default=None)
+    parser.add_argument('--reconcile',
+                        help='Keep the switch state and only apply changes.',
+                        action='store_true')
+    parser.add_argument('--capture',
+                        help='Backend to capture BFD packets.',
+                        choices=BACKENDS,
+                        required=False,
+                        default='raw')
+    parser.add_argument('--flowlet-telemetry',
+                        help='Poll the flowlet registers every given seconds (0 disables).',
+                        type=float,
+                        required=False,
+                        default=0)
+    parser.add_argument('--flowlet-range',
+                        help='Flowlet register indices to evaluate, as start:end.',
+                        type=str,
+                        required=False,
+                        default="0:%d" % REGISTER_SIZE)
+    parser.add_argument('--telemetry-out',
+                        help='File to dump the flowlet telemetry to (.npz).',
+                        type=str,
+                        required=False,
+                        default=None)
+    parser.add_argument('--detection-timer',
+                        help='Heartbeat interval in seconds and detect multiplier of a link class, '
+                             'as class=interval:multiplier (e.g. switch-switch=0.05:3). Can be repeated.',
+                        type=parse_detection_timer,
+                        action='append',
+                        required=False,
+                        default=[])
     args = parser.parse_args()
 
-    control = Controller(args.topo, args.traffic)
+    telemetry = None
+    if args.flowlet_telemetry > 0:
+        start, end = [int(index) for index in args.flowlet_range.split(":")]
+        telemetry = {'interval': args.flowlet_telemetry, 'start': start,
+                     'end': end, 'out_file': args.telemetry_out}
+
+    control = Controller(args.topo, args.traffic, args.reconcile, args.capture,
+                         telemetry, dict(args.detection_timer))
@@ -0,0 +1,125 @@
+"""Per-link failure detection, modelled on the BFD detection time.
+
+Every link has a heartbeat interval and a detect multiplier. Each received
+heartbeat moves the deadline of its link to `now + interval * multiplier`.
+If the deadline passes without a heartbeat, the link is declared down.
+
+Deadlines are kept in a heap. Refreshing a deadline only updates a dict; stale
+heap entries are re-scheduled lazily when they are popped. Thus, the cost per
+received packet is constant and the detection thread only wakes up when the
+earliest deadline expires. Deadlines and latencies use a monotonic clock, so
+a wall clock step cannot declare links down or distort the histograms.
+"""
+import heapq
+import threading
+
+from clock import monotonic
+
+# Upper bounds of the detection latency histogram buckets, in seconds.
+HISTOGRAM_BUCKETS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5,
+                     2.0, 3.0, 5.0, float('inf')]
+
+
+class LatencyHistogram(object):
+    """Fixed-bucket histogram of detection latencies."""
+
+    def __init__(self):
+        self.counts = [0] * len(HISTOGRAM_BUCKETS)
+        self.total = 0.0
+        self.samples = 0
+        self.max = 0.0
+
+    def record(self, latency):
+        for index, bound in enumerate(HISTOGRAM_BUCKETS):
+            if latency <= bound:
+                self.counts[index] += 1
+                break
+        self.total += latency
+        self.samples += 1
+        self.max = max(self.max, latency)
+
+    def summary(self):
+        """Return sample count, mean, max and the non-empty buckets."""
+        return {
+            'samples': self.samples,
+            'mean': self.total / self.samples if self.samples else None,
+            'max': self.max if self.samples else None,
+            'buckets': [(bound, count) for bound, count
+                        in zip(HISTOGRAM_BUCKETS, self.counts) if count],
+        }
+
+
+class DetectionTimers(object):
+    """Deadlines for all monitored links.
+
+    Args:
+        timings (dict(tuple(str, str), tuple(float, int))): Heartbeat interval
+            in seconds and detect multiplier of each link.
+        on_down (callable): Called with the link when it is declared down.
+    """
+
+    def __init__(self, timings, on_down):
+        self.timings = timings
+        self.on_down = on_down
+        self.deadlines = {}
+        self.last_seen = {}
+        self.histograms = {link: LatencyHistogram() for link in timings}
+        self._heap = []
+        self._condition = threading.Condition()
+
+    def detection_time(self, link):
+        interval, multiplier = self.timings[link]
+        return interval * multiplier
+
+    def refresh(self, link):
+        """Called for every heartbeat received on a link."""
+        now = monotonic()
+        deadline = now + self.detection_time(link)
+        with self._condition:
+            self.last_seen[link] = now
+            if link not in self.deadlines:
+                # The link was down (or is not armed yet), schedule it again.
+                heapq.heappush(self._heap, (deadline, link))
+                self._condition.notify()
+            self.deadlines[link] = deadline
+
+    def run(self):
+        """Declare links down when their deadline expires. Blocks forever.
+
+        Every armed link has exactly one heap entry, which is never later
+        than its actual deadline.
+        """
+        now = monotonic()
+        with self._condition:
+            self._heap = []
+            for link in self.timings:
+                self.last_seen.setdefault(link, now)
+                self.deadlines[link] = now + self.detection_time(link)
+                heapq.heappush(self._heap, (self.deadlines[link], link))
+
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                scheduled, link = self._heap[0]
+                now = monotonic()
+                if scheduled > now:
+                    self._condition.wait(scheduled - now)
+                    continue
+
+                heapq.heappop(self._heap)
+                deadline = self.deadlines[link]
+                if deadline > now:
+                    # Refreshed since this entry was scheduled.
+                    heapq.heappush(self._heap, (deadline, link))
+                    continue
+
+                del self.deadlines[link]
+                self.histograms[link].record(now - self.last_seen[link])
+                self.on_down(link)
+
+    def get_histograms(self):
+        """Return the detection latency summary of each link."""
+        with self._condition:
+            return {link: histogram.summary()
+                    for link, histogram in self.histograms.items()}
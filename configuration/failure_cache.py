@@ -0,0 +1,108 @@
+"""Precomputed nexthop register images for failure scenarios.
+
+Failure scenarios only fail a few links at the same time. For the most likely
+scenarios, we compute the primaryNH/alternativeNH register images at startup,
+so that reacting to a failure only requires a lookup and a register push.
+"""
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
+
+
+def failure_key(failures):
+    """Key of a set of failed links, independent of order and link direction."""
+    return frozenset(frozenset(link) for link in failures or [])
+
+
+class FailureImageCache(object):
+    """Thread-safe LRU cache of register images, keyed by `failure_key`."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._images)
+
+    def get(self, failures):
+        """Return the image for the failed links, or None if not cached."""
+        key = failure_key(failures)
+        with self._lock:
+            image = self._images.pop(key, None)
+            if image is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Re-insert to mark as most recently used.
+            self._images[key] = image
+            return image
+
+    def resize(self, maxsize):
+        """Change the number of cached images, evicting the oldest images."""
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def put(self, failures, image):
+        """Store the image for the failed links, evicting the oldest image."""
+        key = failure_key(failures)
+        with self._lock:
+            self._images.pop(key, None)
+            self._images[key] = image
+            self._evict()
+
+    def _evict(self):
+        while len(self._images) > self.maxsize:
+            self._images.popitem(last=False)
+
+
+# Parallel precomputation.
+# ========================
+# Pool workers are forked, so they inherit the image function from the
+# parent. Only the failed links are sent to the workers.
+
+_image_function = None
+
+
+def _compute_image(failures):
+    return failures, _image_function(failures)
+
+
+def start_precompute(image_function, processes=None):
+    """Fork the worker pool for `precompute_images`.
+
+    Call this before starting other threads, as forking a process while
+    other threads hold locks (e.g. for stdout) may deadlock the workers.
+
+    Args:
+        image_function (callable): Maps a list of failed links to an image.
+        processes (int): Number of workers, defaults to the number of CPUs.
+
+    Returns:
+        multiprocessing.Pool: The worker pool.
+    """
+    global _image_function
+    _image_function = image_function
+    return Pool(processes)
+
+
+def precompute_images(pool, failure_sets, cache):
+    """Compute the images for all failure sets and store them in the cache.
+
+    The pool is closed afterwards.
+
+    Args:
+        pool (multiprocessing.Pool): Pool returned by `start_precompute`.
+        failure_sets (list(list(tuple(str, str)))): Failed links per image.
+        cache (FailureImageCache): Cache to fill.
+    """
+    try:
+        for failures, image in pool.imap_unordered(_compute_image,
+                                                   failure_sets):
+            cache.put(failures, image)
+    finally:
+        pool.close()
+        pool.join()
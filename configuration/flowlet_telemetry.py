@@ -0,0 +1,130 @@
+"""Telemetry for the flowlet registers of the switches.
+
+`switch.p4` hashes every packet to a bucket of the `flowlet_to_id` and
+`flowlet_time_stamp` registers. A new flowlet id is drawn for a bucket if
+its last packet is older than the flowlet timeout. By reading both registers
+periodically, we can see how traffic is spread over the buckets:
+
+- occupied: buckets that have seen any packet.
+- active: buckets with a packet within the flowlet timeout of the newest one.
+- churn: buckets whose flowlet id changed since the previous snapshot, per
+  second (a lower bound of new flowlets per second).
+
+Samples are stored in a fixed-size ring buffer per switch and can be dumped
+to a `.npz` file for offline analysis.
+"""
+from __future__ import print_function
+
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from register_sync import read_cells
+from ring_buffer import RingBuffer  # utils/, on the path of controller.py
+
+REGISTER_SIZE = 8192
+# The flowlet timeout is read from the #define of the P4 program.
+P4_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'p4switches', 'switch.p4')
+
+SAMPLE_DTYPE = np.dtype([('time', 'f8'), ('active', 'u4'),
+                         ('occupied', 'u4'), ('churn', 'f4')])
+
+
+def read_p4_define(name, p4_source=P4_SOURCE):
+    """Value of a numeric `#define` of a P4 program, e.g. `48w200000`."""
+    with open(p4_source) as source:
+        for line in source:
+            match = re.match(r'\s*#define\s+%s\s+(?:\d+w)?(\d+)\b' % name, line)
+            if match:
+                return int(match.group(1))
+    raise ValueError("No #define %s in %s" % (name, p4_source))
+
+
+class FlowletTelemetry(object):
+    """Poll the flowlet registers of all switches.
+
+    Args:
+        connections (dict(str, SimpleSwitchAPI)): Dedicated connections to
+            the switches, so that polling never blocks the LFA updates.
+        interval (float): Seconds between two polls of all switches.
+        start (int): First register index to evaluate.
+        end (int): Register index after the last one to evaluate.
+        capacity (int): Number of samples kept per switch.
+        out_file (str): If given, the samples are dumped to this file
+            every `dump_every` polls.
+        dump_every (int): Polls between two dumps.
+        flowlet_timeout (int): Flowlet timeout in microseconds (switch
+            timestamps), read from `FLOWLET_TIMEOUT` of switch.p4 if not given.
+    """
+
+    def __init__(self, connections, interval=1.0, start=0, end=REGISTER_SIZE,
+                 capacity=3600, out_file=None, dump_every=10,
+                 flowlet_timeout=None):
+        self.connections = connections
+        self.interval = interval
+        self.start = start
+        self.end = end
+        self.out_file = out_file
+        self.dump_every = dump_every
+        if flowlet_timeout is None:
+            flowlet_timeout = read_p4_define('FLOWLET_TIMEOUT')
+        self.flowlet_timeout = flowlet_timeout
+        self.series = {switch: RingBuffer(capacity, SAMPLE_DTYPE)
+                       for switch in connections}
+        self._previous = {}
+        self._lock = threading.Lock()
+
+    def poll(self, switch):
+        """Read the flowlet registers of one switch and store a sample."""
+        api = self.connections[switch]
+        indices = range(self.start, self.end)
+        ids = np.array(read_cells(api, 'flowlet_to_id', indices),
+                       dtype=np.uint32)
+        stamps = np.array(read_cells(api, 'flowlet_time_stamp', indices),
+                          dtype=np.uint64)
+        now = time.time()
+
+        used = stamps > 0
+        occupied = np.count_nonzero(used)
+        active = 0
+        if occupied:
+            newest = stamps.max()
+            threshold = newest - min(newest, self.flowlet_timeout)
+            active = np.count_nonzero(used & (stamps >= threshold))
+
+        churn = 0.0
+        previous = self._previous.get(switch)
+        if previous is not None and now > previous[0]:
+            churn = np.count_nonzero(ids != previous[1]) / (now - previous[0])
+        self._previous[switch] = (now, ids)
+
+        with self._lock:
+            self.series[switch].append((now, active, occupied, churn))
+
+    def run(self):
+        """Poll all switches every interval. Blocks forever."""
+        polls = 0
+        while True:
+            started = time.time()
+            for switch in self.connections:
+                self.poll(switch)
+            polls += 1
+            if self.out_file and polls % self.dump_every == 0:
+                self.dump(self.out_file)
+            time.sleep(max(0, self.interval - (time.time() - started)))
+
+    def get_samples(self, switch):
+        """Return the samples of a switch as structured array, oldest first."""
+        with self._lock:
+            return self.series[switch].samples()
+
+    def dump(self, out_file):
+        """Write the samples of all switches to a compressed `.npz` file."""
+        with self._lock:
+            samples = {str(switch): series.samples()
+                       for switch, series in self.series.items()}
+        np.savez_compressed(out_file, **samples)
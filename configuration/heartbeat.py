@@ -0,0 +1,60 @@
+"""Send prebuilt heartbeat frames between switches.
+
+Every heartbeat frame is serialized once. The transmitter keeps one raw socket
+per CPU interface open and sends all frames on a fixed schedule based on a
+monotonic clock, so that even short heartbeat intervals are cheap.
+"""
+import socket
+import time
+
+from clock import monotonic
+
+
+class HeartbeatTransmitter(object):
+    """Periodically send a fixed set of frames.
+
+    Args:
+        frames (list(tuple(str, bytes))): Interface and frame to send on it.
+        interval (float): Time between two heartbeats in seconds.
+    """
+
+    def __init__(self, frames, interval):
+        self.interval = interval
+        self.frames = []
+        self.sockets = {}
+        for interface, frame in frames:
+            if interface not in self.sockets:
+                sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+                sock.bind((interface, 0))
+                self.sockets[interface] = sock
+            self.frames.append((self.sockets[interface], frame))
+        # Number of intervals we could not keep up with.
+        self.missed = 0
+
+    def send_all(self):
+        for sock, frame in self.frames:
+            sock.send(frame)
+
+    def run(self):
+        """Send all frames every interval. Blocks forever.
+
+        Sending times are computed from the start time, so errors do not
+        accumulate. If we fall behind, we skip the missed intervals instead
+        of sending a burst of heartbeats.
+        """
+        next_send = monotonic()
+        while True:
+            self.send_all()
+            next_send += self.interval
+            now = monotonic()
+            if next_send < now:
+                skipped = int((now - next_send) / self.interval) + 1
+                self.missed += skipped
+                next_send += skipped * self.interval
+            time.sleep(next_send - now)
+
+    def close(self):
+        for sock in self.sockets.values():
+            sock.close()
+        self.sockets = {}
+        self.frames = []
@@ -0,0 +1,171 @@
+"""Reconcile the state of a running switch with a rule plan.
+
+Instead of resetting a switch and installing everything from scratch, we read
+the entries of the tables managed by the controller and the register cells
+written by the plan, compare them to what the plan would install, and only
+write the difference. This way, a controller restart does not interrupt
+forwarding.
+"""
+import binascii
+
+from p4utils.utils.runtime_API import ResType
+
+from register_sync import read_cells
+
+# Tables whose content is fully owned by the controller.
+MANAGED_TABLES = ['ipv4_lpm', 'mp_group_to_nhop', 'l2_forward', 'rewrite_mac',
+                  'dst_index']
+
+
+# Normalization helpers.
+# ======================
+# Planned entries use the CLI notation (strings such as MACs, prefixes and
+# numbers), while the switch returns raw bytes. We compare both as integers.
+
+def _short_name(name):
+    """Strip the control block prefix, e.g. `MyIngress.set_nhop`."""
+    return name.split('.')[-1]
+
+
+def _to_int(value):
+    """Convert a MAC, IPv4 address or number in CLI notation to an int."""
+    value = str(value)
+    if ':' in value:
+        return int(value.replace(':', ''), 16)
+    if '.' in value:
+        result = 0
+        for byte in value.split('.'):
+            result = (result << 8) + int(byte)
+        return result
+    return int(value, 0)
+
+
+def _bytes_to_int(data):
+    return int(binascii.hexlify(data), 16) if data else 0
+
+
+def _lpm(value, prefix_length, width):
+    """LPM keys only match on the prefix, so we ignore the host bits."""
+    mask = ((1 << width) - 1) ^ ((1 << (width - prefix_length)) - 1)
+    return (value & mask, prefix_length)
+
+
+def _planned_key(match_keys):
+    key = []
+    for field in match_keys:
+        if '/' in str(field):
+            address, prefix_length = str(field).split('/')
+            key.append(_lpm(_to_int(address), int(prefix_length), 32))
+        else:
+            key.append(_to_int(field))
+    return tuple(key)
+
+
+def _installed_key(match_key):
+    key = []
+    for param in match_key:
+        if param.lpm is not None:
+            key.append(_lpm(_bytes_to_int(param.lpm.key),
+                            param.lpm.prefix_length, 8 * len(param.lpm.key)))
+        else:
+            key.append(_bytes_to_int(param.exact.key))
+    return tuple(key)
+
+
+# Reading the switch state.
+# =========================
+
+def read_table(controller, table_name):
+    """Read all entries of a table.
+
+    Returns:
+        dict(tuple, tuple(int, str, tuple)): Mapping from the normalized
+            match key to entry handle, action name and action parameters.
+    """
+    table = controller.get_res("table", table_name, ResType.table)
+    entries = {}
+    for entry in controller.client.bm_mt_get_entries(0, table.name):
+        action = entry.action_entry
+        entries[_installed_key(entry.match_key)] = (
+            entry.entry_handle, _short_name(action.action_name),
+            tuple(_bytes_to_int(data) for data in action.action_data))
+    return entries
+
+
+def planned_state(plan):
+    """Split a plan into table entries and register values.
+
+    Returns:
+        tuple(dict, dict): Table entries per managed table, as mapping from
+            normalized match key to (action, match_keys, action_params), and
+            written register cells as mapping from register to {index: value}.
+    """
+    tables = {table: {} for table in MANAGED_TABLES}
+    registers = {}
+    for method, args in plan.operations:
+        if method == 'table_add' and args[0] in tables:
+            table, action, match_keys, action_params, _ = args
+            tables[table].setdefault(_planned_key(match_keys),
+                                     (action, match_keys, action_params))
+        elif method == 'register_write':
+            register, index, value = args
+            registers.setdefault(register, {})[index] = int(value)
+    return tables, registers
+
+
+# Reconciliation.
+# ===============
+
+def reconcile_plan(controller, plan):
+    """Bring a switch to the state described by a plan with minimal writes.
+
+    A switch without any entries in the managed tables was just started, so
+    we simply install the full plan. Otherwise, only table entries that are
+    missing, different, or not part of the plan are added, modified or
+    deleted. Only the register cells written by the plan are read and
+    rewritten if they differ. All other cells, such as the `linkState` bits
+    of links that are down, keep their runtime state. Mirrors and multicast
+    groups of a running switch are kept as they are.
+
+    Args:
+        controller (SimpleSwitchAPI): Connection to the switch.
+        plan (RulePlan): Desired state of the switch.
+
+    Returns:
+        int: Number of writes issued to the switch.
+    """
+    installed = {table: read_table(controller, table)
+                 for table in MANAGED_TABLES}
+    if not any(installed.values()):
+        plan.apply(controller)
+        return len(plan)
+
+    writes = 0
+    tables, registers = planned_state(plan)
+    for table in MANAGED_TABLES:
+        planned = tables[table]
+        for key, (handle, _, _) in installed[table].items():
+            if key not in planned:
+                controller.table_delete(table, handle)
+                writes += 1
+
+        for key, (action, match_keys, action_params) in planned.items():
+            current = installed[table].get(key)
+            if current is None:
+                controller.table_add(table, action, match_keys, action_params)
+                writes += 1
+            elif current[1:] != (action, tuple(_to_int(param)
+                                               for param in action_params)):
+                controller.table_modify(table, action, current[0],
+                                        action_params)
+                writes += 1
+
+    for register, cells in registers.items():
+        indices = sorted(cells)
+        current = read_cells(controller, register, indices)
+        for index, value in zip(indices, current):
+            if value != cells[index]:
+                controller.register_write(register, index, cells[index])
+                writes += 1
+
+    return writes
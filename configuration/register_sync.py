@@ -0,0 +1,121 @@
+"""Keep registers of a switch in sync with a NumPy mirror.
+
+The mirror holds the values we believe are on the switch. To update a
+register, we compute the desired array, compare it with the mirror in one
+vectorized operation, and only write the cells that changed. Consecutive
+cells with the same new value are written with a single range write.
+"""
+import numpy as np
+
+# Up to this many cells are read with one call per cell, more cells with one
+# read of the whole register.
+MAX_CELL_READS = 64
+
+
+def _runs(indices, values):
+    """Split sorted indices into runs of consecutive indices with equal values.
+
+    Returns:
+        list(tuple(int, int, int)): First index, last index and value.
+    """
+    if not len(indices):
+        return []
+    run_values = values[indices]
+    breaks = np.flatnonzero((np.diff(indices) != 1) |
+                            (np.diff(run_values) != 0)) + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(indices)])) - 1
+    return [(int(indices[start]), int(indices[end]), int(run_values[start]))
+            for start, end in zip(starts, ends)]
+
+
+def read_cells(controller, register, indices, max_cell_reads=MAX_CELL_READS):
+    """Read some cells of a register.
+
+    Returns:
+        list(int): Values of the cells, in the order of `indices`.
+    """
+    indices = list(indices)
+    if len(indices) <= max_cell_reads:
+        return [controller.register_read(register, index) for index in indices]
+    values = controller.register_read(register)
+    return [values[index] for index in indices]
+
+
+class RegisterSync(object):
+    """Mirror of some registers of one switch.
+
+    Args:
+        controller (SimpleSwitchAPI): Connection to the switch.
+        registers (list(str)): Registers to mirror. Their current content is
+            read from the switch to initialize the mirror.
+    """
+
+    def __init__(self, controller, registers):
+        self.controller = controller
+        self.mirrors = {register: self.read(register)
+                        for register in registers}
+        # Number of Thrift write calls issued.
+        self.writes = 0
+
+    def read(self, register):
+        """Read a whole register from the switch with one call."""
+        return np.array(self.controller.register_read(register),
+                        dtype=np.int64)
+
+    def push(self, register, target):
+        """Write the cells of `target` that differ from the mirror.
+
+        Args:
+            register (str): Register name.
+            target (numpy.ndarray): Desired content of the whole register.
+
+        Returns:
+            int: Number of write calls.
+        """
+        mirror = self.mirrors[register]
+        changed = np.flatnonzero(target != mirror)
+        calls = 0
+        for first, last, value in _runs(changed, target):
+            if first == last:
+                self.controller.register_write(register, first, value)
+            else:
+                # Range writes are exclusive of the end index.
+                self.controller.register_write(register, [first, last + 1],
+                                               value)
+            calls += 1
+        mirror[changed] = target[changed]
+        self.writes += calls
+        return calls
+
+    def push_cells(self, cells):
+        """Update single cells, skipping cells that already hold the value.
+
+        Args:
+            cells (list(tuple(str, int, int))): Register, index and value.
+
+        Returns:
+            int: Number of write calls.
+        """
+        targets = {}
+        for register, index, value in cells:
+            if register not in targets:
+                targets[register] = self.mirrors[register].copy()
+            targets[register][index] = value
+        return sum(self.push(register, target)
+                   for register, target in targets.items())
+
+    def verify(self, registers=None):
+        """Read registers from the switch and compare them with the mirror.
+
+        Returns:
+            dict(str, numpy.ndarray): Indices that differ, per register with
+                differences.
+        """
+        mismatches = {}
+        for register in registers or self.mirrors:
+            differ = np.flatnonzero(self.read(register) !=
+                                    self.mirrors[register])
+            if len(differ):
+                mismatches[register] = differ
+        return mismatches
@@ -0,0 +1,110 @@
+"""Shortest paths that are updated incrementally on link events.
+
+The LFA code needs the distances and paths between all pairs of nodes, with
+the currently failed links removed. Running all_pairs_dijkstra on a fresh copy
+of the graph for every event is wasteful, since a single link only affects
+the shortest-path trees of few sources. `RoutingEngine` keeps the tables and
+only recomputes the sources that are affected by an event (dynamic SPF).
+"""
+from networkx.algorithms import all_pairs_dijkstra, single_source_dijkstra
+
+
+class RoutingEngine(object):
+    """All-pairs shortest distances and paths for a graph with failed links.
+
+    - If a link fails, a source is affected only if the link is part of its
+      shortest-path tree.
+    - If a link comes back, a source is affected only if the link offers a
+      path that is at least as short as its current shortest path.
+
+    Only affected sources are recomputed with a single-source Dijkstra.
+    """
+
+    def __init__(self, graph, weight='weight'):
+        self.graph = graph.copy()
+        self.weight = weight
+        # Failed links: frozenset(link) -> (link, edge attributes).
+        self.failed = {}
+        # Number of single-source computations since the initial computation.
+        self.recomputed = 0
+
+        results = dict(all_pairs_dijkstra(self.graph, weight=weight))
+        self.distances = {node: data[0] for node, data in results.items()}
+        self.paths = {node: data[1] for node, data in results.items()}
+
+    def set_failures(self, failures):
+        """Update the tables so that exactly `failures` are failed.
+
+        Args:
+            failures (list(tuple(str, str))): List of failed links.
+
+        Returns:
+            set(str): Sources whose distances and paths were recomputed.
+        """
+        target = {frozenset(link): link for link in failures or []}
+        changed = set()
+        for key in list(self.failed):
+            if key not in target:
+                changed |= self.link_up(self.failed[key][0])
+        for key, link in target.items():
+            if key not in self.failed:
+                changed |= self.link_down(link)
+        return changed
+
+    def link_down(self, link):
+        """Remove a link and recompute the sources that used it."""
+        node1, node2 = link
+        key = frozenset(link)
+        if key in self.failed or not self.graph.has_edge(node1, node2):
+            return set()
+
+        self.failed[key] = (link, dict(self.graph[node1][node2]))
+        self.graph.remove_edge(node1, node2)
+
+        affected = [source for source, paths in self.paths.items()
+                    if self._uses_link(paths, node1, node2)]
+        return self._recompute(affected)
+
+    def link_up(self, link):
+        """Restore a failed link and recompute the sources it may shorten."""
+        key = frozenset(link)
+        if key not in self.failed:
+            return set()
+
+        (node1, node2), attributes = self.failed.pop(key)
+        self.graph.add_edge(node1, node2, **attributes)
+        weight = attributes.get(self.weight, 1)
+
+        affected = []
+        for source, distances in self.distances.items():
+            dist1 = distances.get(node1)
+            dist2 = distances.get(node2)
+            if dist1 is None or dist2 is None:
+                # The link may reconnect a part of the graph.
+                if dist1 is not None or dist2 is not None:
+                    affected.append(source)
+            elif dist1 + weight <= dist2 or dist2 + weight <= dist1:
+                affected.append(source)
+        return self._recompute(affected)
+
+    @staticmethod
+    def _uses_link(paths, node1, node2):
+        """Check if a link is part of the shortest-path tree of a source.
+
+        All paths of a single source form a tree, so it is enough to check
+        whether one end of the link is the predecessor of the other.
+        """
+        for first, second in ((node1, node2), (node2, node1)):
+            path = paths.get(second)
+            if path is not None and len(path) > 1 and path[-2] == first:
+                return True
+        return False
+
+    def _recompute(self, sources):
+        for source in sources:
+            distances, paths = single_source_dijkstra(
+                self.graph, source, weight=self.weight)
+            self.distances[source] = distances
+            self.paths[source] = paths
+        self.recomputed += len(sources)
+        return set(sources)
@@ -0,0 +1,142 @@
+"""Batched installation of table entries and register values.
+
+During bring-up, the controller does not talk to the switches directly.
+Instead, it records everything it wants to write to a switch in a `RulePlan`.
+Once all plans are complete, `install_plans` pushes them to all switches at
+the same time, using one worker thread per switch (i.e. per Thrift connection).
+Alternatively, plans can be reconciled with the state already present on the
+switches, see `reconcile.py`.
+"""
+from __future__ import print_function
+
+import threading
+import time
+
+from reconcile import reconcile_plan
+
+
+class RulePlan(object):
+    """Ordered list of Thrift calls for a single switch.
+
+    A plan exposes the subset of the `SimpleSwitchAPI` used by the controller
+    during bring-up, so the controller can fill a plan exactly as if it was
+    talking to the switch. Calls are replayed in the order they were recorded.
+    """
+
+    def __init__(self, switch):
+        self.switch = switch
+        self.operations = []
+
+    def __len__(self):
+        return len(self.operations)
+
+    def _record(self, method, *args):
+        self.operations.append((method, args))
+
+    # Recorded SimpleSwitchAPI calls.
+    # ===============================
+
+    def table_add(self, table_name, action_name, match_keys,
+                  action_params=[], prio=0):
+        self._record('table_add', table_name, action_name,
+                     list(match_keys), list(action_params), prio)
+
+    def table_set_default(self, table_name, action_name, action_params=[]):
+        self._record('table_set_default', table_name, action_name,
+                     list(action_params))
+
+    def table_clear(self, table_name):
+        self._record('table_clear', table_name)
+
+    def register_write(self, register_name, index, value):
+        self._record('register_write', register_name, index, value)
+
+    def mirroring_add(self, mirror_id, egress_port):
+        self._record('mirroring_add', mirror_id, egress_port)
+
+    def mc_mgrp_create(self, mgrp):
+        self._record('mc_mgrp_create', mgrp)
+
+    def mc_node_create(self, rid, ports):
+        self._record('mc_node_create', rid, list(ports))
+
+    def mc_node_associate(self, mgrp, l1_handle):
+        self._record('mc_node_associate', mgrp, l1_handle)
+
+    # Plan inspection and replay.
+    # ===========================
+
+    def table_entries(self, table_name=None):
+        """Return the recorded table_add calls, optionally for one table.
+
+        Returns:
+            list(tuple): (table, action, match_keys, action_params, prio).
+        """
+        return [args for method, args in self.operations
+                if method == 'table_add' and
+                (table_name is None or args[0] == table_name)]
+
+    def apply(self, controller):
+        """Replay all recorded calls on a SimpleSwitchAPI instance."""
+        for method, args in self.operations:
+            getattr(controller, method)(*args)
+
+
+def install_plans(controllers, plans, reconcile=False):
+    """Push all plans to their switches in parallel.
+
+    Every switch gets its own worker thread, as every switch has its own
+    Thrift connection. The call blocks until all switches are done.
+
+    Args:
+        controllers (dict(str, SimpleSwitchAPI)): Switch connections.
+        plans (dict(str, RulePlan)): Plan for each switch.
+        reconcile (bool): Only write the difference between the plan and
+            the current switch state instead of replaying the full plan.
+
+    Returns:
+        dict(str, tuple(float, int)): Install time in seconds and number of
+            writes for each switch.
+    """
+    report = {}
+    errors = {}
+
+    def _worker(switch, plan):
+        start = time.time()
+        writes = 0
+        try:
+            if reconcile:
+                writes = reconcile_plan(controllers[switch], plan)
+            else:
+                plan.apply(controllers[switch])
+                writes = len(plan)
+        except Exception as error:  # pylint: disable=broad-except
+            errors[switch] = error
+        report[switch] = (time.time() - start, writes)
+
+    workers = []
+    for switch, plan in plans.items():
+        worker = threading.Thread(target=_worker, args=(switch, plan))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        switch, error = sorted(errors.items())[0]
+        raise RuntimeError("Installing rules on %s failed: %s" %
+                           (switch, error))
+    return report
+
+
+def print_install_report(report):
+    """Print the per-switch result of `install_plans`."""
+    print("Rule installation")
+    print("=================")
+    for switch, (duration, writes) in sorted(report.items()):
+        print("{:6} {:5d} writes in {:.3f}s".format(
+            switch, writes, duration))
+    if report:
+        print("Slowest switch: {:.3f}s".format(
+            max(duration for duration, _ in report.values())))
@@ -0,0 +1,7 @@
+"""The scripts import their modules from their own directory, so do we."""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("configuration", "utils"):
+    sys.path.insert(0, os.path.join(ROOT, directory))
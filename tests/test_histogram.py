@@ -0,0 +1,83 @@
+"""HdrHistogram buckets and the delay recorder built on them."""
+import json
+
+import pytest
+
+from udp import DelayRecorder, HdrHistogram
+
+# Every value up to 2**12, then powers of two and their neighbours.
+VALUES = list(range(1 << 12)) + [(1 << bits) + d for bits in range(12, 40)
+                                 for d in (-1, 0, 1)]
+
+
+@pytest.mark.parametrize("sub_bits", [3, 7])
+def test_lower_bound_round_trip(sub_bits):
+    h = HdrHistogram(sub_bits)
+    for value in VALUES:
+        index = h._index(value)
+        lower = h._lower_bound(index)
+        assert lower <= value
+        assert h._index(lower) == index
+
+
+@pytest.mark.parametrize("sub_bits", [3, 7])
+def test_indices_are_monotonic(sub_bits):
+    h = HdrHistogram(sub_bits)
+    indices = [h._index(value) for value in sorted(set(VALUES))]
+    assert indices == sorted(indices)
+    # no index is skipped while every value is recorded
+    dense = [h._index(value) for value in range(1 << 12)]
+    assert all(b - a <= 1 for a, b in zip(dense, dense[1:]))
+
+
+def test_small_values_are_exact():
+    h = HdrHistogram(7)
+    for value in range(1 << 7):
+        assert h._lower_bound(h._index(value)) == value
+
+
+@pytest.mark.parametrize("sub_bits", [3, 7])
+def test_relative_error(sub_bits):
+    h = HdrHistogram(sub_bits)
+    for value in VALUES:
+        if value:
+            lower = h._lower_bound(h._index(value))
+            assert (value - lower) / float(value) < 2.0 ** (1 - sub_bits)
+
+
+def test_percentiles():
+    h = HdrHistogram()
+    assert h.percentile(50) is None
+    for value in range(1, 101):
+        h.record(value)
+    assert h.percentile(50) == 50
+    assert h.percentile(100) == 100
+    assert h.percentile(0) == 1
+    h.record(10 ** 6)
+    assert h.percentile(100) <= 10 ** 6 < h.percentile(100) * (1 + 2.0 ** -6)
+
+
+def test_summary():
+    h = HdrHistogram()
+    for value in (-5, 3, 3, 1000):
+        h.record(value)
+    summary = h.summary()
+    assert (summary["count"], summary["min"], summary["max"]) == (4, 0, 1000)
+    assert summary["mean"] == 1006 / 4.0
+    assert sum(count for _, count in summary["buckets"]) == 4
+    assert summary["buckets"][:2] == [[0, 1], [3, 2]]
+
+
+def test_delay_recorder(tmp_path):
+    recorder = DelayRecorder()
+    for sent, received in [(0, 5000), (1000, 9000), (2000, 1000)]:
+        recorder.record(sent, received)
+    assert recorder.negative == 1
+    assert recorder.delay.total == 3
+    # |8 - 5| and |-1 - 8| microseconds
+    assert sorted(b[0] for b in recorder.jitter.summary()["buckets"]) == [3, 9]
+    path = tmp_path / "delay.json"
+    recorder.save(str(path))
+    saved = json.load(open(str(path)))
+    assert saved["unit"] == "us"
+    assert saved["negative_delays"] == 1
@@ -0,0 +1,114 @@
+"""The Pacer token bucket, on a fake clock."""
+import pytest
+
+import udp
+from udp import WIRE_OVERHEAD, Pacer
+
+
+class FakeClock(object):
+    """monotonic_ns that only moves when the pacer sleeps."""
+
+    def __init__(self):
+        self.now_ns = 0
+        self.sleeps = []
+
+    def monotonic_ns(self):
+        return self.now_ns
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now_ns += int(round(seconds * 1e9))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(udp.time, "monotonic_ns", clock.monotonic_ns)
+    monkeypatch.setattr(udp.time, "sleep", clock.sleep)
+    return clock
+
+
+def _run(pacer, clock):
+    """Sends every packet, returns the send time of each."""
+    times = []
+    while not pacer.done():
+        count = pacer.wait()
+        times.extend([clock.now_ns] * count)
+        pacer.record(count)
+    return times
+
+
+def test_total_counts_wire_bytes():
+    # 100 bytes per packet on the wire
+    pacer = Pacer(1000, 100 - WIRE_OVERHEAD, 2, resolution_ns=1)
+    assert pacer.packet_size == 100
+    assert pacer.total == 20
+    assert Pacer(1000, 100 - WIRE_OVERHEAD, 2, resolution_ns=1, overhead=0).total == 2000 // 58
+
+
+@pytest.mark.parametrize("resolution_ns, batch_size, expected", [
+    (1, 1, 1),
+    (1, 4, 4),
+    # 0.1 s between packets
+    (10 ** 8, 1, 1),
+    (3 * 10 ** 8, 1, 3),
+    (3 * 10 ** 8 + 1, 1, 4),
+])
+def test_batch_size_covers_the_sleep_resolution(resolution_ns, batch_size, expected):
+    pacer = Pacer(1000, 100 - WIRE_OVERHEAD, 2, batch_size, resolution_ns)
+    assert pacer.batch_size == expected
+
+
+def test_poll_returns_a_count_or_a_delay(clock):
+    pacer = Pacer(1000, 100 - WIRE_OVERHEAD, 2, resolution_ns=1)
+    assert pacer.poll() == (1, 0.0)
+    pacer.record(1)
+    assert pacer.poll() == (0, 0.1)
+    clock.now_ns = 10 ** 8
+    assert pacer.poll() == (1, 0.0)
+    # late packets are sent at once, up to a batch
+    clock.now_ns = 5 * 10 ** 8
+    assert pacer.poll() == (1, 0.0)
+    pacer.batch_size = 5
+    assert pacer.poll() == (5, 0.0)
+    # a batch is sent when its last packet is due
+    pacer.batch_size = 10
+    assert pacer.poll() == (0, 0.5)
+
+
+def test_packets_are_evenly_spaced(clock):
+    pacer = Pacer(1000, 100 - WIRE_OVERHEAD, 2, resolution_ns=1)
+    times = _run(pacer, clock)
+    assert times == [n * 10 ** 8 for n in range(20)]
+    assert pacer.report() == [(0, 8000, 8000, 10), (1, 8000, 8000, 10)]
+
+
+def test_batches_wait_for_their_last_packet(clock):
+    pacer = Pacer(1000, 100 - WIRE_OVERHEAD, 2, resolution_ns=3 * 10 ** 8)
+    times = _run(pacer, clock)
+    assert len(times) == 20
+    # batches of 3, sent when the last packet of the batch is due
+    assert times[:6] == [2 * 10 ** 8] * 3 + [5 * 10 ** 8] * 3
+    assert all(t >= n * 10 ** 8 for n, t in enumerate(times))
+    # the last batch is cut to the packets left
+    assert times[-2:] == [19 * 10 ** 8] * 2
+
+
+def test_sleep_errors_are_made_up(clock):
+    pacer = Pacer(1000, 100 - WIRE_OVERHEAD, 2, resolution_ns=1)
+    pacer.wait()
+    pacer.record(1)
+    # a stall of 0.55 s, the missed packets go out without sleeping
+    clock.now_ns = 55 * 10 ** 7
+    for _ in range(5):
+        assert pacer.poll() == (1, 0.0)
+        pacer.record(1)
+    assert pacer.poll() == (0, 0.05)
+    assert _run(pacer, clock) == [n * 10 ** 8 for n in range(6, 20)]
+    assert pacer.report() == [(0, 8000, 8000, 10), (1, 8000, 8000, 10)]
+
+
+def test_zero_rate_sends_nothing():
+    pacer = Pacer(0, 100, 10, resolution_ns=1)
+    assert pacer.total == 0
+    assert pacer.done()
@@ -0,0 +1,125 @@
+"""reconcile_plan only writes the difference between a switch and a plan."""
+import sys
+import types
+
+try:
+    import p4utils.utils.runtime_API  # noqa: F401
+except ImportError:
+    # p4utils is only installed on the VM, reconcile only needs ResType.
+    runtime_api = types.ModuleType("p4utils.utils.runtime_API")
+    runtime_api.ResType = types.SimpleNamespace(table=0)
+    sys.modules.setdefault("p4utils", types.ModuleType("p4utils"))
+    sys.modules.setdefault("p4utils.utils", types.ModuleType("p4utils.utils"))
+    sys.modules["p4utils.utils.runtime_API"] = runtime_api
+
+from reconcile import reconcile_plan  # noqa: E402
+from rule_installer import RulePlan  # noqa: E402
+
+
+def _exact(value, width):
+    return types.SimpleNamespace(lpm=None, exact=types.SimpleNamespace(
+        key=value.to_bytes(width, "big")))
+
+
+def _lpm(address, prefix_length):
+    key = bytes(int(byte) for byte in address.split("."))
+    return types.SimpleNamespace(exact=None, lpm=types.SimpleNamespace(
+        key=key, prefix_length=prefix_length))
+
+
+def _entry(handle, match_key, action, data):
+    return types.SimpleNamespace(
+        entry_handle=handle, match_key=match_key,
+        action_entry=types.SimpleNamespace(action_name="MyIngress." + action,
+                                           action_data=data))
+
+
+class FakeSwitch(object):
+    """The part of SimpleSwitchAPI used by reconcile_plan, in memory."""
+
+    def __init__(self, entries=None, registers=None):
+        self.entries = entries or {}
+        self.registers = registers or {}
+        self.calls = []
+        self.reads = []
+        self.client = self
+
+    def get_res(self, kind, name, res_type):
+        return types.SimpleNamespace(name=name)
+
+    def bm_mt_get_entries(self, context, table):
+        return self.entries.get(table, [])
+
+    def register_read(self, register, index=None):
+        self.reads.append((register, index))
+        if index is None:
+            return list(self.registers[register])
+        return self.registers[register][index]
+
+    def __getattr__(self, method):
+        # Writes are only recorded.
+        return lambda *args: self.calls.append((method,) + args)
+
+
+NHOP = ["00:00:0a:00:01:01", "1"]
+NHOP_DATA = [bytes.fromhex("00000a000101"), (1).to_bytes(2, "big")]
+
+
+def _plan():
+    plan = RulePlan("S1")
+    plan.table_add("ipv4_lpm", "set_nhop", ["10.0.1.1/24"], NHOP)
+    plan.table_add("ipv4_lpm", "set_nhop", ["10.0.2.0/24"], NHOP)
+    plan.table_add("dst_index", "query_nextLink", ["10.0.3.0/24"], ["7"])
+    return plan
+
+
+def test_new_switch_gets_the_full_plan():
+    switch = FakeSwitch()
+    plan = _plan()
+    assert reconcile_plan(switch, plan) == len(plan)
+    assert [call[0] for call in switch.calls] == ["table_add"] * 3
+
+
+def test_only_differences_are_written():
+    switch = FakeSwitch(entries={
+        # Same as planned: the host bits of the planned prefix are ignored.
+        "ipv4_lpm": [_entry(1, [_lpm("10.0.1.0", 24)], "set_nhop", NHOP_DATA),
+                     # Not planned anymore.
+                     _entry(2, [_lpm("10.0.9.0", 24)], "set_nhop", NHOP_DATA)],
+        # Planned with another parameter.
+        "dst_index": [_entry(3, [_lpm("10.0.3.0", 24)], "query_nextLink",
+                             [(6).to_bytes(4, "big")])],
+    })
+    assert reconcile_plan(switch, _plan()) == 3
+    assert sorted(switch.calls) == sorted([
+        ("table_delete", "ipv4_lpm", 2),
+        ("table_add", "ipv4_lpm", "set_nhop", ["10.0.2.0/24"], NHOP),
+        ("table_modify", "dst_index", "query_nextLink", 3, ["7"]),
+    ])
+
+
+def test_exact_keys_are_compared_as_integers():
+    switch = FakeSwitch(entries={
+        "rewrite_mac": [_entry(1, [_exact(2, 2)], "rewrite_mac",
+                               [bytes.fromhex("00000a000102")])],
+    })
+    plan = RulePlan("S1")
+    plan.table_add("rewrite_mac", "rewrite_mac", ["2"], ["00:00:0a:00:01:02"])
+    assert reconcile_plan(switch, plan) == 0
+    assert switch.calls == []
+
+
+def test_only_planned_register_cells_are_read_and_written():
+    switch = FakeSwitch(
+        entries={"ipv4_lpm": [_entry(1, [_lpm("10.0.1.0", 24)], "set_nhop",
+                                     NHOP_DATA)]},
+        registers={"primaryNH": [0, 0, 4, 3], "linkState": [0, 1, 1, 0]})
+    plan = RulePlan("S1")
+    plan.table_add("ipv4_lpm", "set_nhop", ["10.0.1.0/24"], NHOP)
+    plan.register_write("primaryNH", 2, 5)
+    plan.register_write("primaryNH", 3, 3)
+
+    assert reconcile_plan(switch, plan) == 1
+    assert switch.calls == [("register_write", "primaryNH", 2, 5)]
+    # The linkState bits of failed links are runtime state and not touched.
+    assert switch.reads == [("primaryNH", 2), ("primaryNH", 3)]
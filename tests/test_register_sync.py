@@ -0,0 +1,77 @@
+"""RegisterSync writes only changed cells, in runs, and detects drift."""
+import numpy as np
+
+from register_sync import RegisterSync, _runs, read_cells
+
+
+class FakeSwitch(object):
+    """Registers of a switch with SimpleSwitchAPI read and write calls."""
+
+    def __init__(self, **registers):
+        self.registers = {name: list(values) for name, values in registers.items()}
+        self.writes = []
+        self.reads = []
+
+    def register_read(self, register, index=None):
+        self.reads.append((register, index))
+        if index is None:
+            return list(self.registers[register])
+        return self.registers[register][index]
+
+    def register_write(self, register, index, value):
+        self.writes.append((register, index, value))
+        if isinstance(index, list):
+            first, end = index
+        else:
+            first, end = index, index + 1
+        for cell in range(first, end):
+            self.registers[register][cell] = value
+
+
+def test_runs_split_on_gaps_and_values():
+    values = np.array([0, 5, 5, 5, 7, 7, 0, 7, 7])
+    indices = np.array([1, 2, 3, 4, 5, 7, 8])
+    assert _runs(indices, values) == [(1, 3, 5), (4, 5, 7), (7, 8, 7)]
+
+
+def test_runs_of_nothing():
+    assert _runs(np.array([], dtype=int), np.zeros(4)) == []
+
+
+def test_push_writes_changed_cells_as_ranges():
+    switch = FakeSwitch(primaryNH=[0] * 8)
+    sync = RegisterSync(switch, ["primaryNH"])
+    target = np.array([0, 3, 3, 3, 0, 2, 0, 0])
+    assert sync.push("primaryNH", target) == 2
+    # Range writes exclude the end index.
+    assert switch.writes == [("primaryNH", [1, 4], 3), ("primaryNH", 5, 2)]
+    assert switch.registers["primaryNH"] == list(target)
+    # Nothing changed, nothing written.
+    assert sync.push("primaryNH", target.copy()) == 0
+    assert sync.writes == 2
+
+
+def test_push_cells_skips_cells_with_the_value():
+    switch = FakeSwitch(linkState=[0, 1, 0, 0])
+    sync = RegisterSync(switch, ["linkState"])
+    assert sync.push_cells([("linkState", 1, 1), ("linkState", 3, 1)]) == 1
+    assert switch.writes == [("linkState", 3, 1)]
+
+
+def test_verify_reports_drift():
+    switch = FakeSwitch(primaryNH=[1, 2, 3, 4], linkState=[0, 0])
+    sync = RegisterSync(switch, ["primaryNH", "linkState"])
+    assert sync.verify() == {}
+    switch.registers["primaryNH"][2] = 9
+    mismatches = sync.verify()
+    assert list(mismatches) == ["primaryNH"]
+    assert list(mismatches["primaryNH"]) == [2]
+
+
+def test_read_cells_small_and_large():
+    switch = FakeSwitch(flowlet_to_id=list(range(100)))
+    assert read_cells(switch, "flowlet_to_id", [5, 2], max_cell_reads=2) == [5, 2]
+    assert switch.reads == [("flowlet_to_id", 5), ("flowlet_to_id", 2)]
+    switch.reads = []
+    assert read_cells(switch, "flowlet_to_id", range(10, 13), max_cell_reads=2) == [10, 11, 12]
+    assert switch.reads == [("flowlet_to_id", None)]
@@ -0,0 +1,85 @@
+"""RoutingEngine stays equal to a full Dijkstra on the graph without failed links."""
+import random
+
+import networkx as nx
+import pytest
+from networkx.algorithms import all_pairs_dijkstra_path_length
+
+from routing import RoutingEngine
+
+
+def _graph(seed):
+    graph = nx.connected_watts_strogatz_graph(16, 4, 0.3, seed=seed)
+    rng = random.Random(seed)
+    for node1, node2 in graph.edges:
+        graph[node1][node2]["weight"] = rng.randint(1, 5)
+    return graph
+
+
+def _expected(graph, failures):
+    remaining = graph.copy()
+    remaining.remove_edges_from(failures)
+    return dict(all_pairs_dijkstra_path_length(remaining))
+
+
+def _check(engine, graph, failures):
+    assert engine.distances == _expected(graph, failures)
+    for source, paths in engine.paths.items():
+        for target, path in paths.items():
+            assert path[0] == source and path[-1] == target
+            length = sum(graph[node1][node2].get("weight", 1)
+                         for node1, node2 in zip(path, path[1:]))
+            assert length == engine.distances[source][target]
+            assert not {frozenset(link) for link in zip(path, path[1:])} & \
+                {frozenset(link) for link in failures}
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_link_events_match_dijkstra(seed):
+    graph = _graph(seed)
+    engine = RoutingEngine(graph)
+    rng = random.Random(seed)
+    edges = list(graph.edges)
+    failed = []
+    for _ in range(30):
+        if failed and rng.random() < 0.5:
+            link = failed.pop(rng.randrange(len(failed)))
+            # Links come back in either direction.
+            engine.link_up(link[::-1])
+        else:
+            link = rng.choice([edge for edge in edges if edge not in failed])
+            failed.append(link)
+            engine.link_down(link)
+        _check(engine, graph, failed)
+
+
+def test_partition_and_reconnect():
+    graph = nx.path_graph(4)
+    engine = RoutingEngine(graph)
+    engine.link_down((1, 2))
+    assert 3 not in engine.distances[0]
+    _check(engine, graph, [(1, 2)])
+    engine.link_up((1, 2))
+    assert engine.distances[0][3] == 3
+    _check(engine, graph, [])
+
+
+def test_unused_link_recomputes_nothing():
+    graph = nx.cycle_graph(4)
+    graph[0][3]["weight"] = 10
+    engine = RoutingEngine(graph)
+    assert engine.link_down((0, 3)) == set()
+    assert engine.recomputed == 0
+    _check(engine, graph, [(0, 3)])
+
+
+def test_set_failures():
+    graph = _graph(42)
+    engine = RoutingEngine(graph)
+    edges = list(graph.edges)
+    for failures in (edges[:3], edges[2:5], [], edges[7:8]):
+        engine.set_failures(failures)
+        _check(engine, graph, failures)
+    # Repeated events are ignored.
+    assert engine.link_up(edges[0]) == set()
+    assert engine.link_down(edges[7][::-1]) == set()
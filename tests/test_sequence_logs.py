@@ -0,0 +1,94 @@
+"""Sequence logs read back what was written, in every format."""
+import pytest
+
+from performance import count_flow, load_sequence_array
+from udp import (LOG_FORMATS, RANGES_MAGIC, RECORDS_MAGIC, ReceivedSet, open_sequence_log,
+                 read_sequences, sequence_log_path)
+
+# Increasing with a gap, a reordered and a duplicate packet, and the
+# largest sequence number.
+SEQUENCES = [0, 1, 2, 3, 10, 11, 5, 5, 12, 2 ** 32 - 1]
+
+
+def _write(path, log_format, ranges, sequences):
+    log = open_sequence_log(str(path), log_format, ranges)
+    for seq in sequences:
+        log.add(seq)
+    log.close()
+
+
+@pytest.mark.parametrize("log_format", LOG_FORMATS)
+@pytest.mark.parametrize("ranges", [False, True])
+def test_round_trip(tmp_path, log_format, ranges):
+    path = tmp_path / "log"
+    _write(path, log_format, ranges, SEQUENCES)
+    assert read_sequences(str(path)) == SEQUENCES
+    assert load_sequence_array(str(path)).tolist() == SEQUENCES
+
+
+@pytest.mark.parametrize("ranges, magic", [(False, RECORDS_MAGIC), (True, RANGES_MAGIC)])
+def test_binary_magic(tmp_path, ranges, magic):
+    path = tmp_path / "log"
+    _write(path, "binary", ranges, SEQUENCES)
+    assert path.read_bytes()[:4] == magic
+
+
+def test_consecutive_ranges_are_merged(tmp_path):
+    path = tmp_path / "log"
+    log = open_sequence_log(str(path), "binary", ranges=True)
+    log.add_range(0, 1000)
+    log.add_range(1000, 5000)
+    log.add(5000)
+    log.close()
+    # Magic and a single (start, end) pair.
+    assert path.stat().st_size == 4 + 8
+    assert read_sequences(str(path)) == list(range(5001))
+
+
+def test_ranges_are_split_at_the_wrap(tmp_path):
+    path = tmp_path / "log"
+    log = open_sequence_log(str(path), "binary", ranges=True)
+    log.add_range(2 ** 32 - 2, 2 ** 32 + 2)
+    log.close()
+    wrapped = [2 ** 32 - 2, 2 ** 32 - 1, 0, 1]
+    assert read_sequences(str(path)) == wrapped
+    assert load_sequence_array(str(path)).tolist() == wrapped
+
+
+@pytest.mark.parametrize("log_format", LOG_FORMATS)
+@pytest.mark.parametrize("ranges", [False, True])
+def test_empty_log(tmp_path, log_format, ranges):
+    path = tmp_path / "log"
+    _write(path, log_format, ranges, [])
+    assert read_sequences(str(path)) == []
+    assert len(load_sequence_array(str(path))) == 0
+
+
+def test_records_buffer_is_flushed_in_blocks(tmp_path):
+    path = tmp_path / "log"
+    sequences = list(range(300000))
+    _write(path, "binary", False, sequences)
+    assert load_sequence_array(str(path)).tolist() == sequences
+
+
+def test_count_flow_across_formats(tmp_path):
+    sender, receiver = tmp_path / "sender", tmp_path / "receiver"
+    log = open_sequence_log(str(sender), "binary", ranges=True)
+    log.add_range(0, 100)
+    log.close()
+    # Duplicates and unknown sequence numbers do not count.
+    _write(receiver, "text", False, [0, 1, 1, 50, 99, 150])
+    assert count_flow(str(sender), str(receiver)) == (100, 4)
+
+
+def test_received_set_ranges():
+    received = ReceivedSet()
+    for seq in [7, 0, 1, 2, 5, 2, 8, 9]:
+        received.add(seq)
+    assert list(received.ranges()) == [(0, 3), (5, 6), (7, 10)]
+
+
+def test_log_extension():
+    assert sequence_log_path("/home", "sender", "h1", "h2", 1, 2).endswith(".txt")
+    assert sequence_log_path("/home", "receiver", "h1", "h2", 1, 2,
+                             "binary") == "/home/receiver_h1_h2_1_2.seq"
@@ -0,0 +1,214 @@
+"""Generate large traffic specs over the hosts of a topology.
+
+Flows are written to disk one at a time with the fixed csv dialect of
+`utils.TrafficDialect`, so the memory use does not depend on the number of
+flows.
+
+Example usage:
+
+python generate_matrix.py --model gravity --flows 20000 --out ../scenarios/gravity.traffic
+"""
+
+import argparse
+import bisect
+import csv
+import random
+
+from units import setSizeToInt
+from utils import TRAFFIC_FIELDS, TrafficDialect, load_topology_index
+
+MODELS = ["all-to-all", "gravity", "hotspot"]
+DISTRIBUTIONS = ["constant", "pareto"]
+
+# Every flow gets its own sender port on its source host and its own
+# receiver port on its destination host.
+FIRST_SPORT = 10000
+FIRST_DPORT = 30000
+MAX_PORT = 65535
+
+
+class WeightedChoice(object):
+    """Draw items with probability proportional to their weight."""
+
+    def __init__(self, items, weights):
+        self.items = list(items)
+        self.cumulative = _accumulate(weights)
+
+    def draw(self):
+        value = random.random() * self.cumulative[-1]
+        return self.items[bisect.bisect_right(self.cumulative, value)]
+
+
+def _accumulate(values):
+    total = 0
+    cumulative = []
+    for value in values:
+        total += value
+        cumulative.append(total)
+    return cumulative
+
+
+def _draw_other(choice, src):
+    """Draw a destination different from the source.
+
+    Needs at least one other host with a non-zero weight.
+    """
+    while True:
+        dst = choice.draw()
+        if dst != src:
+            return dst
+
+
+def all_to_all_pairs(hosts, flows_per_pair=1):
+    """Every ordered pair of hosts, flows_per_pair times."""
+    for _ in range(flows_per_pair):
+        for src in hosts:
+            for dst in hosts:
+                if src != dst:
+                    yield src, dst
+
+
+def gravity_pairs(hosts, flows, sigma=1.0):
+    """Pairs drawn with probability proportional to the product of host weights.
+
+    Host weights are log-normal, so a few hosts send and receive most flows.
+    """
+    choice = WeightedChoice(hosts, [random.lognormvariate(0, sigma) for _ in hosts])
+    for _ in range(flows):
+        src = choice.draw()
+        yield src, _draw_other(choice, src)
+
+
+def hotspot_pairs(hosts, flows, hotspots=1, fraction=0.8):
+    """A fraction of the flows go to a few hotspot hosts, the rest uniformly."""
+    hot = random.sample(hosts, min(hotspots, len(hosts)))
+    uniform = WeightedChoice(hosts, [1] * len(hosts))
+    for _ in range(flows):
+        if random.random() < fraction:
+            dst = random.choice(hot)
+            yield _draw_other(uniform, dst), dst
+        else:
+            src = uniform.draw()
+            yield src, _draw_other(uniform, src)
+
+
+def draw_value(distribution, scale, alpha, maximum):
+    """Constant value, or Pareto distributed with minimum scale."""
+    if distribution == "constant":
+        return scale
+    return min(maximum, scale * random.paretovariate(alpha))
+
+
+def _parse_tos_mix(tos_mix):
+    """`128:1,64:1,32:1` to a weighted choice of TOS values."""
+    values, weights = [], []
+    for item in tos_mix.split(","):
+        tos, weight = item.split(":")
+        values.append(tos)
+        weights.append(float(weight))
+    return WeightedChoice(values, weights)
+
+
+def generate_flows(pairs, args):
+    """Turn host pairs into traffic spec rows."""
+    sports = {}
+    dports = {}
+    tos_choice = _parse_tos_mix(args.tos_mix)
+    rate = setSizeToInt(args.rate)
+    max_rate = setSizeToInt(args.max_rate)
+    for src, dst in pairs:
+        sport = sports.get(src, FIRST_SPORT)
+        dport = dports.get(dst, FIRST_DPORT)
+        if sport > MAX_PORT or dport > MAX_PORT:
+            raise ValueError("Too many flows for host {} or {}".format(src, dst))
+        sports[src] = sport + 1
+        dports[dst] = dport + 1
+
+        flow_rate = draw_value(args.rate_dist, rate, args.rate_alpha, max_rate)
+        duration = draw_value(args.duration_dist, args.duration,
+                              args.duration_alpha, args.max_duration)
+        start_time = random.uniform(args.start, args.end)
+        yield [src, dst, sport, dport, tos_choice.draw(),
+               "{:.0f}K".format(flow_rate / 1e3), "{:.1f}".format(duration),
+               args.packet_size, "{:.3f}".format(start_time)]
+
+
+def get_hosts(args):
+    if args.hosts:
+        return args.hosts.split(",")
+    types = load_topology_index(args.topo)["types"]
+    return sorted(node for node, node_type in types.items() if node_type == "host")
+
+
+def write_spec(out_file, rows):
+    """Stream rows to a traffic spec, returns the number of flows."""
+    count = 0
+    with open(out_file, 'w') as csvfile:
+        writer = csv.writer(csvfile, dialect=TrafficDialect)
+        writer.writerow(TRAFFIC_FIELDS)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    # pylint: disable=invalid-name
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--topo', help='Topo path name',
+                        type=str, required=False, default="../build/topology.db")
+    parser.add_argument('--hosts', help='Comma separated hosts, instead of the topology hosts',
+                        type=str, required=False, default=None)
+    parser.add_argument('--out', help='Output traffic spec',
+                        type=str, required=True)
+    parser.add_argument('--model', help='Traffic matrix model',
+                        type=str, required=False, default="gravity", choices=MODELS)
+    parser.add_argument('--flows', help='Number of flows (gravity, hotspot)',
+                        type=int, required=False, default=1000)
+    parser.add_argument('--flows-per-pair', help='Flows per host pair (all-to-all)',
+                        type=int, required=False, default=1)
+    parser.add_argument('--gravity-sigma', help='Spread of the log-normal host weights',
+                        type=float, required=False, default=1.0)
+    parser.add_argument('--hotspots', help='Number of hotspot hosts',
+                        type=int, required=False, default=1)
+    parser.add_argument('--hotspot-fraction', help='Fraction of flows to hotspots',
+                        type=float, required=False, default=0.8)
+    parser.add_argument('--rate', help='Flow rate, minimum rate for pareto',
+                        type=str, required=False, default="100K")
+    parser.add_argument('--rate-dist', type=str, required=False,
+                        default="constant", choices=DISTRIBUTIONS)
+    parser.add_argument('--rate-alpha', type=float, required=False, default=1.5)
+    parser.add_argument('--max-rate', type=str, required=False, default="10M")
+    parser.add_argument('--duration', help='Flow duration, minimum duration for pareto',
+                        type=float, required=False, default=10)
+    parser.add_argument('--duration-dist', type=str, required=False,
+                        default="constant", choices=DISTRIBUTIONS)
+    parser.add_argument('--duration-alpha', type=float, required=False, default=1.5)
+    parser.add_argument('--max-duration', type=float, required=False, default=60)
+    parser.add_argument('--start', help='Earliest start time',
+                        type=float, required=False, default=5)
+    parser.add_argument('--end', help='Latest start time',
+                        type=float, required=False, default=30)
+    parser.add_argument('--packet-size', type=int, required=False, default=1400)
+    parser.add_argument('--tos-mix', help='Weights of the TOS values',
+                        type=str, required=False, default="128:1,64:1,32:1")
+    parser.add_argument('--seed', type=str, required=False, default=None)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    for option in ('rate', 'max_rate'):
+        if setSizeToInt(getattr(args, option)) <= 0:
+            parser.error("invalid --{}: {}".format(option.replace('_', '-'),
+                                                   getattr(args, option)))
+    hosts = get_hosts(args)
+    if len(set(hosts)) < 2:
+        parser.error("at least two hosts are needed, got {}".format(len(set(hosts))))
+    if args.model == "all-to-all":
+        pairs = all_to_all_pairs(hosts, args.flows_per_pair)
+    elif args.model == "gravity":
+        pairs = gravity_pairs(hosts, args.flows, args.gravity_sigma)
+    else:
+        pairs = hotspot_pairs(hosts, args.flows, args.hotspots, args.hotspot_fraction)
+
+    count = write_spec(args.out, generate_flows(pairs, args))
+    print("{} flows written to {}".format(count, args.out))
@@ -1,12 +1,205 @@
-"""Start senders and receivers on hosts."""
+"""Start senders and receivers on hosts.
 
+Every action on a host is a single shell script run by one exec: starting a
+host copies its config file, saves the PID and starts the scheduler; killing
+a host kills the scheduler and removes its files. How the scripts are run
+depends on the backend:
+
+- `DockerCliBackend`: `sudo docker exec`, the config is passed on stdin.
+- `DockerApiBackend`: Docker Engine API over the unix socket, without
+  starting a docker CLI process per host.
+- `LocalBackend`: plain local subprocesses, to run the orchestration without
+  docker (e.g. to test it).
+"""
+
+import io
+import json
+import os
+import socket
+import subprocess
 import sys
 import signal
-import subprocess
+import tarfile
+import time
+from multiprocessing.pool import ThreadPool
 from random import randint
 
+try:
+    import httplib as http_client
+except ImportError:
+    import http.client as http_client
+
 from utils import NODE_TO_CONTAINER
 
+# Maximum number of execs that are started or awaited at the same time.
+DEFAULT_MAX_WORKERS = 16
+BACKENDS = ["docker", "docker-api", "local"]
+MAP_TIMEOUT = 24 * 3600
+
+
+# Backends.
+# =========
+
+def _ignore_sigint():
+    """Interrupts are handled by the orchestrator, not by the workers."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _new_session():
+    """Make the script a process group leader, like `docker exec` does."""
+    _ignore_sigint()
+    os.setsid()
+
+
+class DockerCliBackend(object):
+    """Run scripts with `docker exec`."""
+    docker = ["sudo", "docker"]
+
+    def start(self, container, script, upload=None):
+        """Start a script in a container.
+
+        Args:
+            container (str): Container name.
+            script (str): Bash script.
+            upload (tuple(str, bytes)): Optional path and content of a file
+                that is written before the script runs.
+
+        Returns:
+            Popen: Handle with `poll()` and `wait()`.
+        """
+        cmd = self.docker + ["exec"]
+        if upload is not None:
+            cmd.append("-i")
+            script = "cat > {} && {}".format(upload[0], script)
+        cmd += [container, "bash", "-c", script]
+        return _popen(cmd, upload, _ignore_sigint)
+
+
+class LocalBackend(object):
+    """Run scripts as local subprocesses, the container is ignored."""
+
+    def start(self, container, script, upload=None):
+        if upload is not None:
+            script = "mkdir -p {} && cat > {} && {}".format(
+                os.path.dirname(upload[0]), upload[0], script)
+        return _popen(["bash", "-c", script], upload, _new_session)
+
+
+def _popen(cmd, upload, preexec_fn):
+    stdin = subprocess.PIPE if upload is not None else None
+    worker = subprocess.Popen(cmd, stdin=stdin, preexec_fn=preexec_fn)
+    if upload is not None:
+        worker.stdin.write(upload[1])
+        worker.stdin.close()
+    return worker
+
+
+class _UnixHTTPConnection(http_client.HTTPConnection):
+    """HTTP connection over a unix socket."""
+
+    def __init__(self, socket_path, timeout=60):
+        http_client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerApiBackend(object):
+    """Run scripts with the Docker Engine API.
+
+    Execs are started detached and polled for their exit code, so no
+    process or connection is kept open while a script runs.
+
+    Args:
+        socket_path (str): Unix socket of the docker daemon.
+        poll_interval (float): Seconds between two polls of a running exec.
+    """
+
+    def __init__(self, socket_path="/var/run/docker.sock", poll_interval=0.2):
+        self.socket_path = socket_path
+        self.poll_interval = poll_interval
+
+    def request(self, method, url, body=None, content_type="application/json"):
+        """Send one request to the daemon, return the decoded JSON reply."""
+        connection = _UnixHTTPConnection(self.socket_path)
+        try:
+            if body is not None and content_type == "application/json":
+                body = json.dumps(body)
+            headers = {"Content-Type": content_type} if body is not None else {}
+            connection.request(method, url, body, headers)
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise RuntimeError("Docker API {} {} failed ({}): {}".format(
+                method, url, response.status, data.strip()))
+        return json.loads(data.decode("utf-8")) if data else None
+
+    def upload(self, container, path, content):
+        """Write a file into a container, as a single-file tar archive."""
+        archive = io.BytesIO()
+        info = tarfile.TarInfo(os.path.basename(path))
+        info.size = len(content)
+        info.mtime = time.time()
+        tar = tarfile.open(fileobj=archive, mode="w")
+        tar.addfile(info, io.BytesIO(content))
+        tar.close()
+        self.request("PUT", "/containers/{}/archive?path={}".format(
+            container, os.path.dirname(path)),
+            archive.getvalue(), content_type="application/x-tar")
+
+    def start(self, container, script, upload=None):
+        if upload is not None:
+            self.upload(container, *upload)
+        created = self.request(
+            "POST", "/containers/{}/exec".format(container),
+            {"Cmd": ["bash", "-c", script],
+             "AttachStdout": False, "AttachStderr": False})
+        self.request("POST", "/exec/{}/start".format(created["Id"]),
+                     {"Detach": True})
+        return _ApiExec(self, created["Id"])
+
+
+class _ApiExec(object):
+    """Handle of a detached exec, like a Popen object."""
+
+    def __init__(self, backend, exec_id):
+        self.backend = backend
+        self.exec_id = exec_id
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            info = self.backend.request(
+                "GET", "/exec/{}/json".format(self.exec_id))
+            if not info["Running"] and info["ExitCode"] is not None:
+                self.returncode = info["ExitCode"]
+        return self.returncode
+
+    def wait(self):
+        while self.poll() is None:
+            time.sleep(self.backend.poll_interval)
+        return self.returncode
+
+
+def get_backend(name):
+    """Backend by name, see `BACKENDS`."""
+    if name == "docker":
+        return DockerCliBackend()
+    if name == "docker-api":
+        return DockerApiBackend()
+    if name == "local":
+        return LocalBackend()
+    raise ValueError("Unknown backend: {}".format(name))
+
+
+# Hosts.
+# ======
 
 class Hosts(object):
     """A class that manages host subprocesses."""
@@ -15,7 +208,8 @@ class Hosts(object):
 
     workers = []
 
-    def __init__(self, host_configs, expt_id=None):
+    def __init__(self, host_configs, expt_id=None, backend=None,
+                 max_workers=DEFAULT_MAX_WORKERS, root="", script_dir="/home"):
         """Prepare the hosts.
         Args:
             host_configs (dict):
@@ -23,43 +217,61 @@ class Hosts(object):
             expt_id (str):
                 Id that is used to identify all files belonging
                 to this experiment on the host.
+            backend:
+                Runs the scripts, `DockerCliBackend` by default.
+            max_workers (int):
+                Maximum number of execs started or awaited at once.
+            root (str):
+                Prefix of all paths on the host, may contain `{host}`.
+                Used by the local backend to give every host its own
+                directory.
+            script_dir (str):
+                Directory of `schedule_flows.py` on the host.
         """
         if expt_id is None:
             expt_id = randint(0, 424242)
         self.expt_id = str(expt_id)
         self.host_configs = host_configs
+        self.backend = backend if backend is not None else DockerCliBackend()
+        self.max_workers = max_workers
+        self.root = root
+        self.script_dir = script_dir
 
+    def _scripts(self, host):
+        """Start, kill and cleanup script and config path of a host."""
+        root = self.root.format(host=host)
+        run_dir = root + "/var/run"
         # Path on the host to use for config files.
-        self.config_path = "/var/run/{id}_{suffix}.cfg".format(
-            id=self.expt_id, suffix=self.suffix
+        config_path = "{dir}/{id}_{suffix}.cfg".format(
+            dir=run_dir, id=self.expt_id, suffix=self.suffix
         )
-
         # Path for PID files so we can kill the processes.
-        self.pid_path = "/var/run/{id}_{suffix}.pid".format(
-            id=self.expt_id, suffix=self.suffix
+        pid_path = "{dir}/{id}_{suffix}.pid".format(
+            dir=run_dir, id=self.expt_id, suffix=self.suffix
         )
+        formatted = self.cmd.format(config=config_path, home=root + "/home",
+                                    scripts=self.script_dir)
 
-        # Format the command with config path.
-        formatted = self.cmd.format(config=self.config_path)
-
-        # Wrap the command to run in bash and save the bash PID first,
-        # so we can kill the whole process group later. Killing the group
-        # is important, as otherwise child processes can remain.
-        self.cmd = "bash -c 'echo $$ > {pid} && {cmd}'".format(
-            cmd=formatted,
-            pid=self.pid_path
-        )
-        self.kill_cmd = "bash -c 'kill -- -`cat {pid}`'".format(
-            pid=self.pid_path
-        )
+        # Save the bash PID first, so we can kill the whole process group
+        # later. Killing the group is important, as otherwise child processes
+        # can remain.
+        start = "echo $$ > {pid} && {cmd}".format(cmd=formatted, pid=pid_path)
+        if root:
+            start = "mkdir -p {}/home && {}".format(root, start)
+        cleanup = "rm -f {} {}".format(config_path, pid_path)
+        kill = "kill -- -`cat {}`; {}".format(pid_path, cleanup)
+        return config_path, start, kill, cleanup
 
     def start(self):
-        """Copt config files to hosts, start sender script, and wait."""
-        self._copy_files()
+        """Copy config files to hosts and start the scripts."""
         if self.workers:
             raise RuntimeError("Processes are already started!")
-        args = [(host, self.cmd) for host in self.host_configs]
-        self.workers = _exec_parallel(args)
+        args = []
+        for host, config_file_path in self.host_configs.items():
+            config_path, start, _, _ = self._scripts(host)
+            with open(config_file_path, "rb") as config_file:
+                args.append((host, start, (config_path, config_file.read())))
+        self.workers = _exec_parallel(self.backend, args, self.max_workers)
 
     def wait(self):
         """Wait on all workers, raise for problems."""
@@ -67,79 +279,69 @@ class Hosts(object):
         self._cleanup()
 
     def kill(self):
-        """Kill all processes."""
-        # Kill in parallel to avoid wait time.
-        args = [(host, self.kill_cmd) for host in self.host_configs]
-        workers = _exec_parallel(args)
-        _wait_for_all(workers)  # Immediately wait
-        self._cleanup()
-
-    def _copy_files(self):
-        """Copy files to hosts."""
-        args = [(host, config_file_path, self.config_path)
-                for host, config_file_path in self.host_configs.items()]
-        workers = _copy_parallel(args)
-        _wait_for_all(workers)  # Immediately wait
+        """Kill all processes and remove their files."""
+        args = [(host, self._scripts(host)[2], None)
+                for host in self.host_configs]
+        _run_parallel(self.backend, args, self.max_workers)
+        self.workers = []
 
     def _cleanup(self):
         """Remove all config and pid files."""
-        # Clean in parallel
-        args = [(host, "rm %s" % path)
-                for host in self.host_configs
-                for path in (self.config_path, self.pid_path)]
-        workers = _exec_parallel(args)
-        _wait_for_all(workers)  # Immediately wait
+        args = [(host, self._scripts(host)[3], None)
+                for host in self.host_configs]
+        _run_parallel(self.backend, args, self.max_workers)
         self.workers = []
 
 
 class Senders(Hosts):
     """Sender Manager."""
-    cmd = "python3 /home/schedule_flows.py --config {config} --type sender"
+    cmd = "python3 {scripts}/schedule_flows.py --config {config} --type sender --log-path {home}/"
     suffix = "sender"
 
 
 class Receivers(Hosts):
     """Receiver Manager."""
-    cmd = "python3 /home/schedule_flows.py --config {config} --type receiver"
+    cmd = "python3 {scripts}/schedule_flows.py --config {config} --type receiver --log-path {home}/"
     suffix = "receiver"
 
 
 # Helpers.
 # ========
 
-def _exec_parallel(all_cmds):
-    final_cmds = []
-    for host, cmd in all_cmds:
-        if host in NODE_TO_CONTAINER:
-            host = NODE_TO_CONTAINER[host]
-        final_cmd = "sudo docker exec {container} {cmd}".format(
-            container=host, cmd=cmd,
-        )
-        final_cmds.append(final_cmd)
-    return _start_parallel(final_cmds)
+def _exec_parallel(backend, all_cmds, max_workers):
+    """Start all scripts, at most max_workers starts at once.
 
+    Args:
+        all_cmds (list(tuple(str, str, tuple))): Host, script and upload.
 
-def _copy_parallel(all_cmds):
-    final_cmds = []
-    for host, source, destination in all_cmds:
-        if host in NODE_TO_CONTAINER:
-            host = NODE_TO_CONTAINER[host]
-        final_cmd = "sudo docker cp {source} {container}:{dest}".format(
-            container=host, source=source, dest=destination,
-        )
-        final_cmds.append(final_cmd)
-    return _start_parallel(final_cmds)
+    Returns:
+        list: Handles of the running scripts.
+    """
+    def start(args):
+        host, script, upload = args
+        return backend.start(NODE_TO_CONTAINER.get(host, host), script, upload)
+    return _map(start, all_cmds, max_workers)
 
 
-def _start_parallel(cmds):
-    """Start parallel processes that cannot be interrupted by sigint."""
-    original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    workers = []
-    for cmd in cmds:
-        worker = subprocess.Popen(cmd, shell=True)
-        workers.append(worker)
-    signal.signal(signal.SIGINT, original_sigint_handler)
-    return workers
+def _run_parallel(backend, all_cmds, max_workers):
+    """Run all scripts to completion, at most max_workers at once."""
+    def run(args):
+        host, script, upload = args
+        return backend.start(
+            NODE_TO_CONTAINER.get(host, host), script, upload).wait()
+    return _map(run, all_cmds, max_workers)
+
+
+def _map(function, items, max_workers):
+    if not items:
+        return []
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        # With a timeout, the wait can be interrupted (Python 2).
+        return pool.map_async(function, items).get(MAP_TIMEOUT)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def _wait_for_all(workers, check=False):
@@ -1,87 +1,40 @@
+"""Monitor the bit rate of all links of the mini internet.
+
+The links are the edges of the topology (the index of `topology.db`, see
+`utils.load_topology_index`); `link_info.txt` tells which interface sends the
+traffic of each direction of a link. Only the `tx_bytes` counters of these
+interfaces are read, from sysfs with file descriptors that stay open. Samples
+are kept in a fixed-size NumPy ring buffer and rates are smoothed with an EWMA.
+
+The rates can be shown as:
+
+- diagram: the hand-drawn topology, only for the default topology.
+- top: the busiest links with their utilization of the configured bandwidth.
+- stream: JSON lines for other tools, a header with the links first.
+
+In headless mode, samples are only appended to a binary time series (see
+`load_samples`), so they can be taken at a higher frequency and plotted
+offline.
+
+Example usage:
+
+python2 monitoring.py --view top --top 30
+python2 monitoring.py --headless --interval 0.01 --out links.series
+"""
+from __future__ import print_function
+
+import argparse
+import json
 import os
+import signal
+import struct
 import sys
 import time
-import psutil
-import argparse
-import subprocess as sp
-
-NODE_TO_CONTAINER = {
-    "R1" : "1_R1router",
-    "R2" : "1_R2router",
-    "R3" : "1_R3router",
-    "R4" : "1_R4router",
-    "S1" : "1_S1router",
-    "S2" : "1_S2router",
-    "S3" : "1_S3router",
-    "S4" : "1_S4router",
-    "S5" : "1_S5router",
-    "S6" : "1_S6router",
-    "h1" : "1_S1host",
-    "h2" : "1_S2host",
-    "h3" : "1_S3host",
-    "h4" : "1_S4host",
-    "h5" : "1_S5host",
-    "h6" : "1_S6host"
-}
-
-LINKS = {
-    ('h1', 'S1') : 0,
-    ('S1', 'h1') : 0,
-    ('h2', 'S2') : 0,
-    ('S2', 'h2') : 0,
-    ('h3', 'S3') : 0,
-    ('S3', 'h3') : 0,
-    ('h4', 'S4') : 0,
-    ('S4', 'h4') : 0,
-    ('h5', 'S5') : 0,
-    ('S5', 'h5') : 0,
-    ('h6', 'S6') : 0,
-    ('S6', 'h6') : 0,
-    ('S1', 'R1') : 0,
-    ('R1', 'S1') : 0,
-    ('S1', 'R4') : 0,
-    ('R4', 'S1') : 0,
-    ('S2', 'R1') : 0,
-    ('R1', 'S2') : 0,
-    ('S2', 'R2') : 0,
-    ('R2', 'S2') : 0,
-    ('S3', 'R2') : 0,
-    ('R2', 'S3') : 0,
-    ('S3', 'R3') : 0,
-    ('R3', 'S3') : 0,
-    ('S4', 'R2') : 0,
-    ('R2', 'S4') : 0,
-    ('S4', 'R3') : 0,
-    ('R3', 'S4') : 0,
-    ('S5', 'R3') : 0,
-    ('R3', 'S5') : 0,
-    ('S5', 'R4') : 0,
-    ('R4', 'S5') : 0,
-    ('S6', 'R1') : 0,
-    ('R1', 'S6') : 0,
-    ('S6', 'R4') : 0,
-    ('R4', 'S6') : 0,
-    ('R1', 'R2') : 0,
-    ('R2', 'R1') : 0,
-    ('R2', 'R3') : 0,
-    ('R3', 'R2') : 0,
-    ('R3', 'R4') : 0,
-    ('R4', 'R3') : 0,
-    ('R4', 'R1') : 0,
-    ('R1', 'R4') : 0,
-    ('R1', 'R3') : 0,
-    ('R3', 'R1') : 0,
-    ('R2', 'R4') : 0,
-    ('R4', 'R2') : 0,
-    ('S1', 'S6') : 0,
-    ('S6', 'S1') : 0,
-    ('S3', 'S4') : 0,
-    ('S4', 'S3') : 0
-}
-
-
 
+import numpy as np
 
+from ring_buffer import RingBuffer
+from utils import load_topology_index
 
 topo_string="""
                                      ########################################'
@@ -127,85 +80,383 @@ topo_string="""
 """
 
 
-link_intf = {}
-link_traffic = {}
-
-if not os.path.isfile("/home/adv-net/mini_internet_project/platform/groups/link_info.txt"):
-    print 'You must build the virtual network before running the monitoring script.'
-    sys.exit(0)
-
-with open('/home/adv-net/mini_internet_project/platform/groups/link_info.txt', 'r') as fd:
-    for line in fd.readlines():
-        linetab = line.rstrip('\n').split(' ')
-        node1 = linetab[1]
-        node2 = linetab[4]
-        send_traffic_intf1 = linetab[3]
-        send_traffic_intf2 = linetab[6]
-
-        link_intf[(node1, node2)] = send_traffic_intf2
-        link_traffic[(node1, node2)] = []
-
-        link_intf[(node2, node1)] = send_traffic_intf1
-        link_traffic[(node2, node1)] = []
-
-def print_traffic():
-    tmp = sp.call('clear', shell=True)
-
-    print topo_string.format(\
-    LINKS[("h2", "S2")], LINKS[("S2", "h2")], \
-    LINKS[("R1", "S2")], LINKS[("S2", "R1")], \
-    LINKS[("S2", "R2")], LINKS[("R2", "S2")], \
-    LINKS[("h1", "S1")], LINKS[("S1", "h1")], \
-    LINKS[("S1", "R1")], LINKS[("R1", "S1")], \
-    LINKS[("R1", "R2")], LINKS[("R2", "R1")], \
-    LINKS[("R2", "S3")], LINKS[("S3", "R2")], \
-    LINKS[("S3", "h3")], LINKS[("h3", "S3")], \
-    LINKS[("S1", "R4")], LINKS[("R4", "S1")], \
-    LINKS[("R3", "S3")], LINKS[("S3", "R3")], \
-    LINKS[("R4", "R2")], LINKS[("R2", "R4")], \
-    LINKS[("S1", "S6")], LINKS[("S6", "S1")], \
-    LINKS[("R1", "R4")], LINKS[("R4", "R1")], \
-    LINKS[("R2", "R3")], LINKS[("R3", "R2")], \
-    LINKS[("S3", "S4")], LINKS[("S4", "S3")], \
-    LINKS[("R1", "R3")], LINKS[("R3", "R1")], \
-    LINKS[("S6", "R1")], LINKS[("R1", "S6")], \
-    LINKS[("R2", "S4")], LINKS[("S4", "R2")], \
-    LINKS[("h6", "S6")], LINKS[("S6", "h6")], \
-    LINKS[("S6", "R4")], LINKS[("R4", "S6")], \
-    LINKS[("R4", "R3")], LINKS[("R3", "R4")], \
-    LINKS[("R3", "S4")], LINKS[("S4", "R3")], \
-    LINKS[("S4", "h4")], LINKS[("h4", "S4")], \
-    LINKS[("R4", "S5")], LINKS[("S5", "R4")], \
-    LINKS[("S5", "R3")], LINKS[("R3", "S5")], \
-    LINKS[("S5", "h5")], LINKS[("h5", "S5")])
-
-i = 0
-while True:
-    try:
-        net_stats = psutil.net_io_counters(pernic=True)
+# Placeholders of the diagram, in order.
+DIAGRAM_LINKS = [
+    ("h2", "S2"), ("S2", "h2"), ("R1", "S2"), ("S2", "R1"),
+    ("S2", "R2"), ("R2", "S2"), ("h1", "S1"), ("S1", "h1"),
+    ("S1", "R1"), ("R1", "S1"), ("R1", "R2"), ("R2", "R1"),
+    ("R2", "S3"), ("S3", "R2"), ("S3", "h3"), ("h3", "S3"),
+    ("S1", "R4"), ("R4", "S1"), ("R3", "S3"), ("S3", "R3"),
+    ("R4", "R2"), ("R2", "R4"), ("S1", "S6"), ("S6", "S1"),
+    ("R1", "R4"), ("R4", "R1"), ("R2", "R3"), ("R3", "R2"),
+    ("S3", "S4"), ("S4", "S3"), ("R1", "R3"), ("R3", "R1"),
+    ("S6", "R1"), ("R1", "S6"), ("R2", "S4"), ("S4", "R2"),
+    ("h6", "S6"), ("S6", "h6"), ("S6", "R4"), ("R4", "S6"),
+    ("R4", "R3"), ("R3", "R4"), ("R3", "S4"), ("S4", "R3"),
+    ("S4", "h4"), ("h4", "S4"), ("R4", "S5"), ("S5", "R4"),
+    ("S5", "R3"), ("R3", "S5"), ("S5", "h5"), ("h5", "S5"),
+]
+
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TOPO = os.path.join(UTILS_DIR, "..", "build", "topology.db")
+DEFAULT_LINK_INFO = os.path.expanduser(
+    "~/mini_internet_project/platform/groups/link_info.txt")
+VIEWS = ["auto", "diagram", "top", "stream"]
+SYSFS_COUNTER = "/sys/class/net/{}/statistics/tx_bytes"
+
+# Binary time series: magic, header length, JSON header, then the samples.
+SERIES_MAGIC = b"MON1"
+HEADER_LENGTH = struct.Struct("<I")
+
+
+def sample_dtype(num_links):
+    """One sample: time and the tx_bytes counter of every link."""
+    return np.dtype([('time', '<f8'), ('tx_bytes', '<u8', (num_links,))])
+
+
+class SysfsCounters(object):
+    """Read the tx_bytes counters of some interfaces.
+
+    The counter files are opened once; every read is a seek and a read.
+    """
+
+    def __init__(self, interfaces):
+        self.interfaces = list(interfaces)
+        self.fds = [os.open(SYSFS_COUNTER.format(interface), os.O_RDONLY)
+                    for interface in self.interfaces]
+        self.values = np.zeros(len(self.fds), dtype=np.uint64)
+
+    def read(self):
+        """Return the current counters. The array is reused by the next read."""
+        for index, fd in enumerate(self.fds):
+            os.lseek(fd, 0, os.SEEK_SET)
+            self.values[index] = int(os.read(fd, 32))
+        return self.values
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+class LinkMonitor(object):
+    """Sample the counters of some links and keep smoothed rates.
+
+    Args:
+        links (list(tuple(str, str))): Directed links.
+        interfaces (list(str)): Interface sending the traffic of each link.
+        capacity (int): Number of samples kept in memory.
+        alpha (float): Weight of the newest rate in the EWMA.
+    """
+
+    def __init__(self, links, interfaces, capacity=64, alpha=0.3):
+        self.links = list(links)
+        self.interfaces = list(interfaces)
+        self.counters = SysfsCounters(self.interfaces)
+        self.series = RingBuffer(capacity, sample_dtype(len(self.links)))
+        self.alpha = alpha
+        # Smoothed rates in bit/s.
+        self.rates = np.zeros(len(self.links))
+        # Time of the newest sample.
+        self.time = None
+        self._previous = None
+
+    def sample(self):
+        """Read all counters, update the rates and return the sample."""
+        now = time.time()
+        counters = self.counters.read()
+        if self._previous is not None and now > self._previous[0]:
+            # Counters restart at 0 if an interface is re-created.
+            delta = np.maximum(counters.astype(np.int64) - self._previous[1], 0)
+            rates = delta * 8.0 / (now - self._previous[0])
+            if len(self.series) > 1:
+                self.rates += self.alpha * (rates - self.rates)
+            else:
+                self.rates[:] = rates
+        self._previous = (now, counters.astype(np.int64))
+        self.time = now
+        self.series.append((now, counters))
+        return now, counters
+
+    def close(self):
+        self.counters.close()
+
+
+class SeriesWriter(object):
+    """Append samples to a binary time series.
+
+    Samples are buffered and written `buffer_size` at a time.
+    """
+
+    def __init__(self, out_file, links, interfaces, buffer_size=1024):
+        self.file = open(out_file, 'wb')
+        header = json.dumps({'links': links, 'interfaces': interfaces})
+        header = header.encode('utf-8')
+        self.file.write(SERIES_MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+        self.buffer = np.zeros(buffer_size, dtype=sample_dtype(len(links)))
+        self.count = 0
+
+    def append(self, now, counters):
+        self.buffer[self.count] = (now, counters)
+        self.count += 1
+        if self.count == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer[:self.count].tobytes())
+        self.file.flush()
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def load_samples(file_name):
+    """Read a time series written by `SeriesWriter`.
 
-        for (src, dst), intf in link_intf.items():
-            link_traffic[(src, dst)].append((time.time(), net_stats[intf].bytes_sent*8))
-            if len(link_traffic[(src, dst)]) > 10:
-                link_traffic[(src, dst)].pop(0)
+    Returns:
+        tuple(list, numpy.ndarray): Links and samples with the fields `time`
+            and `tx_bytes` (one column per link).
+    """
+    with open(file_name, 'rb') as series:
+        if series.read(len(SERIES_MAGIC)) != SERIES_MAGIC:
+            raise ValueError("{} is not a link time series".format(file_name))
+        length, = HEADER_LENGTH.unpack(series.read(HEADER_LENGTH.size))
+        header = json.loads(series.read(length).decode('utf-8'))
+        links = [tuple(link) for link in header['links']]
+        samples = np.fromfile(series, dtype=sample_dtype(len(links)))
+    return links, samples
 
 
-        for src, dst in LINKS.keys():
-            t = link_traffic[(NODE_TO_CONTAINER[src], NODE_TO_CONTAINER[dst])]
+def read_link_info(path):
+    """Map directed links between containers to their sending interface."""
+    link_intf = {}
+    with open(path, 'r') as fd:
+        for line in fd:
+            linetab = line.rstrip('\n').split(' ')
+            node1 = linetab[1]
+            node2 = linetab[4]
+            link_intf[(node1, node2)] = linetab[6]
+            link_intf[(node2, node1)] = linetab[3]
+    return link_intf
 
-            if len(t) > 1:
-                duration = float(t[-1][0] - t[0][0])
-                traffic = float(t[-1][1] - t[0][1])
-                # print '{} --> {}: {} Mbit/s'.format(src, dst, "{:.1f}".format((traffic/duration)/1000000))
-                LINKS[(src, dst)] = "{:.1f}".format((traffic/duration)/1000000) if (traffic/duration)/1000000 < 10 else str(int((traffic/duration)/1000000))+'.'
 
-        time.sleep(0.1)
-        if i == 5:
-            print_traffic()
-            i = 0
+def container_names(index, group=1):
+    """Container of every node: `<group>_<node>router` for routers and
+    switches, `<group>_<gateway>host` for hosts."""
+    containers = {}
+    for node, node_type in index["types"].items():
+        if node_type == "host":
+            gateway = index["adjacency"][node][0]
+            containers[node] = "{}_{}host".format(group, gateway)
         else:
-            i += 1
-            
-    except:
+            containers[node] = "{}_{}router".format(group, node)
+    return containers
+
+
+def load_links(topo_db, link_info, group=1):
+    """Directed links of the topology with their interface and bandwidth.
+
+    Returns:
+        tuple(list, list, numpy.ndarray): Links, the interface sending the
+            traffic of each link, and the bandwidth of each link in Mbit/s
+            (NaN if not configured).
+    """
+    index = load_topology_index(topo_db)
+    containers = container_names(index, group)
+    link_intf = read_link_info(link_info)
+
+    links, interfaces, bandwidths = [], [], []
+    for src in sorted(index["adjacency"]):
+        for dst in index["adjacency"][src]:
+            interface = link_intf.get((containers[src], containers[dst]))
+            if interface is None:
+                log("No interface for link {}-{} in {}".format(
+                    src, dst, link_info))
+                continue
+            links.append((src, dst))
+            interfaces.append(interface)
+            bandwidths.append(index["bw"][src].get(dst) or np.nan)
+    return links, interfaces, np.array(bandwidths, dtype=float)
+
+
+def log(message):
+    print(message, file=sys.stderr)
+
+
+def format_rate(rate):
+    """Rate in Mbit/s, short enough for the topology drawing."""
+    mbps = rate / 1000000
+    return "{:.1f}".format(mbps) if mbps < 10 else str(int(mbps)) + '.'
+
+
+def clear_screen():
+    # An escape sequence instead of a `clear` subprocess.
+    sys.stdout.write("\033[H\033[2J")
+
+
+class DiagramView(object):
+    """Redraw the hand-drawn topology with the smoothed rates."""
+
+    def __init__(self, links):
+        positions = dict((link, index) for index, link in enumerate(links))
+        self.indices = np.array([positions[link] for link in DIAGRAM_LINKS])
+
+    @staticmethod
+    def matches(links):
+        """Whether all links of the diagram are monitored."""
+        return set(DIAGRAM_LINKS) <= set(links)
+
+    def __call__(self, monitor):
+        clear_screen()
+        print(topo_string.format(
+            *[format_rate(rate) for rate in monitor.rates[self.indices]]))
+        sys.stdout.flush()
+
+
+class TopView(object):
+    """Table of the busiest links and their utilization."""
+
+    def __init__(self, links, bandwidths, top=20):
+        self.names = ["{}->{}".format(src, dst) for src, dst in links]
+        self.bandwidths = bandwidths
+        self.top = top
+
+    def __call__(self, monitor):
+        rates = monitor.rates
+        top = min(self.top, len(rates))
+        # Only sort the busiest links.
+        busiest = np.argpartition(-rates, top - 1)[:top]
+        busiest = busiest[np.argsort(-rates[busiest])]
+        utilization = 100 * rates[busiest] / (self.bandwidths[busiest] * 1e6)
+
+        lines = ["{:<20} {:>10} {:>10} {:>7}".format(
+            "Link", "Mbit/s", "bw Mbit/s", "Util %")]
+        for index, util in zip(busiest, utilization):
+            lines.append("{:<20} {:>10.1f} {:>10.0f} {:>7.1f}".format(
+                self.names[index], rates[index] / 1e6,
+                self.bandwidths[index], util))
+        clear_screen()
+        print("{} links, {:.1f} Gbit/s in total\n".format(
+            len(rates), rates.sum() / 1e9))
+        print("\n".join(lines))
+        sys.stdout.flush()
+
+
+class StreamView(object):
+    """JSON lines: the links and bandwidths once, then the rates in bit/s."""
+
+    def __init__(self, links, bandwidths, out=sys.stdout):
+        self.out = out
+        self.out.write(json.dumps({
+            'links': ["{}->{}".format(src, dst) for src, dst in links],
+            'bw': [None if np.isnan(bw) else bw for bw in bandwidths],
+        }) + "\n")
+
+    def __call__(self, monitor):
+        self.out.write(json.dumps({
+            'time': round(monitor.time, 6),
+            'bps': np.round(monitor.rates).astype(np.int64).tolist(),
+        }) + "\n")
+        self.out.flush()
+
+
+def get_view(view, links, bandwidths, top):
+    if view == "auto":
+        view = "diagram" if DiagramView.matches(links) else "top"
+    if view == "diagram":
+        if not DiagramView.matches(links):
+            raise ValueError("The diagram only shows the default topology")
+        return DiagramView(links)
+    if view == "top":
+        return TopView(links, bandwidths, top)
+    return StreamView(links, bandwidths)
+
+
+def run(monitor, interval, view=None, redraw_every=1, writer=None):
+    """Sample every interval until interrupted.
+
+    Args:
+        monitor (LinkMonitor): Links to sample.
+        interval (float): Seconds between two samples.
+        view (callable): Called with the monitor to show the rates.
+        redraw_every (int): Samples between two calls of the view.
+        writer (SeriesWriter): If given, all samples are written to it.
+    """
+    next_sample = time.time()
+    samples = 0
+    while True:
+        now, counters = monitor.sample()
+        if writer is not None:
+            writer.append(now, counters)
+        samples += 1
+        if view is not None and samples % redraw_every == 0:
+            view(monitor)
+
+        # Sample on a fixed schedule, skip samples we could not keep up with.
+        next_sample += interval
+        delay = next_sample - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_sample = time.time()
+
+
+if __name__ == "__main__":
+    # pylint: disable=invalid-name
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--topo', help='Topo path name',
+                        type=str, required=False, default=DEFAULT_TOPO)
+    parser.add_argument('--link-info', help='Interfaces of the links',
+                        type=str, required=False, default=DEFAULT_LINK_INFO)
+    parser.add_argument('--group', help='Group number in the container names',
+                        type=int, required=False, default=1)
+    parser.add_argument('--view', help='How to show the rates',
+                        type=str, required=False, default="auto", choices=VIEWS)
+    parser.add_argument('--top', help='Number of links in the top view',
+                        type=int, required=False, default=20)
+    parser.add_argument('--interval', help='Seconds between two samples',
+                        type=float, required=False, default=0.1)
+    parser.add_argument('--redraw-every', help='Samples between two redraws',
+                        type=int, required=False, default=6)
+    parser.add_argument('--alpha', help='Weight of the newest rate in the EWMA',
+                        type=float, required=False, default=0.3)
+    parser.add_argument('--capacity', help='Samples kept in memory',
+                        type=int, required=False, default=64)
+    parser.add_argument('--headless', help='Do not show rates, only record samples',
+                        action='store_true', required=False, default=False)
+    parser.add_argument('--out', help='Binary time series of all samples',
+                        type=str, required=False, default=None)
+    args = parser.parse_args()
+
+    if args.headless and not args.out:
+        parser.error("--headless requires --out")
+    if not os.path.isfile(args.link_info) or not os.path.isfile(args.topo):
+        print('You must build the virtual network before running the monitoring script.')
+        sys.exit(0)
+
+    links, interfaces, bandwidths = load_links(
+        args.topo, args.link_info, args.group)
+    view = None
+    if not args.headless:
+        try:
+            view = get_view(args.view, links, bandwidths, args.top)
+        except ValueError as error:
+            parser.error(str(error))
+
+    # Stop like on an interrupt, so that the time series is complete.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    writer = None
+    try:
+        monitor = LinkMonitor(links, interfaces, args.capacity, args.alpha)
+        if args.out:
+            writer = SeriesWriter(args.out, links, interfaces)
+        run(monitor, args.interval, view, args.redraw_every, writer)
+    except (IOError, OSError):
         print("There is no network to monitor!")
-        break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if writer is not None:
+            writer.close()
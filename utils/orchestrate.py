@@ -11,35 +11,41 @@ from tempfile import mkdtemp
 from p4utils.utils.topology import Topology
 
 from generate_failures import Failures
-from generate_traffic import Receivers, Senders
-from utils import NODE_TO_CONTAINER
+from generate_traffic import (BACKENDS, DEFAULT_MAX_WORKERS, Receivers,
+                              Senders, get_backend)
+from utils import NODE_TO_CONTAINER, read_traffic_spec
 
 
 class Orchestrator(object):
     """Load the traffic matrix and generate everything."""
     fieldnames = ["src_name", "dst_name", "src", "dst", "sport", "tos",
                   "dport", "rate", "duration", "packet_size", "start_time"]
+    # Per-flow sender/receiver options, passed on if the traffic spec has them.
+    optional_fieldnames = ["batch_size", "high_rate", "log_format", "timestamps"]
 
-    def __init__(self, traffic, failures, db):
+    def __init__(self, traffic, failures, db, backend="docker",
+                 max_workers=DEFAULT_MAX_WORKERS, host_root="",
+                 script_dir="/home"):
         self.topo = Topology(db)
+        # Options for starting senders and receivers on the hosts.
+        self.host_options = dict(backend=get_backend(backend),
+                                 max_workers=max_workers, root=host_root,
+                                 script_dir=script_dir)
         self.traffic_spec = traffic
         self.failure_spec = failures
         self.failures = {}
-        self.senders = {}
-        self.receivers = {}
 
     def start(self):
         """Start senders, receivers, and failures."""
         # We need to parse now, to give everything the same t0 == now
         current_time = time.time()
-        self._parse_traffic(self.traffic_spec, current_time)
-        self._parse_failures(self.failure_spec, current_time)
-
         tempdir = mkdtemp()
-        sender_configs, receiver_configs = self._create_files(tempdir)
+        sender_configs, receiver_configs = self._parse_traffic(
+            self.traffic_spec, current_time, tempdir)
+        self._parse_failures(self.failure_spec, current_time)
 
-        senders = Senders(sender_configs)
-        receivers = Receivers(receiver_configs)
+        senders = Senders(sender_configs, **self.host_options)
+        receivers = Receivers(receiver_configs, **self.host_options)
         failures = Failures(self.topo, self.failures)
         try:
             failures.start()
@@ -68,25 +74,55 @@ class Orchestrator(object):
             shutil.rmtree(tempdir)
             signal.signal(signal.SIGINT, handler)
 
-    def _parse_traffic(self, matrix, current_time):
-        """Parse the traffic matrix into sub-dicts for senders and receivers."""
-        self.senders = {}
-        self.receivers = {}
+    def _parse_traffic(self, matrix, current_time, directory):
+        """Split the traffic matrix into config files for senders and receivers.
 
-        with open(matrix, 'rb') as csvfile:
-            dialect = csv.Sniffer().sniff(csvfile.read(1024))
-            csvfile.seek(0)
-            reader = csv.DictReader(csvfile, dialect=dialect)
-            for row in reader:
+        Flows are streamed from the matrix to the per-host files, so large
+        matrices are never held in memory. The files have enumerated names:
+        s0, s1, ...; r0, r1, ... .
+
+        Args:
+            matrix(str): Traffic spec.
+            current_time(float): Time all start times are relative to.
+            directory(str): Directory for all files.
+        Returns:
+            dict, dict: Mappings of senders/receivers to config files.
+        """
+        host_ips = {}
+        writers = {}
+        files = []
+        configs = {'s': {}, 'r': {}}
+        try:
+            for row in read_traffic_spec(matrix):
                 # Re-format rows
                 row['src_name'] = row['src']
                 row['dst_name'] = row['dst']
-                row['src'] = self.topo.get_host_ip(row['src'])
-                row['dst'] = self.topo.get_host_ip(row['dst'])
+                for field in ('src', 'dst'):
+                    name = row[field]
+                    if name not in host_ips:
+                        host_ips[name] = self.topo.get_host_ip(name)
+                    row[field] = host_ips[name]
                 row['start_time'] = current_time + \
                     float(row['start_time'])
-                self.senders.setdefault(row['src_name'], []).append(row)
-                self.receivers.setdefault(row['dst_name'], []).append(row)
+
+                for prefix, host in (('s', row['src_name']), ('r', row['dst_name'])):
+                    if (prefix, host) not in writers:
+                        filename = path.join(
+                            directory, "%s%s" % (prefix, len(configs[prefix])))
+                        csvfile = open(filename, 'w')
+                        files.append(csvfile)
+                        fieldnames = self.fieldnames + [
+                            name for name in self.optional_fieldnames if name in row]
+                        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+                        writer.writeheader()
+                        writers[(prefix, host)] = writer
+                        configs[prefix][NODE_TO_CONTAINER[host]] = filename
+                    writers[(prefix, host)].writerow(row)
+        finally:
+            for csvfile in files:
+                csvfile.close()
+
+        return configs['s'], configs['r']
 
     def _parse_failures(self, failures, current_time):
         """Parse the failure spec file."""
@@ -102,32 +138,6 @@ class Orchestrator(object):
             self.failures['end_time'] = (
                 float(self.failures['end_time']) + current_time)
 
-    def _create_files(self, directory):
-        """Create sender and receiver files.
-
-        The files will simply have enumerated names: s0, s1, ...; r0, r1, ... .
-
-        Args:
-            directory(str): Directory for all files.
-        Returns:
-            dict, dict: Mappings of senders/receivers to config files.
-        """
-        sender_configs = {}
-        receiver_configs = {}
-        for data, config, prefix in [
-            (self.senders, sender_configs, 's'),
-            (self.receivers, receiver_configs, 'r')
-        ]:
-            for index, (host, rows) in enumerate(data.items()):
-                filename = path.join(directory, "%s%s" % (prefix, index))
-                with open(filename, 'w') as csvfile:
-                    writer = csv.DictWriter(
-                        csvfile, fieldnames=self.fieldnames)
-                    writer.writeheader()
-                    writer.writerows(rows)
-                config[NODE_TO_CONTAINER[host]] = filename
-        return sender_configs, receiver_configs
-
 
 if __name__ == "__main__":
     # pylint: disable=invalid-name
@@ -141,11 +151,30 @@ if __name__ == "__main__":
     parser.add_argument('--failure-spec',
                         help='Failure generation specification',
                         type=str, required=True)
+    parser.add_argument('--backend',
+                        help='How to run commands on the hosts',
+                        type=str, required=False, default="docker",
+                        choices=BACKENDS)
+    parser.add_argument('--max-workers',
+                        help='Maximum number of parallel host commands',
+                        type=int, required=False,
+                        default=DEFAULT_MAX_WORKERS)
+    parser.add_argument('--host-root',
+                        help='Prefix of the host paths, may contain {host} '
+                             '(e.g. a directory per host with --backend local)',
+                        type=str, required=False, default="")
+    parser.add_argument('--script-dir',
+                        help='Directory of schedule_flows.py on the hosts',
+                        type=str, required=False, default="/home")
     args = parser.parse_args()
 
     orchestrator = Orchestrator(
         args.traffic_spec,
         args.failure_spec,
         args.topo,
+        backend=args.backend,
+        max_workers=args.max_workers,
+        host_root=args.host_root,
+        script_dir=args.script_dir,
     )
     orchestrator.start()
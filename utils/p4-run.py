@@ -1,6 +1,9 @@
 import os
+import socket
 import time
 import argparse
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from p4utils.utils.utils import *
 from utils import check_output_cmd_docker, NODE_TO_CONTAINER, run_cmd_docker, run_command
 from p4utils import FAILED_STATUS, SUCCESS_STATUS
@@ -9,13 +12,36 @@ from p4utils.utils.topology import Topology
 MAIN_SHARED_PATH = "/home/adv-net/infrastructure/shared/"
 HOSTS_SHARED_PATH = "/home/"
 
+# Phases of a switch start, in order.
+PHASES = ["compile", "launch", "ready", "populate"]
+
+
+def wait_for_thrift(thrift_ip, thrift_port, timeout, interval=0.05):
+    """Poll until the thrift server of a switch accepts connections.
+
+    Returns:
+        bool: False if the server did not come up within the timeout.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            sock = socket.create_connection((thrift_ip, int(thrift_port)),
+                                            timeout=1)
+            sock.close()
+            return True
+        except socket.error:
+            if time.time() >= deadline:
+                return False
+            time.sleep(interval)
+
 
 class AppRunner(object):
 
     """Class for running P4 applications.
     """
 
-    def __init__(self, conf_file, topology_file, log_enabled, pcap_enabled):
+    def __init__(self, conf_file, topology_file, log_enabled, pcap_enabled,
+                 workers=8, ready_timeout=30):
 
         self.config = load_conf(conf_file)
         self.topo = Topology(db=topology_file)
@@ -28,6 +54,12 @@ class AppRunner(object):
         self.pcap_log = pcap_enabled
         self.switch_log = log_enabled
 
+        # Switches started in parallel, and seconds to wait for each.
+        self.workers = workers
+        self.ready_timeout = ready_timeout
+        # Seconds per phase, for every started switch.
+        self.timings = {}
+
     def compile_program(self, switch_name):
 
         # load default configuration
@@ -63,17 +95,44 @@ class AppRunner(object):
         self.already_compiled.add(p4source_path_source)
         return output_file
 
-    def start_switch(self, switch_name):
+    def _timed(self, switch_name, phase, function, *args):
+        """Call a function and add its duration to a phase of a switch."""
+        start = time.time()
+        result = function(*args)
+        timings = self.timings.setdefault(switch_name, OrderedDict())
+        timings[phase] = timings.get(phase, 0) + time.time() - start
+        return result
 
+    def start_switch(self, switch_name):
+        """Compile, launch, wait until ready and populate a switch."""
         if switch_name not in self.topo.get_switches():
             print('Switch {} does not exist'.format(switch_name))
-            return self.failed_status()
-
-        switch_config = self.config['switches'][switch_name]
-
-        # compile program
-        compiled_program = self.compile_program(switch_name)
-
+            return FAILED_STATUS
+
+        compiled_program = self._timed(
+            switch_name, "compile", self.compile_program, switch_name)
+        if compiled_program == -1:
+            return FAILED_STATUS
+        return self._start_compiled(switch_name, compiled_program)
+
+    def _start_compiled(self, switch_name, compiled_program):
+        self._timed(switch_name, "launch",
+                    self.launch_switch, switch_name, compiled_program)
+
+        thrift_port = self.topo.get_thrift_port(switch_name)
+        thrift_ip = self.topo.get_thrift_ip(switch_name)
+        ready = self._timed(switch_name, "ready", wait_for_thrift,
+                            thrift_ip, thrift_port, self.ready_timeout)
+        if not ready:
+            print('Switch {} is not ready after {}s\n'.format(
+                switch_name, self.ready_timeout))
+            return FAILED_STATUS
+
+        return self._timed(switch_name, "populate",
+                           self.populate_switch, switch_name)
+
+    def launch_switch(self, switch_name, compiled_program):
+        """Start the switch in its container, without waiting for it."""
         # copy json to docker container
         os.system("cp {} {}".format(compiled_program,
                                     self.main_shared_path+"/" + switch_name + "/"))
@@ -88,9 +147,11 @@ class AppRunner(object):
 
         shared_base_path = HOSTS_SHARED_PATH
 
-        # create pcap dir even if not saving pcaps
+        # create pcap and log dirs even if not saving pcaps or logging
         pcap_path = "{}/pcap".format(shared_base_path)
-        run_cmd_docker(switch_name, "mkdir -p " + pcap_path)
+        log_path = "{}/logs/".format(shared_base_path)
+        run_cmd_docker(switch_name,
+                       "mkdir -p {} {}".format(pcap_path, log_path), "")
         if self.pcap_log:
             args.append("--pcap="+pcap_path)
 
@@ -107,9 +168,6 @@ class AppRunner(object):
         docker_json_file = shared_base_path + compiled_program.split("/")[-1]
         args.append(docker_json_file)
 
-        # we create the log dir even if not logging
-        log_path = "{}/logs/".format(shared_base_path)
-        run_cmd_docker(switch_name, "mkdir -p " + log_path)
         if self.switch_log:
             log_file = "{}/{}.txt".format(log_path, switch_name)
             args.append("--log-console")
@@ -123,15 +181,15 @@ class AppRunner(object):
         print(cmd)
         run_cmd_docker(switch_name, cmd + " & ", "")
 
-        time.sleep(2)
-
-        # populate static tables
+    def populate_switch(self, switch_name):
+        """Add the static table entries of the switch, if any."""
+        switch_config = self.config['switches'][switch_name]
         commands_path = switch_config.get('cli_input', None)
         if commands_path:
             if not os.path.exists(commands_path):
                 print('File Error: commands file %s does not exist\n' %
                       commands_path)
-                return -1
+                return FAILED_STATUS
 
             entries = read_entries(commands_path)
             cli_outfile = '{}/{}/logs/{}_cli_output.log'.format(
@@ -139,6 +197,7 @@ class AppRunner(object):
             thrift_port = str(self.topo.get_thrift_port(switch_name))
             thrift_ip = self.topo.get_thrift_ip(switch_name)
             add_entries(thrift_port, entries, cli_outfile, thrift_ip=thrift_ip)
+        return SUCCESS_STATUS
 
     def stop_switch(self, switch_name):
         run_cmd_docker(
@@ -149,8 +208,50 @@ class AppRunner(object):
         self.start_switch(switch_name)
 
     def start_switches(self):
-        for switch in self.topo.get_switches():
-            self.start_switch(switch)
+        """Start all switches in parallel.
+
+        Programs are compiled first, one at a time, as switches usually
+        share them. Then every switch is launched, and its tables are
+        populated as soon as its thrift server is up.
+        """
+        start = time.time()
+        switches = sorted(self.topo.get_switches())
+        programs = {}
+        for switch in switches:
+            programs[switch] = self._timed(
+                switch, "compile", self.compile_program, switch)
+
+        def start_compiled(switch):
+            if programs[switch] == -1:
+                return FAILED_STATUS
+            return self._start_compiled(switch, programs[switch])
+
+        pool = ThreadPool(max(1, min(self.workers, len(switches))))
+        try:
+            results = pool.map(start_compiled, switches)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.report_timings(switches)
+        failed = [switch for switch, result in zip(switches, results)
+                  if result == FAILED_STATUS]
+        print("Started {} of {} switches in {:.1f}s".format(
+            len(switches) - len(failed), len(switches), time.time() - start))
+        if failed:
+            print("Failed: {}".format(", ".join(failed)))
+            return FAILED_STATUS
+        return SUCCESS_STATUS
+
+    def report_timings(self, switches):
+        """Print the seconds spent in every phase, per switch."""
+        print("{:<10}".format("Switch") +
+              "".join("{:>10}".format(phase) for phase in PHASES))
+        for switch in switches:
+            timings = self.timings.get(switch, {})
+            print("{:<10}".format(switch) + "".join(
+                "{:>10.2f}".format(timings[phase]) if phase in timings
+                else "{:>10}".format("-") for phase in PHASES))
 
     def stop_switches(self):
         # dirty way
@@ -179,6 +280,11 @@ def get_args():
                         help='Enables logging if the switch allows it')
     parser.add_argument('--pcap', action='store_true',
                         help='Enables logging if the switch allows it')
+    parser.add_argument('--workers', help='Switches to start in parallel',
+                        type=int, required=False, default=8)
+    parser.add_argument('--ready-timeout',
+                        help='Seconds to wait for the thrift server of a switch',
+                        type=float, required=False, default=30)
 
     return parser.parse_args()
 
@@ -186,13 +292,15 @@ def get_args():
 if __name__ == '__main__':
 
     args = get_args()
-    runner = AppRunner(args.config, args.topo, args.log, args.pcap)
+    runner = AppRunner(args.config, args.topo, args.log, args.pcap,
+                       args.workers, args.ready_timeout)
 
     if args.cmd == "start":
         if args.target == "all":
             runner.start_switches()
         else:
             runner.start_switch(args.target)
+            runner.report_timings([args.target])
     elif args.cmd == "stop":
         if args.target == "all":
             runner.stop_switches()
@@ -1,12 +1,35 @@
 """Computes the performance of your run
 
-Example usage: python2 performance.py --traffic-spec ../scenarios/default.traffic
+Example usage: python3 performance.py --traffic-spec ../scenarios/default.traffic
 
 """
 
 import argparse
 import csv
+import itertools
+import json
+import os
 from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+
+from udp import (LOG_FORMATS, RANGES_MAGIC, RECORDS_MAGIC, WIRE_OVERHEAD,
+                 clamp_packet_size, datagram_size, maxUDPSize, sequence_log_path)
+from units import setSizeToInt
+from utils import read_traffic_spec
+
+# Per-flow counts are cached in the log directory, keyed by file mtime and size.
+CACHE_FILE = ".performance_cache.json"
+# Flows are read and scored in chunks of this size.
+CHUNK_SIZE = 1024
+
+# Columns of the analytics outputs.
+FLOW_COLUMNS = ["src", "dst", "sport", "dport", "tos", "sent", "delivered",
+                "lost", "loss", "duplicates", "reordered", "reorder_depth",
+                "gaps", "longest_gap", "longest_gap_start", "longest_gap_end"]
+GAP_COLUMNS = ["start", "end", "packets", "first_seq", "src", "dst", "sport",
+               "dport", "tos"]
 
 
 traffic_weights = {
@@ -21,44 +44,269 @@ traffic_names = OrderedDict([
     ("32",  "Bronze")
 ])
 
+
+def load_sequence_array(file_name):
+    """Loads a sequence log (text or binary) into a NumPy array.
+
+    Binary record logs are memory-mapped, ranges are expanded.
+    """
+    with open(file_name, "rb") as f:
+        magic = f.read(len(RANGES_MAGIC))
+
+    if magic == RECORDS_MAGIC:
+        if os.path.getsize(file_name) == len(RECORDS_MAGIC):
+            return np.zeros(0, dtype=np.uint32)
+        return np.memmap(file_name, dtype="<u4", mode="r",
+                         offset=len(RECORDS_MAGIC))
+    elif magic == RANGES_MAGIC:
+        bounds = np.fromfile(file_name, dtype="<u4")[1:].reshape(-1, 2)
+        if not len(bounds):
+            return np.zeros(0, dtype=np.uint32)
+        return np.concatenate([np.arange(int(start), int(end) or 1 << 32, dtype=np.uint32)
+                               for start, end in bounds])
+
+    with open(file_name, "r") as f:
+        return np.fromstring(f.read(), dtype=np.int64, sep=" ")
+
+
+def count_flow(sender_path, receiver_path):
+    """Counts sent and delivered packets of one flow.
+
+    Both logs are turned into bitmaps indexed by sequence number, so
+    duplicates and packets not sent by this sender are ignored.
+
+    Returns:
+        tuple: unique packets sent, unique sent packets received
+    """
+    sent = load_sequence_array(sender_path)
+    received = load_sequence_array(receiver_path)
+    if not len(sent):
+        return 0, 0
+
+    size = int(sent.max()) + 1
+    sent_bitmap = np.zeros(size, dtype=bool)
+    sent_bitmap[sent] = True
+
+    received = received[received < size]
+    received_bitmap = np.zeros(size, dtype=bool)
+    received_bitmap[received] = True
+
+    return (int(np.count_nonzero(sent_bitmap)),
+            int(np.count_nonzero(sent_bitmap & received_bitmap)))
+
+
+def _count_flow_cached(args):
+    """Counts a flow, unless its cached counts are still valid.
+
+    Returns:
+        tuple: counts and whether they were computed
+    """
+    paths, file_key, entry = args
+    if entry is not None and entry["files"] == file_key:
+        return tuple(entry["counts"]), False
+    return count_flow(*paths), True
+
+
+def analyze_flow(flow, sender_path, receiver_path, top_gaps=5):
+    """Loss, duplicates, reordering and loss bursts of one flow.
+
+    The receiver log is processed in arrival order. A packet is reordered if
+    a higher sequence number arrived before it; its depth is the difference
+    to the highest sequence number seen so far. Runs of consecutive missing
+    sequence numbers are mapped to time with the sending rate of the flow,
+    in the time base of the traffic spec (seconds after the experiment start).
+
+    Args:
+        flow (dict): Flow of the traffic spec.
+        sender_path (str): Sender log.
+        receiver_path (str): Receiver log.
+        top_gaps (int): Number of longest gaps to return.
+
+    Returns:
+        tuple(dict, list(dict)): Flow row and the longest gaps.
+    """
+    sent = load_sequence_array(sender_path)
+    received = np.asarray(load_sequence_array(receiver_path), dtype=np.int64)
+
+    size = int(sent.max()) + 1 if len(sent) else 0
+    sent_bitmap = np.zeros(size, dtype=bool)
+    sent_bitmap[sent] = True
+    received = received[received < size]
+
+    # First arrival of each sequence number, in arrival order.
+    _, first = np.unique(received, return_index=True)
+    first.sort()
+    duplicates = len(received) - len(first)
+    arrivals = received[first]
+
+    reordered, reorder_depth = 0, 0
+    if len(arrivals) > 1:
+        highest = np.maximum.accumulate(arrivals)[:-1]
+        depth = highest - arrivals[1:]
+        late = depth > 0
+        reordered = int(np.count_nonzero(late))
+        reorder_depth = int(depth[late].max()) if reordered else 0
+
+    missing = sent_bitmap.copy()
+    missing[arrivals] = False
+    missing_seqs = np.flatnonzero(missing)
+    gaps = []
+    gap_count = 0
+    if len(missing_seqs):
+        breaks = np.flatnonzero(np.diff(missing_seqs) != 1) + 1
+        starts = missing_seqs[np.concatenate(([0], breaks))]
+        lengths = np.diff(np.concatenate(([0], breaks, [len(missing_seqs)])))
+        gap_count = len(starts)
+        # Same bytes per packet as the Pacer of the sender.
+        packet_size = clamp_packet_size(flow.get("packet_size") or maxUDPSize)
+        wire_size = datagram_size(packet_size) + WIRE_OVERHEAD
+        packets_per_second = setSizeToInt(flow["rate"].strip()) / 8.0 / wire_size
+        start_time = float(flow.get("start_time") or 0)
+        for index in np.argsort(-lengths, kind="mergesort")[:top_gaps]:
+            first_seq, packets = int(starts[index]), int(lengths[index])
+            gaps.append({
+                "start": start_time + first_seq / packets_per_second,
+                "end": start_time + (first_seq + packets) / packets_per_second,
+                "packets": packets,
+                "first_seq": first_seq,
+            })
+
+    sent_count = int(np.count_nonzero(sent_bitmap))
+    delivered = len(arrivals)
+    row = {key: flow[key] for key in ("src", "dst", "sport", "dport", "tos")}
+    row.update({
+        "sent": sent_count,
+        "delivered": delivered,
+        "lost": sent_count - delivered,
+        "loss": float(sent_count - delivered) / sent_count if sent_count else 0.0,
+        "duplicates": duplicates,
+        "reordered": reordered,
+        "reorder_depth": reorder_depth,
+        "gaps": gap_count,
+        "longest_gap": gaps[0]["packets"] if gaps else 0,
+        "longest_gap_start": gaps[0]["start"] if gaps else "",
+        "longest_gap_end": gaps[0]["end"] if gaps else "",
+    })
+    for gap in gaps:
+        gap.update({key: row[key] for key in ("src", "dst", "sport", "dport", "tos")})
+    return row, gaps
+
+
+def _analyze_flow_args(args):
+    return analyze_flow(*args)
+
+
+def _file_key(file_name):
+    stat = os.stat(file_name)
+    return [stat.st_mtime, stat.st_size]
+
+
 class Performance(object):
     """Load the traffic matrix and generate everything."""
 
-    def __init__(self, traffic, out_path):
+    def __init__(self, traffic, out_path, processes=None, use_cache=True):
         self.traffic_spec = traffic
         self.out_path = out_path
-        self.flows = self._load_traffic_spec()
+        self.processes = processes
+        self.use_cache = use_cache
         self._count_points()
 
     def _load_traffic_spec(self):
-        """Loads traffic matrix spec"""
+        """Iterates over the flows of the traffic matrix spec, without loading it"""
+
+        return read_traffic_spec(self.traffic_spec)
+
+    def _flow_paths(self, flow):
+        """ Sender and receiver log paths of a flow"""
+
+        return (self._log_path("sender", flow["src"], flow),
+                self._log_path("receiver", flow["dst"], flow))
+
+    def _log_path(self, role, host, flow):
+        """ Log of the flow's log format, else of any format that exists"""
+
+        paths = [sequence_log_path("{}/{}".format(self.out_path, host), role, flow["src"],
+                                   flow["dst"], flow["sport"], flow["dport"], log_format)
+                 for log_format in [flow.get("log_format") or "text"] + LOG_FORMATS]
+        for path in paths:
+            if os.path.exists(path):
+                return path
+        return paths[0]
 
-        flows = []
-        with open(self.traffic_spec, 'r') as csvfile:
-            dialect = csv.Sniffer().sniff(csvfile.read(1024))
-            csvfile.seek(0)
-            reader = csv.DictReader(csvfile, dialect=dialect)
-            return list(reader)
+    def _map(self, function, args):
+        """ Lazily maps over args, in a process pool unless processes is 1
 
-    def _read_sequences(self, file_name):
-        """Helper function to read"""
-        
-        with open(file_name, "r") as f:
-            return set([int(x) for x in f.read().split()])
+        Args are consumed in chunks, so only a chunk is in memory at a time.
+        """
+
+        if self.processes == 1:
+            for arg in args:
+                yield function(arg)
+            return
+
+        pool = Pool(self.processes)
+        try:
+            args = iter(args)
+            while True:
+                chunk = list(itertools.islice(args, CHUNK_SIZE))
+                if not chunk:
+                    break
+                for result in pool.map(function, chunk):
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
 
     def _count_flow(self, flow):
         """ Counts the packet in out for a given flow"""
 
-        sender_path = "{}/{}/sender_{}_{}_{}_{}.txt".format(self.out_path, flow["src"],
-                                                         flow["src"], flow["dst"], flow["sport"], flow["dport"])
-        sender_seq =  self._read_sequences(sender_path)                                           
-        receiver_path = "{}/{}/receiver_{}_{}_{}_{}.txt".format(self.out_path, flow["dst"],
-                                                         flow["src"], flow["dst"], flow["sport"], flow["dport"])         
-        receiver_seq =  self._read_sequences(receiver_path)                                          
-        received_and_sent = sender_seq.intersection(receiver_seq)
-
         # returns pkt_in and pkt_out (sent from this sender and not repeated)
-        return len(sender_seq), len(received_and_sent)                                                                                 
+        return count_flow(*self._flow_paths(flow))
+
+    def _load_cache(self):
+        """Loads cached counts, or an empty cache"""
+
+        try:
+            with open(os.path.join(self.out_path, CACHE_FILE), "r") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_cache(self, cache):
+        try:
+            with open(os.path.join(self.out_path, CACHE_FILE), "w") as f:
+                json.dump(cache, f)
+        except (IOError, OSError):
+            # read-only log directory, scoring still works
+            pass
+
+    def _count_flows(self):
+        """ Counts all flows, with cached counts and a process pool
+
+        Yields:
+            tuple: flow and its (pkt_in, pkt_out)
+        """
+
+        cache = self._load_cache() if self.use_cache else {}
+        updated = False
+
+        def _args(flow):
+            paths = self._flow_paths(flow)
+            file_key = _file_key(paths[0]) + _file_key(paths[1])
+            return paths, file_key, cache.get("{}|{}".format(*paths))
+
+        flows, tasks = itertools.tee(
+            (flow, _args(flow)) for flow in self._load_traffic_spec())
+        results = self._map(_count_flow_cached, (args for _, args in tasks))
+        for (flow, (paths, file_key, _)), (counts, computed) in zip(flows, results):
+            if computed:
+                cache["{}|{}".format(*paths)] = {"files": file_key,
+                                                 "counts": list(counts)}
+                updated = True
+            yield flow, counts
+
+        if self.use_cache and updated:
+            self._save_cache(cache)
 
     def _count_points(self):
         """ Counts all flows in/out """
@@ -71,17 +319,50 @@ class Performance(object):
             "32":
             {"pkts_in": 0.0, "pkts_out": 0.0},
         }
-        for flow in self.flows:
+        for flow, (pkt_in, pkt_out) in self._count_flows():
             tos = flow["tos"]
-            pkt_in, pkt_out = self._count_flow(flow)
-        
+
             self._traffic_counts[tos]["pkts_in"] += pkt_in
             self._traffic_counts[tos]["pkts_out"] += pkt_out
     
+    def write_analytics(self, out_file, top_gaps=5):
+        """ Writes per-flow loss analytics and the longest gaps to csv files
+
+        Flows are streamed to out_file, gaps to out_file with a "_gaps"
+        suffix, sorted by start time so they line up with failure events.
+
+        Returns:
+            str: path of the gaps file
+        """
+
+        args = ((flow,) + self._flow_paths(flow) + (top_gaps,)
+                for flow in self._load_traffic_spec())
+        results = self._map(_analyze_flow_args, args)
+
+        base, extension = os.path.splitext(out_file)
+        gaps_file = "{}_gaps{}".format(base, extension or ".csv")
+
+        gaps = []
+        with open(out_file, "w") as f:
+            writer = csv.DictWriter(f, fieldnames=FLOW_COLUMNS)
+            writer.writeheader()
+            for row, flow_gaps in results:
+                writer.writerow(row)
+                gaps.extend(flow_gaps)
+
+        gaps.sort(key=lambda gap: gap["start"])
+        with open(gaps_file, "w") as f:
+            writer = csv.DictWriter(f, fieldnames=GAP_COLUMNS)
+            writer.writeheader()
+            for gap in gaps:
+                writer.writerow(gap)
+
+        return gaps_file
+
     def get_weighted_perfomance(self):
         """ computes final performance """
 
-        self._count_points()
+        # counts are computed once in __init__
         weighted_performance = 0
         for traffic_type, packets in self._traffic_counts.items():
             # type weighted performance
@@ -122,11 +403,28 @@ if __name__ == "__main__":
     parser.add_argument('--out-path',
                         help='Path to flows logs',
                         type=str, required=False, default="/home/adv-net/infrastructure/shared")
+    parser.add_argument('--processes',
+                        help='Number of processes to score flows (default: one per CPU)',
+                        type=int, required=False, default=None)
+    parser.add_argument('--no-cache',
+                        help='Do not use or update the per-flow count cache',
+                        action='store_true', required=False, default=False)
+    parser.add_argument('--analytics',
+                        help='Write per-flow loss, reordering and gap analytics to this csv file',
+                        type=str, required=False, default=None)
+    parser.add_argument('--top-gaps',
+                        help='Number of longest gaps reported per flow',
+                        type=int, required=False, default=5)
 
     args = parser.parse_args()
 
     performance = Performance(
-        args.traffic_spec, args.out_path
+        args.traffic_spec, args.out_path,
+        processes=args.processes, use_cache=not args.no_cache
     )
 
-    performance.print_performance()
\ No newline at end of file
+    performance.print_performance()
+
+    if args.analytics:
+        gaps_file = performance.write_analytics(args.analytics, args.top_gaps)
+        print("Analytics written to {} and {}".format(args.analytics, gaps_file))
\ No newline at end of file
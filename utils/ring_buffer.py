@@ -0,0 +1,30 @@
+"""Fixed-size NumPy ring buffer for time series samples.
+
+Used by the link monitor and by the flowlet telemetry of the controller.
+"""
+import numpy as np
+
+
+class RingBuffer(object):
+    """Fixed-size buffer of samples that overwrites the oldest sample."""
+
+    def __init__(self, capacity, dtype):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.next = 0
+        self.full = False
+
+    def __len__(self):
+        return len(self.data) if self.full else self.next
+
+    def append(self, sample):
+        self.data[self.next] = sample
+        self.next = (self.next + 1) % len(self.data)
+        if self.next == 0:
+            self.full = True
+
+    def samples(self):
+        """Return all samples, oldest first."""
+        if self.full:
+            return np.concatenate((self.data[self.next:],
+                                   self.data[:self.next]))
+        return self.data[:self.next].copy()
@@ -1,7 +1,12 @@
 import sys
+import os
+import asyncio
+import signal
+import socket
 import multiprocessing
 import threading
 import time
+import traceback
 from datetime import datetime as dt
 import csv
 from udp import *
@@ -9,11 +14,27 @@ from udp import *
 
 class Scheduler(object):
 
-    def __init__(self, config_file, scheduler_type, log_path="/home/"):
+    def __init__(self, config_file, scheduler_type, log_path="/home/", log_format="text",
+                 pacing_report=False):
 
         self.config_file = config_file
         self.scheduler_type = scheduler_type
         self.log_path = log_path
+        self.log_format = log_format
+        self.pacing_report = pacing_report
+
+    def _log_file(self, role, flow):
+        """Sequence log of a flow, in its own or the default log format."""
+        log_format = flow.get("log_format") or self.log_format
+        return sequence_log_path(self.log_path, role, flow["src_name"], flow["dst_name"],
+                                 flow["sport"], flow["dport"], log_format), log_format
+
+    def _sender_options(self, kwargs):
+        """Defaults for the per-flow sender options."""
+        kwargs["log_format"] = kwargs.get("log_format") or self.log_format
+        if self.pacing_report:
+            kwargs.setdefault("pacing_report", "{}/pacing_{}_{}_{}_{}.csv".format(
+                self.log_path, kwargs["src_name"], kwargs["dst_name"], kwargs["sport"], kwargs["dport"]))
 
     def load_flows_file(self):
         """[summary]
@@ -44,14 +65,14 @@ class Scheduler(object):
         time.sleep(start_time - time.time())
 
         # sender
-        out_file = "{}/sender_{}_{}_{}_{}.txt".format(
-            self.log_path, kwargs["src_name"], kwargs["dst_name"], kwargs["sport"], kwargs["dport"])
+        out_file, _ = self._log_file("sender", kwargs)
 
         print("{time} Flow from {src} to {dst} starting (TOS: {tos}, Volume: {tput})".format(
             time=dt.now().strftime("%T"),
             src=kwargs["src_name"], dst=kwargs["dst_name"],
             tput=kwargs["rate"], tos=kwargs["tos"],
         ), flush=True)
+        self._sender_options(kwargs)
         send_udp_flow(out_file=out_file, **kwargs)
         print("{time} Flow from {src} to {dst} ending".format(
             time=dt.now().strftime("%T"),
@@ -64,9 +85,9 @@ class Scheduler(object):
 
         # start inmediately
         # sender
-        out_file = "{}/receiver_{}_{}_{}_{}.txt".format(
-            self.log_path, kwargs["src_name"], kwargs["dst_name"], kwargs["sport"], kwargs["dport"])
-        recv_udp_flow(kwargs["src"], int(kwargs["dport"]), out_file)
+        out_file, log_format = self._log_file("receiver", kwargs)
+        recv_udp_flow(kwargs["src"], int(kwargs["dport"]), out_file, log_format,
+                      timestamps=kwargs.get("timestamps", False))
 
     def main(self):
         """[summary]
@@ -102,12 +123,221 @@ class Scheduler(object):
                 sys.exit(1)
 
 
+class AsyncScheduler(Scheduler):
+    """Runs all flows of a host in one asyncio event loop per worker process.
+
+    Flow start times are timers of the event loop, senders pace with a token
+    bucket on non-blocking sockets. Receivers share one epoll loop
+    (MultiFlowReceiver). Log names and the exit code (1 if any
+    flow could not start or failed) are the same as with one process per flow.
+    """
+
+    def __init__(self, config_file, scheduler_type, log_path="/home/", log_format="text",
+                 pacing_report=False, workers=1):
+        super(AsyncScheduler, self).__init__(config_file, scheduler_type, log_path, log_format,
+                                             pacing_report)
+        self.workers = workers
+
+    def main(self):
+        """[summary]
+        """
+        flows = self.load_flows_file()
+
+        if self.scheduler_type not in ("sender", "receiver"):
+            print("Wrong scheduler type {}".format(self.scheduler_type))
+            return
+
+        workers = max(1, min(self.workers or os.cpu_count(), len(flows)))
+        if workers == 1:
+            if not self.run_flows(flows):
+                sys.exit(1)
+            return
+
+        self.processes = []
+        for worker_flows in self._partition(flows, workers):
+            process = multiprocessing.Process(
+                target=self._run_worker, args=(worker_flows,))
+            process.start()
+            self.processes.append(process)
+
+        # forward SIGTERM, in case only this process is killed
+        def _terminate_workers(signum, frame):
+            for process in self.processes:
+                process.terminate()
+        signal.signal(signal.SIGTERM, _terminate_workers)
+
+        for process in self.processes:
+            process.join()
+            if process.exitcode != 0:
+                sys.exit(1)
+
+    def _partition(self, flows, workers):
+        """Splits flows between workers."""
+        if self.scheduler_type == "sender":
+            return [flows[worker::workers] for worker in range(workers)]
+        # flows to the same port share a socket, so they stay together
+        ports = sorted(set(int(flow["dport"]) for flow in flows))
+        owner = {port: index % workers for index, port in enumerate(ports)}
+        return [[flow for flow in flows if owner[int(flow["dport"])] == worker]
+                for worker in range(workers)]
+
+    def _run_worker(self, flows):
+        sys.exit(0 if self.run_flows(flows) else 1)
+
+    def run_flows(self, flows):
+        """Runs flows until senders are done or receivers get SIGTERM.
+
+        Returns:
+            bool: True if all flows ran without errors
+        """
+        if self.scheduler_type == "receiver":
+            return self.run_receivers(flows)
+
+        # event loop timers are less precise than time.sleep
+        self.sleep_resolution = max(measure_sleep_resolution(), 1000000)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.stopped = self.loop.create_future()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, self._stop)
+
+        try:
+            return self.loop.run_until_complete(self._run_senders(flows))
+        finally:
+            self.loop.close()
+
+    def _stop(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    async def _run_senders(self, flows):
+        results = await asyncio.gather(
+            *[self.sender_flow(**flow) for flow in flows], return_exceptions=True)
+        ok = True
+        for result in results:
+            if isinstance(result, BaseException):
+                traceback.print_exception(type(result), result, result.__traceback__)
+                ok = False
+            elif not result:
+                ok = False
+        return ok
+
+    async def sender_flow(self, **kwargs):
+        """Waits for the start time and sends one flow.
+
+        Returns:
+            bool: False if the start time is in the past
+        """
+        start_time = float(kwargs['start_time'])
+        if time.time() > start_time:
+            print("\033[31mWarning: Invalid start time in the past. This flow won't start. Rerun the experiment\033[31m")
+            return False
+
+        # a SIGTERM before the start time stops the flow before it sends
+        start = self.loop.create_task(asyncio.sleep(start_time - time.time()))
+        await asyncio.wait([start, self.stopped], return_when=asyncio.FIRST_COMPLETED)
+        if self.stopped.done():
+            start.cancel()
+            return True
+
+        out_file, _ = self._log_file("sender", kwargs)
+
+        print("{time} Flow from {src} to {dst} starting (TOS: {tos}, Volume: {tput})".format(
+            time=dt.now().strftime("%T"),
+            src=kwargs["src_name"], dst=kwargs["dst_name"],
+            tput=kwargs["rate"], tos=kwargs["tos"],
+        ), flush=True)
+        self._sender_options(kwargs)
+        await self.send_flow(out_file=out_file, **kwargs)
+        print("{time} Flow from {src} to {dst} ending".format(
+            time=dt.now().strftime("%T"),
+            src=kwargs["src_name"], dst=kwargs["dst_name"],
+        ), flush=True)
+        return True
+
+    async def _wait_writable(self, sock):
+        writable = self.loop.create_future()
+        self.loop.add_writer(sock.fileno(), writable.set_result, None)
+        try:
+            await writable
+        finally:
+            self.loop.remove_writer(sock.fileno())
+
+    async def send_flow(self, dst, sport, dport, tos=0, rate='10M', duration=10,
+                        packet_size=maxUDPSize, batch_size=DEFAULT_BATCH_SIZE,
+                        out_file="send.txt", high_rate=False, log_format="text",
+                        timestamps=False, pacing_report=None, **kwargs):
+        """Same traffic as send_udp_flow, without blocking the event loop.
+
+        Datagrams are patched in place in a preallocated BatchSender buffer;
+        in high rate mode each batch is sent with one sendmmsg call.
+        """
+        timestamps = parse_flag(timestamps)
+        packet_size = clamp_packet_size(packet_size, timestamps)
+        high_rate = parse_flag(high_rate)
+        rate = int(setSizeToInt(rate) / 8)
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_IP, socket.IP_TOS, int(tos))
+        s.bind(('', int(sport)))
+        s.setblocking(False)
+        address = (dst, int(dport))
+
+        pacer = Pacer(rate, datagram_size(packet_size), duration, batch_size,
+                      self.sleep_resolution)
+        sender = BatchSender(s, address, datagram_size(packet_size), pacer.batch_size,
+                             timestamps, use_sendmmsg=high_rate)
+        output_log = open_sequence_log(out_file, log_format, ranges=True)
+        seq = 0
+        try:
+            while not pacer.done() and not self.stopped.done():
+                count, delay = pacer.poll()
+                if not count:
+                    await asyncio.sleep(delay)
+                    continue
+                sender.prepare(seq, count)
+                sent = sender.transmit(0, count)
+                while sent < count:
+                    await self._wait_writable(s)
+                    sent = sender.transmit(sent, count)
+                output_log.add_range(seq, seq + count)
+                seq += count
+                pacer.record(count)
+                # let the other flows run
+                await asyncio.sleep(0)
+        finally:
+            s.close()
+            output_log.close()
+            if pacing_report:
+                pacer.save_report(pacing_report)
+
+    def run_receivers(self, flows):
+        """Receives all flows in one epoll loop until SIGTERM."""
+        receiver = MultiFlowReceiver()
+        for flow in flows:
+            out_file, log_format = self._log_file("receiver", flow)
+            receiver.add_flow(flow["src"], flow["dport"], out_file, log_format,
+                              flow.get("timestamps", False))
+        receiver.run()
+        return True
+
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', help='Path to configuration',
                         type=str, required=False, default='./flows.txt')
     parser.add_argument('--type', help='Sender or receiver',
                         type=str, required=False, default='sender')
+    parser.add_argument('--log-path', help='Directory of the sequence logs',
+                        type=str, required=False, default='/home/')
+    parser.add_argument('--log-format', help='Format of the sequence logs (binary logs are written to .seq files)',
+                        type=str, required=False, default='text', choices=LOG_FORMATS)
+    parser.add_argument('--pacing-report', help='Write the target and achieved rate per second of each sender',
+                        action='store_true', required=False, default=False)
+    parser.add_argument('--engine', help='One event loop for all flows, or one process per flow',
+                        type=str, required=False, default='asyncio', choices=['asyncio', 'process'])
+    parser.add_argument('--workers', help='Event loop processes (0: one per core)',
+                        type=int, required=False, default=1)
     return parser.parse_args()
 
 
@@ -117,5 +347,10 @@ if __name__ == "__main__":
     args = get_args()
 
     # starts the flow scheduling task
-    scheduler = Scheduler(args.config, args.type)
+    if args.engine == 'asyncio':
+        scheduler = AsyncScheduler(args.config, args.type, args.log_path, log_format=args.log_format,
+                                   pacing_report=args.pacing_report, workers=args.workers)
+    else:
+        scheduler = Scheduler(args.config, args.type, args.log_path, log_format=args.log_format,
+                              pacing_report=args.pacing_report)
     scheduler.main()
@@ -1,13 +1,89 @@
 import subprocess
+import hashlib
 import json
 import ipdb
 import re
+import time
+from multiprocessing.pool import ThreadPool
+
+from utils import NODE_TO_CONTAINER, save_topology_index
+
+# One dump of all interfaces and of the default route per container.
+DISCOVERY_CMD = "sudo docker exec {} sh -c 'ip -j addr show; ip -j route show default'"
+# IDs of all containers in one call, missing containers are skipped.
+INSPECT_CMD = "sudo docker inspect --format '{{{{.Name}}}} {{{{.Id}}}}' {}"
+# Discovery results of the previous build, next to the topology.db.
+CACHE_SUFFIX = ".cache.json"
+
+
+def _parse_json_values(text):
+    """Parse consecutive JSON values, e.g. the output of several `ip -j`."""
+    decoder = json.JSONDecoder()
+    values = []
+    index = 0
+    text = text.strip()
+    while index < len(text):
+        value, index = decoder.raw_decode(text, index)
+        values.append(value)
+        while index < len(text) and text[index].isspace():
+            index += 1
+    return values
+
+
+def parse_discovery(output):
+    """Interfaces and default gateway from the output of DISCOVERY_CMD.
+
+    Returns:
+        dict: `interfaces` maps interface names to their MAC and IPv4
+            addresses (with prefix length), `gateway` is the default gateway.
+    """
+    values = _parse_json_values(output)
+    links = values[0] if values else []
+    routes = values[1] if len(values) > 1 else []
+    interfaces = {}
+    for link in links:
+        interfaces[link["ifname"]] = {
+            "mac": link.get("address", ""),
+            "inet": ["{}/{}".format(addr["local"], addr["prefixlen"])
+                     for addr in link.get("addr_info", [])
+                     if addr.get("family") == "inet"],
+        }
+    gateway = routes[0].get("gateway", "") if routes else ""
+    return {"interfaces": interfaces, "gateway": gateway}
+
+
+def discover_container(container):
+    """Run DISCOVERY_CMD in a container and parse its output."""
+    output = subprocess.check_output(DISCOVERY_CMD.format(container), shell=True)
+    return parse_discovery(output.decode("utf-8"))
+
+
+def container_ids(containers):
+    """Map container names to their IDs, running containers only."""
+    process = subprocess.Popen(INSPECT_CMD.format(" ".join(containers)),
+                               shell=True, stdout=subprocess.PIPE)
+    output = process.communicate()[0].decode("utf-8")
+    ids = {}
+    for line in output.splitlines():
+        name, _, container_id = line.strip().partition(" ")
+        ids[name.lstrip("/")] = container_id
+    return ids
+
+
+def load_cache(cache_file):
+    try:
+        with open(cache_file, "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
 
-from utils import check_output_cmd_docker, NODE_TO_CONTAINER
 
 class MiniInternetTopoBuilder(object):
-    def __init__(self, mini_internet_conf_path):
+    def __init__(self, mini_internet_conf_path, workers=16):
         self.mini_internet_conf_path = mini_internet_conf_path
+        self.workers = workers
+        # Discovery results per node, see `discover`.
+        self.discovery = {}
 
     def load_router_conf(self, file):
         """Loads FRR and P4 switches configuration
@@ -50,6 +126,88 @@ class MiniInternetTopoBuilder(object):
         self.links_confs = self.load_internal_links_conf(
             path + "/internal_links_config.txt")
 
+    def get_host_names(self):
+        """Names of the hosts attached to routers and switches."""
+        return ["h{}".format(int(re.search(r'\d+', router).group()))
+                for router, setting in self.router_confs.items()
+                if setting["has_host"]]
+
+    def node_key(self, node, container_id):
+        """Hash of the config lines of a node and of its container ID.
+
+        The discovery result of a node can be reused as long as its key
+        does not change.
+        """
+        if node in self.router_confs:
+            config = [self.router_confs[node]] + sorted(
+                [list(link) + list(setting)
+                 for link, setting in self.links_confs.items() if node in link])
+        else:
+            # Hosts depend on the config of the router they are attached to.
+            number = int(re.search(r'\d+', node).group())
+            config = sorted(
+                [router, setting] for router, setting in self.router_confs.items()
+                if setting["has_host"] and
+                int(re.search(r'\d+', router).group()) == number)
+        data = json.dumps({"config": config, "container": container_id},
+                          sort_keys=True)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+    def discover_cached(self, nodes, cache_file):
+        """Discover only the nodes whose key changed since the last build.
+
+        Returns:
+            int: Number of discovered nodes.
+        """
+        containers = dict((node, NODE_TO_CONTAINER.get(node, node))
+                          for node in nodes)
+        ids = container_ids(sorted(containers.values()))
+        cache = load_cache(cache_file)
+        keys = {}
+        changed = []
+        for node in nodes:
+            keys[node] = self.node_key(node, ids.get(containers[node]))
+            entry = cache.get(node)
+            # Never reuse results for containers that are not running.
+            if (containers[node] in ids and entry is not None and
+                    entry["key"] == keys[node]):
+                self.discovery[node] = entry["discovery"]
+            else:
+                changed.append(node)
+        if changed:
+            self.discover(changed)
+
+        with open(cache_file, "w") as f:
+            json.dump(dict((node, {"key": keys[node],
+                                   "discovery": self.discovery[node]})
+                           for node in nodes), f)
+        return len(changed)
+
+    def discover(self, nodes):
+        """Dump the interfaces of all nodes, in parallel.
+
+        Every container is queried once; all attributes are then looked up
+        in the parsed results.
+        """
+        containers = [NODE_TO_CONTAINER.get(node, node) for node in nodes]
+        pool = ThreadPool(max(1, min(self.workers, len(containers))))
+        try:
+            results = pool.map(discover_container, containers)
+        finally:
+            pool.close()
+            pool.join()
+        self.discovery.update(zip(nodes, results))
+
+    def get_ip(self, node, intf_name):
+        """First IPv4 address of an interface with prefix length, or ''."""
+        interface = self.discovery[node]["interfaces"].get(intf_name, {})
+        inet = interface.get("inet", [])
+        return inet[0] if inet else ""
+
+    def get_mac(self, node, intf_name):
+        interface = self.discovery[node]["interfaces"].get(intf_name, {})
+        return interface.get("mac", "")
+
     def get_switches(self):
         """gets all switches in the network
 
@@ -84,12 +242,9 @@ class MiniInternetTopoBuilder(object):
                 # get interface name
                 intf_name = "{}{}".format(router, router_type)
                 # get interface metadata
-                ip_addr = check_output_cmd_docker(
-                    host_name, "ip -f inet addr show {} | awk '/inet / {{print $2}}'".format(intf_name)).strip()
-                gateway_addr = check_output_cmd_docker(
-                    host_name, "ip r | grep default | awk '{print $3}'").strip()
-                mac_addr = check_output_cmd_docker(
-                    host_name, "cat /sys/class/net/{}/address".format(intf_name)).strip()
+                ip_addr = self.get_ip(host_name, intf_name)
+                gateway_addr = self.discovery[host_name]["gateway"]
+                mac_addr = self.get_mac(host_name, intf_name)
                 delay = int(setting["host_delay"])
                 bw = int(setting["host_bw"])/1000
                 loss = None
@@ -148,15 +303,14 @@ class MiniInternetTopoBuilder(object):
                 thrift_port += 1
                 # add addresses and api info
                 nodes[node]["ctl_cpu_intf"] = "1-{}-cpu".format(node)
-                thrift_ip = check_output_cmd_docker(
-                    node, "ip -f inet addr show {} | awk '/inet / {{print $2}}'".format("switch-api")).strip().split("/")[0]
+                thrift_ip = self.get_ip(node, "switch-api").split("/")[0]
                 nodes[node]["thrift_ip"] = thrift_ip
 
             elif node_type == "router":
                 nodes[node]["type"] = "router"
                 # get router id
-                router_id = [x for x in check_output_cmd_docker(
-                    node, "ip -f inet addr show lo | awk '/inet / {print $2}'").split() if not x.startswith("127.0.0.1")]
+                router_id = [x for x in self.discovery[node]["interfaces"].get("lo", {}).get("inet", [])
+                             if not x.startswith("127.0.0.1")]
                 if router_id:
                     router_id = router_id[0]
                 nodes[node]["router_id"] = router_id
@@ -166,10 +320,8 @@ class MiniInternetTopoBuilder(object):
                 setting = self.router_confs[node]
                 host_name = "h{}".format(int(re.search(r'\d+', node).group()))
                 intf_name = 'host'
-                ip_addr = check_output_cmd_docker(
-                    node, "ip -f inet addr show {} | awk '/inet / {{print $2}}'".format(intf_name)).strip()
-                mac_addr = check_output_cmd_docker(
-                    node, "cat /sys/class/net/{}/address".format(intf_name)).strip()
+                ip_addr = self.get_ip(node, intf_name)
+                mac_addr = self.get_mac(node, intf_name)
                 delay = int(setting["host_delay"])
                 bw = int(setting["host_bw"])/1000
                 loss = None
@@ -196,10 +348,8 @@ class MiniInternetTopoBuilder(object):
                     # internal links, thus its a router or a switch
                     host_name = src if node == dst else dst
                     intf_name = "port_{}".format(host_name)
-                    ip_addr = check_output_cmd_docker(
-                        node, "ip -f inet addr show {} | awk '/inet / {{print $2}}'".format(intf_name)).strip()
-                    mac_addr = check_output_cmd_docker(
-                        node, "cat /sys/class/net/{}/address".format(intf_name)).strip()
+                    ip_addr = self.get_ip(node, intf_name)
+                    mac_addr = self.get_mac(node, intf_name)
                     delay = int(setting[1])
                     bw = int(setting[0])/1000
                     loss = None
@@ -227,8 +377,25 @@ class MiniInternetTopoBuilder(object):
 
         return nodes
 
-    def build(self):
+    def build(self, cache_file=None):
+        """Discover all containers and build the topology.
+
+        Args:
+            cache_file (str): If given, discovery results are cached in this
+                file and only nodes whose config or container changed are
+                discovered again.
+        """
         self.load_configs()
+        nodes = sorted(set(self.get_host_names()) | set(self.get_switches()) |
+                       set(self.get_routers()))
+        start = time.time()
+        if cache_file:
+            discovered = self.discover_cached(nodes, cache_file)
+        else:
+            self.discover(nodes)
+            discovered = len(nodes)
+        print("Discovered {} of {} containers in {:.1f}s".format(
+            discovered, len(nodes), time.time() - start))
         self.hosts = self.build_hosts()
         self.nodes = self.build_forwarding_nodes()
         self.topo = {}
@@ -236,8 +403,10 @@ class MiniInternetTopoBuilder(object):
         self.topo.update(self.nodes)
 
     def save_topology(self, out_file="topology.db"):
+        """Write the topology and its binary index (see `load_topology_index`)."""
         with open(out_file, 'w') as f:
             json.dump(self.topo, f)
+        save_topology_index(self.topo, out_file)
 
 
 if __name__ == "__main__":
@@ -248,9 +417,13 @@ if __name__ == "__main__":
                         type=str, required=True)
     parser.add_argument('--out_dir', help='Output path name',
                         type=str, required=False, default="topology.db")
+    parser.add_argument('--workers', help='Containers to query in parallel',
+                        type=int, required=False, default=16)
+    parser.add_argument('--no-cache', help='Discover all containers again',
+                        action='store_true', required=False, default=False)
 
     args = parser.parse_args()
 
-    p = MiniInternetTopoBuilder(args.config_dir)
-    p.build()
+    p = MiniInternetTopoBuilder(args.config_dir, args.workers)
+    p.build(None if args.no_cache else args.out_dir + CACHE_SUFFIX)
     p.save_topology(args.out_dir)
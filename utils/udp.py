@@ -1,6 +1,18 @@
 import time
 import socket
 import math
+import ctypes
+import ctypes.util
+import struct
+import signal
+import sys
+import os
+import json
+import select
+import errno
+from array import array
+
+from units import setSizeToInt
 
 # max mtu
 MTU = 1500
@@ -8,33 +20,581 @@ MTU = 1500
 minSizeUDP = 42
 maxUDPSize = 1400
 DEFAULT_BATCH_SIZE = 1
+# Datagrams carry packet_size - PACKET_SIZE_CORRECTION bytes of padding after
+# the 4 byte sequence number.
+PACKET_SIZE_CORRECTION = 17
+# Ethernet (14), IPv4 (20) and UDP (8) headers of every datagram. The Pacer
+# adds them to the datagram size, so the rate is kept on the wire.
+WIRE_OVERHEAD = minSizeUDP
+# sequence logs are written to disk in blocks of this size
+LOG_BUFFER_SIZE = 1 << 20
+
+# Sequence log formats. Binary logs start with a 4 byte magic, followed by
+# little-endian uint32 values: (start, end) pairs of sequence ranges, with
+# the end excluded, or one record per sequence number. Ranges never cross
+# the wrap of the sequence numbers, an end of 0 stands for 2**32.
+LOG_FORMATS = ["binary", "text"]
+# Binary logs get their own extension, so that tools which read the text
+# logs never open a binary one.
+LOG_EXTENSIONS = {"text": ".txt", "binary": ".seq"}
+RANGES_MAGIC = b"SQR1"
+RECORDS_MAGIC = b"SQN1"
+
+# Payload headers: sequence number, optionally followed by the send time in
+# nanoseconds since the epoch.
+SEQ_HEADER = struct.Struct(">I")
+TIMESTAMP_HEADER = struct.Struct(">IQ")
+# Not exported by the socket module (asm-generic/socket.h).
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)
+TIMESPEC = struct.Struct("@ll")
+
+
+class _Iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _Msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_Iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _Mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _Msghdr), ("msg_len", ctypes.c_uint)]
+
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_sendmmsg = getattr(_libc, "sendmmsg", None)
+_recvmmsg = getattr(_libc, "recvmmsg", None)
+MSG_DONTWAIT = 0x40
+
+# receive buffers: datagrams per recvmmsg call and bytes per datagram
+RECV_BATCH_SIZE = 64
+RECV_BUFFER_SIZE = 2048
+SOCKADDR_IN_SIZE = 16
+# struct cmsghdr: size_t cmsg_len, int cmsg_level, int cmsg_type.
+CMSG_HEADER = struct.Struct("@Nii")
+CMSG_ALIGN = struct.calcsize("@N")
+
+
+class BatchSender(object):
+    """Sends batches of equally sized datagrams to one destination.
+
+    All datagrams of a batch live in one preallocated buffer, only the
+    payload header (sequence number and optional send timestamp) is patched
+    before sending. If available, the whole batch is sent with a single
+    sendmmsg call. The socket is not connected, so ICMP errors from the
+    destination do not abort the flow.
+
+    With use_sendmmsg=False, the datagrams are sent one sendto call each,
+    still from the preallocated buffer.
+    """
+
+    def __init__(self, sock, address, datagram_size, batch_size, timestamps=False,
+                 use_sendmmsg=True):
+        self.sock = sock
+        self.address = address
+        self.datagram_size = datagram_size
+        self.batch_size = batch_size
+        self.timestamps = timestamps
+        self.buffer = bytearray(b"A" * (datagram_size * batch_size))
+        self.view = memoryview(self.buffer)
+
+        self.use_sendmmsg = use_sendmmsg and _sendmmsg is not None
+        if self.use_sendmmsg:
+            base = ctypes.addressof(
+                (ctypes.c_char * len(self.buffer)).from_buffer(self.buffer))
+            # struct sockaddr_in
+            self.sockaddr = ctypes.create_string_buffer(
+                struct.pack("=H", socket.AF_INET) + struct.pack(">H", address[1]) +
+                socket.inet_aton(address[0]) + b"\0" * 8, 16)
+            self.iovecs = (_Iovec * batch_size)()
+            self.msgs = (_Mmsghdr * batch_size)()
+            for i in range(batch_size):
+                self.iovecs[i].iov_base = base + i * datagram_size
+                self.iovecs[i].iov_len = datagram_size
+                self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+                self.msgs[i].msg_hdr.msg_iovlen = 1
+                self.msgs[i].msg_hdr.msg_name = ctypes.addressof(self.sockaddr)
+                self.msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(self.sockaddr)
+
+    def prepare(self, first_seq, count):
+        """Patch the headers of `count` datagrams, starting at `first_seq`."""
+        if self.timestamps:
+            now = time.time_ns()
+            for i in range(count):
+                TIMESTAMP_HEADER.pack_into(self.buffer, i * self.datagram_size,
+                                           (first_seq + i) & 0xffffffff, now)
+        else:
+            for i in range(count):
+                SEQ_HEADER.pack_into(self.buffer, i * self.datagram_size,
+                                     (first_seq + i) & 0xffffffff)
+
+    def transmit(self, start, count):
+        """Send the prepared datagrams start, ..., count - 1.
+
+        Returns:
+            int: Index after the last datagram sent. Less than count if the
+                socket is non-blocking and its buffer is full.
+        """
+        if not self.use_sendmmsg:
+            for i in range(start, count):
+                offset = i * self.datagram_size
+                try:
+                    self.sock.sendto(self.view[offset:offset + self.datagram_size],
+                                     self.address)
+                except BlockingIOError:
+                    return i
+            return count
+
+        while start < count:
+            result = _sendmmsg(self.sock.fileno(),
+                               ctypes.byref(self.msgs, start * ctypes.sizeof(_Mmsghdr)),
+                               count - start, 0)
+            if result < 0:
+                error = ctypes.get_errno()
+                if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return start
+                raise OSError(error, "sendmmsg failed")
+            start += result
+        return count
+
+    def send(self, first_seq, count):
+        """Send `count` datagrams with sequence numbers starting at `first_seq`."""
+        self.prepare(first_seq, count)
+        sent = 0
+        while sent < count:
+            sent = self.transmit(sent, count)
+
+
+class TextSequenceLog(object):
+    """Sequence log with one decimal number per line."""
+
+    def __init__(self, out_file):
+        self.f = open(out_file, "w", buffering=LOG_BUFFER_SIZE)
+
+    def add(self, seq):
+        self.f.write("{}\n".format(seq))
+
+    def add_range(self, start, end):
+        """Log the sequence numbers start, ..., end - 1."""
+        self.f.write("".join("{}\n".format(seq) for seq in range(start, end)))
+
+    def close(self):
+        self.f.close()
+
+
+class RangeSequenceLog(object):
+    """Binary sequence log that stores runs of consecutive numbers as ranges.
+
+    Senders log increasing sequence numbers, so a whole flow usually
+    compresses to a single range.
+    """
+
+    def __init__(self, out_file):
+        self.f = open(out_file, "wb")
+        self.f.write(RANGES_MAGIC)
+        self.buffer = bytearray()
+        self.start = None
+        self.end = None
+
+    def add(self, seq):
+        self.add_range(seq, seq + 1)
+
+    def add_range(self, start, end):
+        """Log the sequence numbers start, ..., end - 1."""
+        if start == self.end:
+            self.end = end
+            return
+        self._close_range()
+        self.start, self.end = start, end
+
+    def _close_range(self):
+        if self.start is None:
+            return
+        start = self.start
+        while start < self.end:
+            end = min(self.end, (start | 0xffffffff) + 1)
+            self.buffer += struct.pack("<II", start & 0xffffffff, end & 0xffffffff)
+            start = end
+        if len(self.buffer) >= LOG_BUFFER_SIZE:
+            self.f.write(self.buffer)
+            self.buffer = bytearray()
+
+    def close(self):
+        self._close_range()
+        self.start = self.end = None
+        self.f.write(self.buffer)
+        self.f.close()
+
+
+class RecordSequenceLog(object):
+    """Binary sequence log with one uint32 record per sequence number.
+
+    Records keep the arrival order, including duplicates.
+    """
+
+    def __init__(self, out_file):
+        self.f = open(out_file, "wb")
+        self.f.write(RECORDS_MAGIC)
+        self.records = array("I")
+
+    def add(self, seq):
+        self.records.append(seq & 0xffffffff)
+        if len(self.records) * 4 >= LOG_BUFFER_SIZE:
+            self._write()
+
+    def add_range(self, start, end):
+        """Log the sequence numbers start, ..., end - 1."""
+        for seq in range(start, end):
+            self.add(seq)
+
+    def _write(self):
+        if sys.byteorder != "little":
+            self.records.byteswap()
+        self.f.write(self.records.tobytes())
+        self.records = array("I")
+
+    def close(self):
+        self._write()
+        self.f.close()
+
+
+def sequence_log_path(log_path, role, src_name, dst_name, sport, dport, log_format="text"):
+    """Path of the sender or receiver sequence log of a flow.
+
+    Args:
+        log_path (str): directory of the logs
+        role (str): "sender" or "receiver"
+        log_format (str): "text" or "binary", selects the extension
+    """
+    return "{}/{}_{}_{}_{}_{}{}".format(log_path, role, src_name, dst_name, sport, dport,
+                                        LOG_EXTENSIONS[log_format])
+
+
+def open_sequence_log(out_file, log_format="text", ranges=False):
+    """Opens a sequence log writer.
+
+    Args:
+        out_file (str): output file
+        log_format (str): "text" or "binary"
+        ranges (bool): binary logs store ranges instead of single records,
+            best for senders, whose sequence numbers are consecutive.
+    """
+    if log_format == "text":
+        return TextSequenceLog(out_file)
+    elif log_format == "binary":
+        return RangeSequenceLog(out_file) if ranges else RecordSequenceLog(out_file)
+    raise ValueError("Unknown log format {}".format(log_format))
+
+
+def _read_uint32(data):
+    """Decodes little-endian uint32 values from bytes."""
+    values = array("I")
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def read_sequences(file_name):
+    """Reads a sequence log in any format.
+
+    Args:
+        file_name (str): log file
+
+    Returns:
+        list: sequence numbers in logged order, with ranges expanded
+    """
+    with open(file_name, "rb") as f:
+        data = f.read()
+
+    magic = data[:len(RANGES_MAGIC)]
+    if magic == RANGES_MAGIC:
+        bounds = _read_uint32(data[len(RANGES_MAGIC):])
+        sequences = []
+        for start, end in zip(bounds[0::2], bounds[1::2]):
+            sequences.extend(range(start, end or 1 << 32))
+        return sequences
+    elif magic == RECORDS_MAGIC:
+        return _read_uint32(data[len(RECORDS_MAGIC):]).tolist()
+    return [int(x) for x in data.split()]
+
+
+class HdrHistogram(object):
+    """Log-linear histogram of non-negative integers, as in HdrHistogram.
+
+    Values below 2**sub_bits are counted exactly. Larger values share a
+    bucket with values that have the same sub_bits most significant bits,
+    so the relative error stays below 2**(1 - sub_bits).
+    """
+
+    def __init__(self, sub_bits=7):
+        self.sub_bits = sub_bits
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        shift = value.bit_length() - self.sub_bits
+        if shift <= 0:
+            return value
+        return (shift << (self.sub_bits - 1)) + (value >> shift)
+
+    def _lower_bound(self, index):
+        if index < (1 << self.sub_bits):
+            return index
+        shift = (index >> (self.sub_bits - 1)) - 1
+        return (index - (shift << (self.sub_bits - 1))) << shift
+
+    def record(self, value):
+        value = max(0, int(value))
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Lower bound of the bucket holding the given percentile."""
+        if not self.total:
+            return None
+        rank = max(1, int(math.ceil(self.total * percent / 100.0)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return self._lower_bound(index)
+
+    def summary(self):
+        """Count, min, mean, max, percentiles and the non-empty buckets."""
+        return {
+            "count": self.total,
+            "min": self.min,
+            "mean": float(self.sum) / self.total if self.total else None,
+            "max": self.max,
+            "percentiles": {str(p): self.percentile(p)
+                            for p in (50, 90, 99, 99.9)},
+            "buckets": [[self._lower_bound(index), self.counts[index]]
+                        for index in sorted(self.counts)],
+        }
+
+
+class DelayRecorder(object):
+    """One-way delay and jitter histograms of a flow, in microseconds.
+
+    Jitter is the difference between the delays of consecutive packets
+    (RFC 3550 transit time difference). The smoothed RFC 3550 jitter is
+    kept as well.
+    """
 
+    def __init__(self):
+        self.delay = HdrHistogram()
+        self.jitter = HdrHistogram()
+        self.last_delay = None
+        self.smoothed_jitter = 0.0
+        # packets received before they were sent (clock offset)
+        self.negative = 0
 
-def setSizeToInt(size):
-    """" Converts the sizes string notation to the corresponding integer
-    (in bytes).  Input size can be given with the following
-    magnitudes: B, K, M and G.
+    def record(self, sent_ns, received_ns):
+        delay = (received_ns - sent_ns) // 1000
+        if delay < 0:
+            self.negative += 1
+        self.delay.record(delay)
+        if self.last_delay is not None:
+            difference = abs(delay - self.last_delay)
+            self.jitter.record(difference)
+            self.smoothed_jitter += (difference - self.smoothed_jitter) / 16.0
+        self.last_delay = delay
+
+    def save(self, file_name):
+        with open(file_name, "w") as f:
+            json.dump({
+                "unit": "us",
+                "delay": self.delay.summary(),
+                "jitter": self.jitter.summary(),
+                "smoothed_jitter": self.smoothed_jitter,
+                "negative_delays": self.negative,
+            }, f)
+
+
+def parse_flag(value):
+    """Flags read from a csv file are passed as strings."""
+    return str(value).lower() in ("1", "true", "yes")
+
+
+def clamp_packet_size(packet_size, timestamps=False):
+    """Packet size between the smallest packet that fits the payload header and maxUDPSize."""
+    header = TIMESTAMP_HEADER if timestamps else SEQ_HEADER
+    smallest = PACKET_SIZE_CORRECTION - SEQ_HEADER.size + header.size
+    return max(min(int(packet_size), maxUDPSize), smallest)
+
+
+def datagram_size(packet_size):
+    """Size of the UDP payload sent for a packet_size of the traffic spec."""
+    return packet_size - PACKET_SIZE_CORRECTION + SEQ_HEADER.size
+
+
+def make_datagram(seq, padding, timestamps=False):
+    """Payload header followed by padding, len(padding) + 4 bytes in total."""
+    if timestamps:
+        header = TIMESTAMP_HEADER.pack(seq & 0xffffffff, time.time_ns())
+    else:
+        header = SEQ_HEADER.pack(seq & 0xffffffff)
+    return header + padding[len(header) - 4:]
+
+
+def enable_kernel_timestamps(sock):
+    """Asks the kernel to timestamp received packets (SO_TIMESTAMPNS).
+
+    Returns:
+        int: ancillary buffer size to pass to recvmsg
     """
-    if isinstance(size, int):
-        return size
-    elif isinstance(size, float):
-        return int(size)
     try:
-        conversions = {'B': 1, 'K': 1e3, 'M': 1e6, 'G': 1e9}
-        digits_list = list(range(48, 58)) + [ord(".")]
-        magnitude = chr(
-            sum([ord(x) if (ord(x) not in digits_list) else 0 for x in size]))
-        digit = float(size[0:(size.index(magnitude))])
-        magnitude = conversions[magnitude]
-        return int(magnitude*digit)
-    except:
-        print("Conversion Fail")
-        return 0
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+    except OSError:
+        pass
+    return socket.CMSG_SPACE(TIMESPEC.size)
+
+
+def arrival_time_ns(ancdata):
+    """Kernel receive timestamp from recvmsg ancillary data, or the current time."""
+    for level, kind, value in ancdata:
+        if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS:
+            seconds, nanoseconds = TIMESPEC.unpack(value[:TIMESPEC.size])
+            return seconds * 1000000000 + nanoseconds
+    return time.time_ns()
+
+
+def measure_sleep_resolution(samples=20):
+    """Median time a very short sleep actually takes, in nanoseconds."""
+    durations = []
+    for _ in range(samples):
+        start = time.monotonic_ns()
+        time.sleep(1e-5)
+        durations.append(time.monotonic_ns() - start)
+    return sorted(durations)[samples // 2]
+
+
+class Pacer(object):
+    """Paces the packets of a flow with a token bucket on time.monotonic_ns.
+
+    The tokens are the packets due since the start minus the packets sent.
+    They are never reset, so rounding and sleep errors of one second are
+    made up in the next and the flow sends exactly duration * rate bytes.
+    If the packet interval is shorter than the sleep resolution, several
+    packets are sent per wake-up.
+
+    Every packet is accounted with its size on the wire: the UDP payload
+    plus the Ethernet, IPv4 and UDP headers.
+
+    Args:
+        rate (int): bytes per second on the wire
+        datagram_size (int): UDP payload bytes per packet
+        duration (float): seconds
+        batch_size (int): minimum packets per wake-up
+        resolution_ns (int): sleep resolution, measured if not given
+        overhead (int): header bytes per packet
+    """
+
+    def __init__(self, rate, datagram_size, duration, batch_size=1, resolution_ns=None,
+                 overhead=WIRE_OVERHEAD):
+        self.rate = int(rate)
+        # bytes accounted per packet
+        self.packet_size = int(datagram_size) + int(overhead)
+        self.total = int(float(duration) * self.rate) // self.packet_size
+        # packets per nanosecond, as a fraction
+        self.numerator = self.rate
+        self.denominator = self.packet_size * 1000000000
+        if resolution_ns is None:
+            resolution_ns = measure_sleep_resolution()
+        interval_ns = float(self.denominator) / self.numerator if self.rate else float("inf")
+        self.batch_size = max(int(batch_size), int(math.ceil(resolution_ns / interval_ns)))
+        self.sent = 0
+        self.start_ns = None
+        # packets sent in each second since the start
+        self.per_second = []
+
+    def done(self):
+        return self.sent >= self.total
+
+    def poll(self):
+        """Packets to send now, or the time to wait first.
+
+        Returns:
+            tuple(int, float): packets to send and seconds to wait, one of
+                them is zero
+        """
+        now = time.monotonic_ns()
+        if self.start_ns is None:
+            self.start_ns = now
+        elapsed = now - self.start_ns
+        # packet n is due at n / packets per second
+        due = min(self.total, elapsed * self.numerator // self.denominator + 1)
+        target = min(self.batch_size, self.total - self.sent)
+        if due - self.sent >= target:
+            return min(due - self.sent, self.batch_size), 0.0
+        # wait until the whole batch is due
+        due_ns = -(-(self.sent + target - 1) * self.denominator // self.numerator)
+        return 0, (self.start_ns + due_ns - now) / 1e9
+
+    def wait(self):
+        """Sleeps until packets are due, returns how many to send."""
+        while True:
+            count, delay = self.poll()
+            if count:
+                return count
+            time.sleep(delay)
+
+    def record(self, count):
+        """Marks packets as sent."""
+        second = (time.monotonic_ns() - self.start_ns) // 1000000000
+        while len(self.per_second) <= second:
+            self.per_second.append(0)
+        self.per_second[second] += count
+        self.sent += count
+
+    def report(self):
+        """Target and achieved rate of each second, in bits per second."""
+        return [(second, self.rate * 8, packets * self.packet_size * 8, packets)
+                for second, packets in enumerate(self.per_second)]
+
+    def save_report(self, file_name):
+        with open(file_name, "w") as f:
+            f.write("second,target_bps,achieved_bps,packets\n")
+            for row in self.report():
+                f.write("{},{},{},{}\n".format(*row))
+
+
+def _exit_on_sigterm():
+    """Turns SIGTERM into SystemExit, so buffered logs are flushed."""
+    def _handler(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, _handler)
 
 
 def send_udp_flow(dst="10.0.1.2", sport=5000, dport=5001, tos=0, rate='10M', duration=10, 
-                  packet_size=maxUDPSize, batch_size=DEFAULT_BATCH_SIZE, out_file="send.txt", **kwargs):
+                  packet_size=maxUDPSize, batch_size=DEFAULT_BATCH_SIZE, out_file="send.txt",
+                  high_rate=False, log_format="text", timestamps=False, pacing_report=None,
+                  **kwargs):
     """Udp sending function that keeps a constant rate and logs sent packets to a file.
+
+    The rate is kept by a Pacer: duration * rate bytes are sent, evenly
+    spaced, in batches of at least batch_size packets.
+
+    In high rate mode, each batch is sent with one sendmmsg call from a
+    preallocated buffer and the log is written in large blocks, which
+    keeps the sender CPU from limiting the rate.
+
     Args:
         dst (str, optional): [description]. Defaults to "10.0.1.2".
         sport (int, optional): [description]. Defaults to 5000.
@@ -45,97 +605,326 @@ def send_udp_flow(dst="10.0.1.2", sport=5000, dport=5001, tos=0, rate='10M', dur
         packet_size ([type], optional): [description]. Defaults to maxUDPSize.
         batch_size (int, optional): [description]. Defaults to 5.
         out_file (str, optional): [description]. Defaults to "send.txt".
+        high_rate (bool, optional): Batched sending and buffered logging. Defaults to False.
+        log_format (str, optional): "text" or "binary" (ranges). Defaults to "text".
+        timestamps (bool, optional): Add the send time to the payload header. Defaults to False.
+        pacing_report (str, optional): csv file for the target and achieved rate per second.
     """
 
     sport = int(sport)
     dport = int(dport)
-    packet_size = int(packet_size)
+    batch_size = int(batch_size)
     tos = int(tos)
-    if packet_size > maxUDPSize:
-        packet_size = maxUDPSize
+    high_rate = parse_flag(high_rate)
+    timestamps = parse_flag(timestamps)
+    packet_size = clamp_packet_size(packet_size, timestamps)
 
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.setsockopt(socket.SOL_IP, socket.IP_TOS, tos)
     s.bind(('', sport))
 
     rate = int(setSizeToInt(rate)/8)
-    totalTime = float(duration)
+    pacer = Pacer(rate, datagram_size(packet_size), duration, batch_size)
 
-    # we use 17 to correct a bit the bw
-    packet = b"A" * int((packet_size - 17))
+    packet = b"A" * (packet_size - PACKET_SIZE_CORRECTION)
     seq = 0
-    output_log = open(out_file, "w")
+    if high_rate:
+        sender = BatchSender(s, (dst, dport), datagram_size(packet_size), pacer.batch_size, timestamps)
+    output_log = open_sequence_log(out_file, log_format, ranges=True)
+    _exit_on_sigterm()
 
     try:
-        startTime = time.time()
-        while (time.time() - startTime < totalTime):
-
-            packets_to_send = rate/packet_size
-            times = math.ceil((float(rate) / (packet_size))/batch_size)
-            time_step = 1/times
-            start = time.time()
-            i = 0
-            packets_sent = 0
-            # batches of 1 sec
-            while packets_sent < packets_to_send:
-                for _ in range(batch_size):
-                    s.sendto(seq.to_bytes(4, byteorder='big') +
-                             packet, (dst, dport))
-                    output_log.write("{}\n".format(seq))
-                    output_log.flush()
-                    # sequence_numbers.append(seq)
-                    packets_sent += 1
-                    seq += 1
-
-                i += 1
-                next_send_time = start + (i * time_step)
-                time.sleep(max(0, next_send_time - time.time()))
-                # return
-            time.sleep(max(0, 1-(time.time()-start)))
+        while not pacer.done():
+            count = pacer.wait()
+            if high_rate:
+                sender.send(seq, count)
+                output_log.add_range(seq, seq + count)
+            else:
+                for i in range(count):
+                    s.sendto(make_datagram(seq + i, packet, timestamps), (dst, dport))
+                    output_log.add(seq + i)
+            seq += count
+            pacer.record(count)
 
     finally:
         s.close()
         output_log.close()
+        if pacing_report:
+            pacer.save_report(pacing_report)
+
+
+class ReceivedSet(object):
+    """Bitmap of the received sequence numbers, written as ranges."""
+
+    def __init__(self):
+        self.bits = bytearray()
+
+    def add(self, seq):
+        if seq >= len(self.bits):
+            self.bits.extend(b"\x00" * max(seq + 1 - len(self.bits), len(self.bits)))
+        self.bits[seq] = 1
 
+    def ranges(self):
+        """Runs of received sequence numbers, as (start, end) with end excluded."""
+        start = self.bits.find(b"\x01")
+        while start != -1:
+            end = self.bits.find(b"\x00", start)
+            if end == -1:
+                end = len(self.bits)
+            yield start, end
+            start = self.bits.find(b"\x01", end)
 
-def recv_udp_flow(src, dport, out_file="recv.txt"):
+
+class _ReceivedFlow(object):
+    """Log and delay histograms of one received flow.
+
+    With timestamps, nothing is written per packet: the received sequence
+    numbers are kept in a ReceivedSet and logged as ranges at exit, next to
+    the delay summary. The scoring only needs which packets arrived, but
+    duplicates and the arrival order are not logged in this mode.
+    """
+
+    def __init__(self, out_file, log_format, timestamps, latency_file):
+        self.out_file = out_file
+        self.log_format = log_format
+        self.timestamps = timestamps
+        self.count = 0
+        if timestamps:
+            self.received = ReceivedSet()
+            self.recorder = DelayRecorder()
+            self.latency_file = latency_file or (
+                os.path.splitext(out_file)[0] + "_latency.json")
+        else:
+            self.output_log = open_sequence_log(out_file, log_format)
+
+    def close(self):
+        print("Packets received {}".format(self.count))
+        if self.timestamps:
+            output_log = open_sequence_log(self.out_file, self.log_format, ranges=True)
+            for start, end in self.received.ranges():
+                output_log.add_range(start, end)
+            output_log.close()
+            self.recorder.save(self.latency_file)
+        else:
+            self.output_log.close()
+
+
+class MultiFlowReceiver(object):
+    """Receives any number of flows in one epoll loop.
+
+    There is one socket per destination port. Flows to the same port share
+    it and are told apart by their source address, with a dict prepared
+    when the flow is added. Ready sockets are drained with recvmmsg into
+    preallocated buffers (or recvmsg_into, if libc has no recvmmsg).
+
+    The loop runs until SIGTERM or SIGINT, then all logs are flushed.
+    """
+
+    def __init__(self, batch_size=RECV_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.flows = []
+        # port -> socket, fileno -> (socket, {packed source address: flow})
+        self.ports = {}
+        self.sockets = {}
+        self.running = False
+
+        self.buffer = bytearray(batch_size * RECV_BUFFER_SIZE)
+        self.names = bytearray(batch_size * SOCKADDR_IN_SIZE)
+        self.control_size = socket.CMSG_SPACE(TIMESPEC.size)
+        self.control = bytearray(batch_size * self.control_size)
+
+        self.use_recvmmsg = _recvmmsg is not None
+        if self.use_recvmmsg:
+            def address(data):
+                return ctypes.addressof((ctypes.c_char * len(data)).from_buffer(data))
+            buffer, names, control = address(self.buffer), address(self.names), address(self.control)
+            self.iovecs = (_Iovec * batch_size)()
+            self.msgs = (_Mmsghdr * batch_size)()
+            for i in range(batch_size):
+                self.iovecs[i].iov_base = buffer + i * RECV_BUFFER_SIZE
+                self.iovecs[i].iov_len = RECV_BUFFER_SIZE
+                header = self.msgs[i].msg_hdr
+                header.msg_iov = ctypes.pointer(self.iovecs[i])
+                header.msg_iovlen = 1
+                header.msg_name = names + i * SOCKADDR_IN_SIZE
+                header.msg_control = control + i * self.control_size
+
+    def add_flow(self, src, dport, out_file, log_format="text", timestamps=False,
+                 latency_file=None):
+        """Adds a flow from src to the local port dport."""
+        timestamps = parse_flag(timestamps)
+        flow = _ReceivedFlow(out_file, log_format, timestamps, latency_file)
+        self.flows.append(flow)
+
+        dport = int(dport)
+        if dport not in self.ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("", dport))
+            sock.setblocking(False)
+            self.ports[dport] = sock
+            self.sockets[sock.fileno()] = (sock, {})
+        sock = self.ports[dport]
+        if timestamps:
+            enable_kernel_timestamps(sock)
+        self.sockets[sock.fileno()][1][socket.inet_aton(src)] = flow
+        return flow
+
+    def _stop(self, signum, frame):
+        self.running = False
+
+    def run(self):
+        """Receives until SIGTERM or SIGINT, then closes all flows."""
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_read, False)
+        os.set_blocking(wakeup_write, False)
+        # the signal wakes up epoll through the pipe
+        previous_wakeup = signal.set_wakeup_fd(wakeup_write)
+        previous_handlers = [(signum, signal.signal(signum, self._stop))
+                             for signum in (signal.SIGTERM, signal.SIGINT)]
+
+        poller = select.epoll()
+        poller.register(wakeup_read, select.EPOLLIN)
+        for fileno in self.sockets:
+            poller.register(fileno, select.EPOLLIN)
+
+        self.running = True
+        try:
+            while self.running:
+                for fileno, _ in poller.poll():
+                    if fileno != wakeup_read:
+                        self._drain(*self.sockets[fileno])
+        finally:
+            poller.close()
+            signal.set_wakeup_fd(previous_wakeup)
+            for signum, handler in previous_handlers:
+                signal.signal(signum, handler)
+            os.close(wakeup_read)
+            os.close(wakeup_write)
+            self.close()
+
+    def _drain(self, sock, sources):
+        """Reads all pending datagrams of a socket."""
+        if not self.use_recvmmsg:
+            return self._drain_single(sock, sources)
+
+        while True:
+            for i in range(self.batch_size):
+                # the kernel overwrites the lengths
+                header = self.msgs[i].msg_hdr
+                header.msg_namelen = SOCKADDR_IN_SIZE
+                header.msg_controllen = self.control_size
+            received = _recvmmsg(sock.fileno(), self.msgs, self.batch_size,
+                                 MSG_DONTWAIT, None)
+            if received < 0:
+                error = ctypes.get_errno()
+                if error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise OSError(error, "recvmmsg failed")
+
+            for i in range(received):
+                # sockaddr_in: family, port, address
+                name = i * SOCKADDR_IN_SIZE
+                flow = sources.get(bytes(self.names[name + 4:name + 8]))
+                if flow is None:
+                    continue
+                arrival = None
+                if flow.timestamps:
+                    arrival = self._control_time_ns(
+                        i * self.control_size, self.msgs[i].msg_hdr.msg_controllen)
+                self._record(flow, i * RECV_BUFFER_SIZE, self.msgs[i].msg_len, arrival)
+
+            if received < self.batch_size:
+                return
+
+    def _drain_single(self, sock, sources):
+        view = memoryview(self.buffer)[:RECV_BUFFER_SIZE]
+        while True:
+            try:
+                size, ancdata, _, address = sock.recvmsg_into([view], self.control_size)
+            except BlockingIOError:
+                return
+            flow = sources.get(socket.inet_aton(address[0]))
+            if flow is not None:
+                arrival = arrival_time_ns(ancdata) if flow.timestamps else None
+                self._record(flow, 0, size, arrival)
+
+    def _control_time_ns(self, offset, length):
+        """Kernel receive timestamp from a control buffer, or the current time."""
+        end = offset + length
+        while offset + CMSG_HEADER.size <= end:
+            cmsg_len, level, kind = CMSG_HEADER.unpack_from(self.control, offset)
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS:
+                seconds, nanoseconds = TIMESPEC.unpack_from(
+                    self.control, offset + CMSG_HEADER.size)
+                return seconds * 1000000000 + nanoseconds
+            if cmsg_len < CMSG_HEADER.size:
+                break
+            offset += (cmsg_len + CMSG_ALIGN - 1) & ~(CMSG_ALIGN - 1)
+        return time.time_ns()
+
+    def _record(self, flow, offset, size, arrival):
+        if flow.timestamps:
+            if size < TIMESTAMP_HEADER.size:
+                return
+            seq, sent_ns = TIMESTAMP_HEADER.unpack_from(self.buffer, offset)
+            flow.recorder.record(sent_ns, arrival)
+            flow.received.add(seq)
+        else:
+            if size < SEQ_HEADER.size:
+                return
+            seq = SEQ_HEADER.unpack_from(self.buffer, offset)[0]
+            flow.output_log.add(seq)
+        flow.count += 1
+
+    def close(self):
+        for flow in self.flows:
+            flow.close()
+        for sock, _ in self.sockets.values():
+            sock.close()
+        self.flows = []
+        self.ports = {}
+        self.sockets = {}
+
+
+def recv_udp_flow(src, dport, out_file="recv.txt", log_format="text",
+                  timestamps=False, latency_file=None):
     """Receiving function. It blocks reciving packets and store the first
-       4 bytes into out file
+       4 bytes into out file, until SIGTERM or SIGINT.
+
+    With timestamps, the payload header also holds the send time. The
+    arrival time is taken from the kernel (SO_TIMESTAMPNS) and only the
+    delay and jitter histograms are kept, written to latency_file at exit.
+    Nothing is logged per packet, the received sequence numbers are
+    written to out_file as ranges at exit.
 
     Args:
         src ([str]): source ip address to listen
         dport ([int]): port to listen
         out_file ([str]): out file to log
+        log_format ([str]): "text" or "binary" (uint32 records)
+        timestamps ([bool]): packets carry a send timestamp
+        latency_file ([str]): delay summary, defaults to out_file with a
+            "_latency.json" suffix
     """
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.bind(("", dport))
-    output_log = open(out_file, "w")
-    c = 0
-    try:
-        while True:
-            data, address = s.recvfrom(2048)
-            # only accept packets from the expected source
-            if address[0] == src:
-                c += 1
-                output_log.write("{}\n".format(
-                    int.from_bytes(data[:4], 'big')))
-                output_log.flush()
-
-    except:
-        print("Packets received {}".format(c))
-        s.close()
-        output_log.close()
+    receiver = MultiFlowReceiver()
+    receiver.add_flow(src, dport, out_file, log_format, timestamps, latency_file)
+    receiver.run()
 
 
-def save_sequences(sequences, file_name):
+def save_sequences(sequences, file_name, log_format="text", ranges=False):
     """Helper function to save sequence numbers in bulk
 
     Args:
         sequences ([list]): list of sequences
         file_name ([str]):  output file
+        log_format ([str]): "text" or "binary"
+        ranges ([bool]): store binary logs as ranges
     """
 
-    with open(file_name, "w") as f:
+    output_log = open_sequence_log(file_name, log_format, ranges)
+    try:
         for seq in sequences:
-            f.write("{}\n".format(seq))
+            output_log.add(seq)
+    finally:
+        output_log.close()
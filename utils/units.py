@@ -0,0 +1,28 @@
+"""Size and rate notation of traffic specs, such as 100K, 1.5M or 2G.
+
+Shared by the senders, the scoring, the traffic matrix generator and the
+controller, so that they all agree on what a rate means. Runs on Python 2
+and 3 without dependencies: it is copied to the hosts next to udp.py, and
+the controller imports it from the utils directory.
+"""
+
+
+def setSizeToInt(size):
+    """" Converts the sizes string notation to the corresponding integer
+    (in bytes).  Input size can be given with the following
+    magnitudes: B, K, M and G, plain numbers have no magnitude.
+    """
+    if isinstance(size, int):
+        return size
+    elif isinstance(size, float):
+        return int(size)
+    try:
+        conversions = {'B': 1, 'K': 1e3, 'M': 1e6, 'G': 1e9}
+        size = size.strip()
+        magnitude = conversions.get(size[-1].upper())
+        if magnitude is None:
+            return int(float(size))
+        return int(magnitude * float(size[:-1]))
+    except (AttributeError, IndexError, ValueError):
+        print("Conversion Fail")
+        return 0
@@ -2,6 +2,9 @@ from __future__ import print_function
 import sys, os
 import subprocess
 import json
+import csv
+import hashlib
+import pickle
 
 # network mapping, this could be a conf file
 NODE_TO_CONTAINER = {
@@ -23,6 +26,101 @@ NODE_TO_CONTAINER = {
     "h6" : "1_S6host"
 }
 
+# Columns of a traffic spec, in the order of generated specs.
+TRAFFIC_FIELDS = ["src", "dst", "sport", "dport", "tos", "rate", "duration",
+                  "packet_size", "start_time"]
+
+
+class TrafficDialect(csv.Dialect):
+    """Fixed csv dialect of generated traffic specs."""
+    delimiter = ","
+    quotechar = '"'
+    doublequote = True
+    skipinitialspace = True
+    lineterminator = "\n"
+    quoting = csv.QUOTE_MINIMAL
+
+
+def read_traffic_spec(path):
+    """Yields the flows of a traffic spec one at a time.
+
+    Specs with the fixed header of TrafficDialect are read directly,
+    hand-written specs have their dialect sniffed from the first 1 KB.
+    """
+    with open(path, 'r') as csvfile:
+        header = csvfile.readline()
+        if header.rstrip("\r\n") == ",".join(TRAFFIC_FIELDS):
+            dialect = TrafficDialect
+        else:
+            dialect = csv.Sniffer().sniff(header + csvfile.read(1024))
+        csvfile.seek(0)
+        for row in csv.DictReader(csvfile, dialect=dialect):
+            yield row
+
+
+# Binary sidecar of topology.db, written by topodb-build.py. It is meant for
+# tools that only need adjacency and interface attributes (the link monitor
+# and the traffic matrix generator). The controller, the orchestrator and the
+# app runner need the p4utils Topology (thrift ports, device ids, interface
+# names, the networkx graph) and still load the JSON.
+TOPOLOGY_INDEX_SUFFIX = ".index.pkl"
+
+
+def build_topology_index(topo):
+    """Adjacency, port, MAC, IP and bandwidth indexes of a topology.db dict.
+
+    Returns:
+        dict: `types` maps nodes to their type, `adjacency` to their sorted
+            neighbors. `ports`, `macs`, `ips` and `bw` map nodes to a dict
+            with the attribute of their interface towards each neighbor.
+    """
+    index = {"types": {}, "adjacency": {}, "ports": {}, "macs": {},
+             "ips": {}, "bw": {}}
+    for node, attributes in topo.items():
+        to_node = attributes.get("interfaces_to_node", {})
+        to_port = attributes.get("interfaces_to_port", {})
+        neighbors = sorted(set(to_node.values()))
+        index["types"][node] = attributes["type"]
+        index["adjacency"][node] = neighbors
+        index["ports"][node] = {to_node[intf]: to_port[intf]
+                                for intf in to_node if intf in to_port}
+        for key, field in (("macs", "mac"), ("ips", "ip"), ("bw", "bw")):
+            index[key][node] = {neighbor: attributes[neighbor].get(field)
+                                for neighbor in neighbors
+                                if neighbor in attributes}
+    return index
+
+
+def _file_digest(path):
+    with open(path, 'rb') as db_file:
+        return hashlib.sha1(db_file.read()).hexdigest()
+
+
+def save_topology_index(topo, db_path):
+    """Write the index of a topology next to its topology.db."""
+    data = {"db_sha1": _file_digest(db_path),
+            "index": build_topology_index(topo)}
+    with open(db_path + TOPOLOGY_INDEX_SUFFIX, 'wb') as index_file:
+        # Protocol 2 can be read by Python 2 and 3.
+        pickle.dump(data, index_file, protocol=2)
+
+
+def load_topology_index(db_path):
+    """Load the index of a topology.db.
+
+    Falls back to building the index from the JSON if the sidecar is
+    missing or was written for a different topology.db.
+    """
+    try:
+        with open(db_path + TOPOLOGY_INDEX_SUFFIX, 'rb') as index_file:
+            data = pickle.load(index_file)
+        if data["db_sha1"] == _file_digest(db_path):
+            return data["index"]
+    except (IOError, OSError, EOFError, KeyError, pickle.UnpicklingError):
+        pass
+    return build_topology_index(load_conf(db_path))
+
+
 base_docker_run = "sudo docker exec {} {} {}"
 
 base_docker_copy = "sudo docker cp {source} {container}:{dest}"